@@ -0,0 +1,326 @@
+"""
+Benchmark the data pipeline (clean -> sketch -> craft) on a fixed subset of `./repos`.
+
+Each stage runs in its own process, the same way as `run_step{1,2,3}_*.sh` (with a
+single worker, so the timings do not depend on the machine's core count), and is
+measured for its wall time and peak RSS. The sketch stage also reports the time
+spent in the main functions of `extract_sketch.py`. The report is a JSON file,
+optionally compared against a stored baseline report:
+
+    python benchmark_pipeline.py --output benchmark_report.json --baseline benchmark_baseline.json
+"""
+
+import argparse
+import functools
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+)
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+REPO_NAMES = "dacite-master,PySnooper-master,astroML-main"
+STAGES = ["clean", "sketch", "craft"]
+
+# functions of `extract_sketch` timed in the sketch stage
+PROFILED_FUNCTIONS = [
+    "replace_function_body",
+    "get_function_body",
+    "add_imports_infos",
+]
+
+
+class FunctionTimer:
+    """
+    Count the calls and the total time of module functions, by replacing them
+    with timed wrappers in their module.
+    """
+
+    def __init__(self, module, function_names):
+        self.timings = {
+            name: {"calls": 0, "total_time": 0.0} for name in function_names
+        }
+        for name in function_names:
+            setattr(module, name, self.wrap(name, getattr(module, name)))
+
+    def wrap(self, name, function):
+        timing = self.timings[name]
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                timing["calls"] += 1
+                timing["total_time"] += time.perf_counter() - start_time
+
+        return wrapper
+
+    def report(self):
+        return {
+            name: dict(timing, mean_time=timing["total_time"] / max(timing["calls"], 1))
+            for name, timing in self.timings.items()
+        }
+
+
+def profile_sketch_stage(base_path, output_path, repo_names, timings_path):
+    """
+    Run the sketch stage like `extract_sketch.py --workers 1` with the timed functions,
+    and save their timings to `timings_path`.
+    """
+    import extract_sketch
+
+    timer = FunctionTimer(extract_sketch, PROFILED_FUNCTIONS)
+    for repo_name in repo_names:
+        extract_sketch.extract_repo(repo_name, base_path, output_path)
+
+    with open(timings_path, "w") as f:
+        json.dump(timer.report(), f, indent=4)
+
+
+def get_peak_rss_mb(rusage):
+    # kilobytes on Linux, bytes on macOS
+    if sys.platform == "darwin":
+        return rusage.ru_maxrss / 1024 / 1024
+    return rusage.ru_maxrss / 1024
+
+
+def run_stage(command, log_path):
+    """
+    Run a stage command, returning its exit code, wall time and peak RSS.
+    """
+    with open(log_path, "w") as log_file:
+        start_time = time.perf_counter()
+        process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT)
+        # unlike `process.wait`, `wait4` gives the resources used by this process only
+        _, status, rusage = os.wait4(process.pid, 0)
+        wall_time = time.perf_counter() - start_time
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    return {
+        "exit_code": process.returncode,
+        "wall_time": wall_time,
+        "peak_rss_mb": get_peak_rss_mb(rusage),
+    }
+
+
+def get_stage_commands(stage, args, work_dir):
+    repo_names = ",".join(args.repo_names)
+    cleaned_repos = os.path.join(work_dir, "cleaned_repos")
+    if "clean" not in args.stages:
+        cleaned_repos = args.repos_dir
+    outputs = os.path.join(work_dir, "outputs")
+    if stage == "clean":
+        return [
+            sys.executable,
+            os.path.join(ROOT_DIR, "clean_repo.py"),
+            "--base_path",
+            args.repos_dir,
+            "--new_base_path",
+            cleaned_repos,
+            "--repo_names",
+            repo_names,
+        ]
+    if stage == "sketch":
+        return [
+            sys.executable,
+            os.path.join(ROOT_DIR, "benchmark_pipeline.py"),
+            "--profile_sketch",
+            "--repos_dir",
+            cleaned_repos,
+            "--work_dir",
+            work_dir,
+            "--repo_names",
+            repo_names,
+        ]
+    if stage == "craft":
+        return [
+            sys.executable,
+            os.path.join(ROOT_DIR, "craft_train_data.py"),
+            "--input_dir",
+            outputs,
+            "--output_dir",
+            os.path.join(work_dir, "training_data"),
+        ]
+    raise ValueError(f"Unknown stage: {stage}")
+
+
+def run_benchmark(args):
+    """
+    Run the stages `args.repeat` times, keeping the fastest run of each stage.
+    """
+    stages = {}
+    for run in range(args.repeat):
+        work_dir = os.path.join(args.work_dir, f"run{run}")
+        shutil.rmtree(work_dir, ignore_errors=True)
+        os.makedirs(work_dir)
+        for stage in args.stages:
+            logging.info(f"run {run}: {stage}")
+            result = run_stage(
+                get_stage_commands(stage, args, work_dir),
+                os.path.join(work_dir, f"{stage}.log"),
+            )
+            if result["exit_code"] != 0:
+                raise RuntimeError(
+                    f"{stage} failed, see {os.path.join(work_dir, stage + '.log')}"
+                )
+            if stage == "sketch":
+                with open(os.path.join(work_dir, "sketch_timings.json")) as f:
+                    result["functions"] = json.load(f)
+            logging.info(
+                f"{stage}: {result['wall_time']:.2f}s, {result['peak_rss_mb']:.1f} MB"
+            )
+            if stage not in stages or result["wall_time"] < stages[stage]["wall_time"]:
+                stages[stage] = result
+
+    return {
+        "repo_names": args.repo_names,
+        "repeat": args.repeat,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "stages": stages,
+    }
+
+
+def get_metrics(report):
+    """
+    Flatten a report into {metric name: value}, e.g. {"sketch.wall_time": 1.2}.
+    """
+    metrics = {}
+    for stage, result in report["stages"].items():
+        metrics[f"{stage}.wall_time"] = result["wall_time"]
+        metrics[f"{stage}.peak_rss_mb"] = result["peak_rss_mb"]
+        for name, timing in result.get("functions", {}).items():
+            metrics[f"{stage}.{name}.total_time"] = timing["total_time"]
+    return metrics
+
+
+def compare_reports(report, baseline, tolerance):
+    """
+    Compare the metrics of a report with a baseline report.
+    Returns the comparison and the names of the metrics more than `tolerance` worse.
+    """
+    metrics = get_metrics(report)
+    baseline_metrics = get_metrics(baseline)
+    comparison = {}
+    regressions = []
+    for name, value in metrics.items():
+        if name not in baseline_metrics:
+            continue
+        baseline_value = baseline_metrics[name]
+        ratio = value / baseline_value if baseline_value > 0 else None
+        comparison[name] = {"baseline": baseline_value, "value": value, "ratio": ratio}
+        if ratio is not None and ratio > 1 + tolerance:
+            regressions.append(name)
+    return comparison, regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the clean -> sketch -> craft pipeline."
+    )
+    parser.add_argument(
+        "--repos_dir",
+        type=str,
+        default="./repos/",
+        help="Raw repositories (cleaned ones when the clean stage is not run).",
+    )
+    parser.add_argument(
+        "--repo_names",
+        type=str,
+        default=REPO_NAMES,
+        help="Repositories to benchmark on.",
+    )
+    parser.add_argument(
+        "--stages",
+        type=str,
+        default=",".join(STAGES),
+        help="Stages to run, a later stage reading the outputs of the earlier ones.",
+    )
+    parser.add_argument(
+        "--work_dir",
+        type=str,
+        default="./.benchmark/",
+        help="Where the stages write their outputs and logs.",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=1,
+        help="Run the stages this many times and keep the fastest run of each.",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="./benchmark_report.json",
+        help="Where to write the report.",
+    )
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        default=None,
+        help="Report to compare with; written from this run if it does not exist.",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="Relative slowdown (or memory growth) reported as a regression.",
+    )
+    parser.add_argument(
+        "--fail_on_regression",
+        action="store_true",
+        help="Exit with status 1 when a metric regressed.",
+    )
+    # internal: the process of the sketch stage
+    parser.add_argument("--profile_sketch", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.repo_names = args.repo_names.split(",")
+    args.stages = args.stages.split(",")
+
+    if args.profile_sketch:
+        profile_sketch_stage(
+            args.repos_dir,
+            os.path.join(args.work_dir, "outputs"),
+            args.repo_names,
+            os.path.join(args.work_dir, "sketch_timings.json"),
+        )
+        sys.exit(0)
+
+    report = run_benchmark(args)
+
+    regressions = []
+    if args.baseline is not None:
+        if os.path.exists(args.baseline):
+            with open(args.baseline, "r") as f:
+                baseline = json.load(f)
+            report["comparison"], regressions = compare_reports(
+                report, baseline, args.tolerance
+            )
+            for name, result in report["comparison"].items():
+                logging.info(
+                    f"{name}: {result['baseline']:.3f} -> {result['value']:.3f}"
+                    + (f" ({result['ratio']:.2f}x)" if result["ratio"] else "")
+                    + (" REGRESSION" if name in regressions else "")
+                )
+        else:
+            with open(args.baseline, "w") as f:
+                json.dump(report, f, indent=4)
+            logging.info(f"baseline saved to {args.baseline}")
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=4)
+    logging.info(f"report saved to {args.output}")
+
+    if regressions and args.fail_on_regression:
+        logging.error(f"{len(regressions)} regressions: {', '.join(regressions)}")
+        sys.exit(1)
@@ -8,6 +8,9 @@ import os
 import re
 import ipdb
 import shutil
+import time
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import isort
 import autopep8
@@ -34,73 +37,210 @@ class RepoCleaner():
         cleaned_content = re.sub(copyright_regex, '', python_file_content, count=1, flags=re.MULTILINE)
 
         return cleaned_content.strip()
-    
+
     @staticmethod
-    def remove_empty_folders(path):
-        is_deleted = False
+    def is_dropped_name(name):
+        """
+        Whether a file or folder is dropped by name: hidden entries, tests and logs.
+        """
+        return name.startswith('.') or "test" in name or "log" in name
 
-        if not os.path.isdir(path):
-            return is_deleted
-        
-        for entry in os.listdir(path):
-            full_path = os.path.join(path, entry)
-            if os.path.isdir(full_path):
-                if RepoCleaner.remove_empty_folders(full_path):
-                    is_deleted = True
-
-        if not os.listdir(path):
-            logging.info(f"Removing empty folder: {path}")
-            os.rmdir(path)
-            is_deleted = True
-
-        return is_deleted
-    
     @staticmethod
-    def delete_md(path):
+    def is_kept_file(rel_path):
         """
-        Delete all the ".md" files in a directory except the "README.md" file.
+        Whether a (relative) file path of a repository survives cleaning.
+        Only the top-level "README.md" is kept among the markdown files.
         """
-        remained_path = os.path.join(path, "README.md")
-        for root, dirs, files in os.walk(path):
-            for file in files:
-                if file.endswith(".md"):
-                    # os.remove(os.path.join(root, file))
-                    this_md_path = os.path.join(root, file)
-                    if this_md_path == remained_path:
-                        continue
-                    os.system(f"rm -rf {this_md_path}")
-
-def not_contains_py_files(directory):
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            if file.endswith('.py'):
-                return False
-    return True
-
-def list_all_paths(repo_path):
-    """
-    Get all file or folder paths in a directory
-    """
-    all_repo_paths = []
+        if rel_path.endswith('.py'):
+            return True
+        if rel_path == "README.md":
+            return True
+        if "requirements.txt" in rel_path:
+            return True
+        return rel_path.endswith('.sh') or rel_path.endswith('html')
+
+def walk_kept_files(repo_path):
+    """
+    Walk the repository once and return the relative paths of the files to keep,
+    pruning hidden, test and log folders on the way down.
+    """
+    kept_files = []
     for root, dirs, files in os.walk(repo_path):
-        for dir in dirs:
-            if dir.startswith('.'):
-                continue
-            all_repo_paths.append(os.path.join(root, dir))
-        for file in files:
-            if file.startswith('.'):
+        dirs[:] = sorted(dir for dir in dirs if not RepoCleaner.is_dropped_name(dir))
+        rel_root = os.path.relpath(root, repo_path)
+        for file in sorted(files):
+            if RepoCleaner.is_dropped_name(file):
                 continue
-            all_repo_paths.append(os.path.join(root, file))
+            rel_path = file if rel_root == "." else os.path.join(rel_root, file)
+            if RepoCleaner.is_kept_file(rel_path):
+                kept_files.append(rel_path)
 
-    return all_repo_paths
+    return kept_files
 
 def mkdir_folder_for_file(file_path):
     """
     Create folder for a file if not exists.
     """
-    folder_path = os.path.dirname(file_path)
-    if not os.path.exists(folder_path):
-        os.makedirs(folder_path)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+def clean_python_file_content(python_file_content):
+    """
+    Remove copy right, sort imports and beautify the code of a python file.
+    Return None if the file cannot be handled by `isort`.
+    """
+    cleaned_python_file_content = RepoCleaner.remove_copy_right(python_file_content)
+    try:
+        sorted_code = isort.code(cleaned_python_file_content)
+        # beatified_code = autopep8.fix_code(sorted_code) # using `autopep8`
+    except:
+        return None
+    try:
+        beatified_code = black.format_str(sorted_code, mode=black.FileMode()) # using `black`
+    except:
+        beatified_code = sorted_code
+    return beatified_code
+
+def get_cleaner_hash():
+    """
+    Hash of the cleaning code (this file, with its filters and formatter settings)
+    and of the formatter versions, so that cached results are dropped whenever they change.
+    """
+    sha = hashlib.sha256()
+    with open(__file__, 'rb') as f:
+        sha.update(f.read())
+    sha.update(f"isort={isort.__version__};black={black.__version__}".encode('utf-8'))
+    return sha.hexdigest()
+
+CLEANER_HASH = get_cleaner_hash()
+
+class FormatCache():
+    """
+    On-disk cache of cleaned python files, keyed by the hash of the raw file content
+    and of the cleaning code, so unchanged files are not re-formatted.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def key(self, python_file_content):
+        sha = hashlib.sha256()
+        sha.update(CLEANER_HASH.encode('utf-8'))
+        sha.update(python_file_content.encode('utf-8', 'surrogateescape'))
+        return sha.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".py")
+
+    def skip_path(self, key):
+        # marker for contents that `isort` fails on
+        return os.path.join(self.cache_dir, key[:2], key + ".skip")
+
+    def put(self, key, beatified_code):
+        target_path = self.path(key) if beatified_code is not None else self.skip_path(key)
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        tmp_path = f"{target_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(beatified_code or '')
+        os.replace(tmp_path, target_path)
+
+def clean_python_file(old_path, new_path, format_cache_dir=None):
+    """
+    Clean a python file, reusing the cached result if the content was cleaned before.
+    """
+    with open(old_path, 'r') as f:
+        python_file_content = f.read()
+
+    if format_cache_dir is None:
+        beatified_code = clean_python_file_content(python_file_content)
+        if beatified_code is not None:
+            mkdir_folder_for_file(new_path)
+            with open(new_path, 'w+') as f:
+                f.write(beatified_code)
+        return
+
+    format_cache = FormatCache(format_cache_dir)
+    key = format_cache.key(python_file_content)
+    if os.path.exists(format_cache.skip_path(key)):
+        return
+    if os.path.exists(format_cache.path(key)):
+        mkdir_folder_for_file(new_path)
+        shutil.copyfile(format_cache.path(key), new_path)
+        return
+
+    beatified_code = clean_python_file_content(python_file_content)
+    format_cache.put(key, beatified_code)
+    if beatified_code is not None:
+        mkdir_folder_for_file(new_path)
+        with open(new_path, 'w+') as f:
+            f.write(beatified_code)
+
+def clean_file(old_path, new_path, format_cache_dir=None):
+    """
+    Clean (or copy) a single kept file of a repository. Safe to run in a worker process.
+    Folders are only created for files that are actually written.
+    """
+    if new_path.endswith('.py'):
+        clean_python_file(old_path, new_path, format_cache_dir)
+    elif new_path.endswith("README.md"):
+        if os.path.exists(new_path):
+            return old_path
+        mkdir_folder_for_file(new_path)
+        shutil.copyfile(old_path, new_path)
+    else: # requirements.txt, shell and html files
+        mkdir_folder_for_file(new_path)
+        shutil.copyfile(old_path, new_path)
+    return old_path
+
+class CleanManifest():
+    """
+    Per-repository record of the files that have already been cleaned,
+    so that an interrupted run can resume where it stopped.
+    A manifest written by a different cleaning code (see `get_cleaner_hash`) is ignored.
+    """
+
+    def __init__(self, manifest_path, resume=False):
+        self.manifest_path = manifest_path
+        self.finished = False
+        self.files = {}
+        if resume and os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as f:
+                manifest = json.load(f)
+            if manifest.get("cleaner_hash") != CLEANER_HASH:
+                logging.info(f"{manifest_path} was written by another version of the cleaning code, cleaning again.")
+                return
+            self.finished = manifest.get("finished", False)
+            self.files = manifest.get("files", {})
+
+    @staticmethod
+    def stamp(old_path):
+        stat = os.stat(old_path)
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def is_done(self, rel_path, old_path):
+        return self.files.get(rel_path) == self.stamp(old_path)
+
+    def mark_done(self, rel_path, old_path):
+        self.files[rel_path] = self.stamp(old_path)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({"cleaner_hash": CLEANER_HASH, "finished": self.finished, "files": self.files}, f)
+        os.replace(tmp_path, self.manifest_path)
+
+def run_clean_tasks(tasks, executor=None, format_cache_dir=None):
+    """
+    Run `clean_file` over (old_path, new_path) tasks, yielding each finished old_path.
+    """
+    if executor is None:
+        for old_path, new_path in tasks:
+            yield clean_file(old_path, new_path, format_cache_dir)
+        return
+
+    futures = [executor.submit(clean_file, old_path, new_path, format_cache_dir) for old_path, new_path in tasks]
+    for future in as_completed(futures):
+        yield future.result()
 
 
 if __name__ == '__main__':
@@ -109,90 +249,78 @@ if __name__ == '__main__':
     parser.add_argument('--base_path', type=str, help='Path to repository.')
     parser.add_argument('--new_base_path', type=str, help='Cleaned repository path.')
     parser.add_argument('--repo_names', type=str, help='Repository names.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes for cleaning files.')
+    parser.add_argument('--manifest_dir', type=str, default=None, help='Where to keep per-repository manifests of cleaned files (default: <new_base_path>/.manifests).')
+    parser.add_argument('--resume', action='store_true', help='Skip files (and repositories) already recorded in the manifests.')
+    parser.add_argument('--format_cache_dir', type=str, default=None, help='On-disk cache of isort/black results keyed by content hash (disabled if not given).')
     
     args = parser.parse_args()
 
+    manifest_dir = args.manifest_dir or os.path.join(args.new_base_path, ".manifests")
+    executor = ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
+    repo_timings = []
+
     repo_names = args.repo_names.split(',')
     for repo_name in repo_names:
         repo_path = os.path.join(args.base_path, repo_name)
         new_repo_path = os.path.join(args.new_base_path, repo_name)
         logging.info(f"")
+
+        manifest = CleanManifest(os.path.join(manifest_dir, f"{repo_name}.json"), args.resume)
+        if manifest.finished:
+            logging.info(f"{repo_path} already cleaned, skipping.")
+            continue
+        start_time = time.time()
         
         # reset new_repo_path
         # if os.path.exists(new_repo_path):
         #     os.system(f"rm -rf {new_repo_path}")
 
-        all_repo_paths = list_all_paths(repo_path)
-        logging.info(f"total {len(all_repo_paths)} files in {repo_path}, cleaning...")
-        
-        for old_path in all_repo_paths:
-            new_path = old_path.replace(args.base_path, args.new_base_path)
-            
-            assert "test" not in repo_name and "log" not in repo_name
-            if "test" in new_path or "log" in new_path:
-                continue
+        assert "test" not in repo_name and "log" not in repo_name
+        # a single walk decides which files survive, so no folder, markdown file
+        # or repository without python files is ever written
+        kept_files = walk_kept_files(repo_path)
+        py_files = [rel_path for rel_path in kept_files if rel_path.endswith('.py')]
+        logging.info(f"total {len(kept_files)} files ({len(py_files)} py files) kept in {repo_path}, cleaning...")
 
-            if os.path.isdir(old_path): # folder
-                flag = False
-                for folder in os.path.dirname(new_path).split("/"):
-                    if folder.startswith('.') and "." != folder:
-                        flag = True
-                        break
-                if flag:
+        tasks = []
+        if len(py_files) == 0:
+            logging.info(f"no py files in {repo_path}, skipping...")
+        else:
+            for rel_path in kept_files:
+                old_path = os.path.join(repo_path, rel_path)
+                if manifest.is_done(rel_path, old_path):
                     continue
-                if not os.path.exists(new_path):
-                    os.makedirs(new_path)
-            else: # file
-                # if os.path.dirname(new_path).
-                flag = False
-                for folder in os.path.dirname(new_path).split("/"):
-                    if folder.startswith('.') and "." != folder:
-                        flag = True
-                        break
-                if flag:
-                    continue
-                if not os.path.exists(os.path.dirname(new_path)):
-                    os.makedirs(os.path.dirname(new_path))
-                if new_path.endswith('.py'):
-                    with open(old_path, 'r') as f:
-                        python_file_content = f.read()
-                    cleaned_python_file_content = RepoCleaner.remove_copy_right(python_file_content)
-                    try:
-                        sorted_code = isort.code(cleaned_python_file_content)
-                        # beatified_code = autopep8.fix_code(sorted_code) # using `autopep8`
-                    except:
-                        continue
-                    try:
-                        beatified_code = black.format_str(sorted_code, mode=black.FileMode()) # using `black`
-                    except:
-                        beatified_code = sorted_code
-                    with open(new_path, 'w+') as f:
-                        f.write(beatified_code)
-                elif "README.md" in new_path:
-                    if os.path.exists(new_path):
-                        continue
-                    shutil.copyfile(old_path, new_path)
-                elif "requirements.txt" in new_path:
-                    shutil.copyfile(old_path, new_path)
-                elif new_path.endswith('.sh') or new_path.endswith('html'):
-                    shutil.copyfile(old_path, new_path)
-                else:
-                    # with open(new_path, 'w+') as f:
-                    #     f.write('')
-                    pass
+                tasks.append((old_path, os.path.join(new_repo_path, rel_path)))
+
+        logging.info(f"{len(tasks)} files to clean in {repo_path}.")
+        for index, old_path in enumerate(run_clean_tasks(tasks, executor, args.format_cache_dir)):
+            manifest.mark_done(os.path.relpath(old_path, repo_path), old_path)
+            if (index + 1) % 100 == 0:
+                manifest.save()
+        manifest.save()
 
         logging.info(f"finished cleaning {repo_path}.")
         logging.info(f"clean done!")
 
-        # Delete all the ".md" files in a directory except the "README.md" file.
-        RepoCleaner.delete_md(new_repo_path)
-        logging.info(f"delete md done!")
-        
-        # Delete all empty folders in new_repo_path
-        RepoCleaner.remove_empty_folders(new_repo_path)
-        logging.info(f"remove empty folders done!")
-
-        if not_contains_py_files(new_repo_path):
+        # python files rejected by `isort` are not written, drop the repository if none is left
+        if os.path.isdir(new_repo_path) and not any(
+            os.path.exists(os.path.join(new_repo_path, rel_path)) for rel_path in py_files
+        ):
             logging.info(f"no py files in {new_repo_path}, removing...")
-            os.system(f"rm -rf {new_repo_path}")
-            logging.info(f"remove done!")
\ No newline at end of file
+            shutil.rmtree(new_repo_path)
+            logging.info(f"remove done!")
+
+        manifest.finished = True
+        manifest.save()
+        repo_timings.append((repo_name, len(tasks), time.time() - start_time))
+
+    if executor is not None:
+        executor.shutdown()
+
+    total_files = sum(num_files for _, num_files, _ in repo_timings)
+    total_seconds = sum(seconds for _, _, seconds in repo_timings)
+    for repo_name, num_files, seconds in repo_timings:
+        logging.info(f"{repo_name}: {num_files} files in {seconds:.2f}s")
+    logging.info(f"cleaned {total_files} files of {len(repo_timings)} repositories in {total_seconds:.2f}s "
+                 f"({total_files / max(total_seconds, 1e-9):.2f} files/sec)")
@@ -1,52 +1,334 @@
+import argparse
+import functools
 import json
+import logging
 import os
+import random
+from concurrent.futures import ProcessPoolExecutor
 
-saved_name = "codes_train_data_v11_24.03.08.json"
+from record_utils import (
+    RecordWriter,
+    get_record_extension,
+    get_record_name,
+    is_record_file,
+    iter_records,
+)
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+)
+
+saved_name = "codes_train_data"
 max_lens_for_repo = 50
-code_data_size = 2000
-nl_data_size = 2000
-
-# # Load model directly
-# from transformers import AutoTokenizer, AutoModelForCausalLM
-# tokenizer = AutoTokenizer.from_pretrained("/Users/zandaoguang/Desktop/CodeLlama-7b-Instruct")
-
-# def cal_tokens(text):
-#     inputs = tokenizer(text)
-#     input_ids = inputs["input_ids"]
-#     return len(input_ids)
-
-path = "/Users/zandaoguang/Desktop/Intern/huawei/codes/outputs"
-new_data = []
-over_num = 0
-for root, dirs, files in os.walk(path):
-    for file in files:
-        if file.endswith(".json"):
-            file_path = os.path.join(root, file)
-            with open(file_path, "r") as file:
-                data = json.load(file)
-                filted_data = []
-                for item in data:
-                    # this_tokens = cal_tokens(item["instruction"]+item["output"])
-                    # print(this_tokens)
-                    words_len = len((item["instruction"]+item["output"]).split(" "))
-                    if words_len > 10000:
-                        over_num += 1
-                        continue
-                    # if this_tokens > max_sizes:
-                    #     max_sizes = this_tokens
-                    filted_data.append(item)
-
-                import random
-                random.shuffle(filted_data)
-
-                new_data.extend(filted_data[:max_lens_for_repo])               
-
-print(f"over: {over_num}")
-print(f"saved: {len(new_data)}")
-
-saved_path = f"/Users/zandaoguang/Desktop/Intern/huawei/codes/training_data/{saved_name}"
-
-with open(saved_path, "w+") as file:
-    json.dump(new_data, file, indent=4)
-
-print("done!")
\ No newline at end of file
+max_length = 10000
+
+# tokenizer of the worker process, see `init_worker`
+tokenizer = None
+
+
+def init_worker(tokenizer_name_or_path):
+    """
+    Load the tokenizer once per worker process.
+    """
+    global tokenizer
+    if tokenizer_name_or_path is None:
+        return
+
+    try:
+        from transformers import AutoTokenizer
+    except ImportError:
+        raise ImportError("Please install transformers via `pip install transformers`")
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name_or_path, use_fast=True)
+
+
+def cal_tokens(texts):
+    """
+    Lengths of a batch of texts, in tokens (in words without a tokenizer).
+    """
+    if tokenizer is None:
+        return [len(text.split(" ")) for text in texts]
+
+    input_ids = tokenizer(texts, add_special_tokens=False)["input_ids"]
+    return [len(x) for x in input_ids]
+
+
+def find_record_files(input_dir):
+    """
+    All the record files of the extracted repositories, in a stable order.
+    """
+    record_files = []
+    for root, dirs, files in os.walk(input_dir):
+        # skip the incremental cache and logs of extract_sketch.py
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for file in files:
+            # e.g. the temporary file of a prompt store being written
+            if file.startswith("."):
+                continue
+            if is_record_file(file):
+                record_files.append(os.path.join(root, file))
+
+    return sorted(record_files)
+
+
+def sample_record_file(file_path, input_dir, max_length, max_samples, seed, batch_size):
+    """
+    Filter the records of a file by length and sample at most `max_samples` of them.
+    The sampling only depends on the seed, the repository directory and the records
+    name (e.g. "function_body"), not on the processing order or the file format.
+    Returns `(records, lengths, over_num)`.
+    """
+    filted_data = []
+    lengths = []
+    over_num = 0
+
+    def flush(batch):
+        nonlocal over_num
+        this_lengths = cal_tokens([x["instruction"] + x["output"] for x in batch])
+        for item, length in zip(batch, this_lengths):
+            if length > max_length:
+                over_num += 1
+                continue
+            filted_data.append(item)
+            lengths.append(length)
+
+    batch = []
+    for item in iter_records(file_path):
+        batch.append(item)
+        if len(batch) == batch_size:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+
+    records_key = os.path.join(
+        os.path.relpath(os.path.dirname(file_path), input_dir),
+        get_record_name(file_path),
+    )
+    rng = random.Random(f"{seed}:{records_key}")
+    indexes = list(range(len(filted_data)))
+    rng.shuffle(indexes)
+    indexes = indexes[:max_samples]
+
+    return [filted_data[i] for i in indexes], [lengths[i] for i in indexes], over_num
+
+
+def get_length_histogram(lengths, bin_size):
+    """
+    Number of samples per length bin, e.g. {"0-511": 10, "512-1023": 3}.
+    """
+    bins = {}
+    for length in lengths:
+        bins[length // bin_size] = bins.get(length // bin_size, 0) + 1
+
+    return {f"{i * bin_size}-{(i + 1) * bin_size - 1}": bins[i] for i in sorted(bins)}
+
+
+def get_bucket(length, bucket_boundaries):
+    """
+    Index of the length bucket, bucket `i` holding the lengths up to `bucket_boundaries[i]`.
+    """
+    for i, boundary in enumerate(bucket_boundaries):
+        if length <= boundary:
+            return i
+    return len(bucket_boundaries)
+
+
+class ShardWriter:
+    """
+    Write records into shards of at most `shard_size` records.
+    """
+
+    def __init__(self, output_dir, shard_size, extension, prefix="train"):
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+        self.extension = extension
+        self.prefix = prefix
+        self.shard_paths = []
+        self.writer = None
+
+    def write(self, record):
+        if self.writer is None or self.writer.num_records == self.shard_size:
+            self.close()
+            shard_path = os.path.join(
+                self.output_dir,
+                f"{self.prefix}-{len(self.shard_paths):05d}{self.extension}",
+            )
+            self.shard_paths.append(shard_path)
+            self.writer = RecordWriter(shard_path)
+        self.writer.write(record)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Crafting training data from the extracted sketches."
+    )
+    parser.add_argument(
+        "--input_dir", type=str, default="./outputs/", help="Extracted sketches."
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        default=f"./training_data/{saved_name}",
+        help="Where to write the shards of the training data.",
+    )
+    parser.add_argument(
+        "--tokenizer",
+        type=str,
+        default=None,
+        help="Tokenizer (name or path) measuring the lengths; whitespace-split words if not given.",
+    )
+    parser.add_argument(
+        "--max_length",
+        type=int,
+        default=max_length,
+        help="Drop the samples whose instruction and output are longer than this.",
+    )
+    parser.add_argument(
+        "--max_lens_for_repo",
+        type=int,
+        default=max_lens_for_repo,
+        help="Max samples kept from each record file (one per repository and phase).",
+    )
+    parser.add_argument("--seed", type=int, default=42, help="Sampling seed.")
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Number of tokenizing processes."
+    )
+    parser.add_argument(
+        "--batch_size", type=int, default=64, help="Texts per tokenizer call."
+    )
+    parser.add_argument(
+        "--shard_size", type=int, default=10000, help="Samples per output shard."
+    )
+    parser.add_argument(
+        "--compression",
+        type=str,
+        default="none",
+        choices=["none", "gzip", "zstd"],
+        help="Compression of the output shards.",
+    )
+    parser.add_argument(
+        "--bucket_boundaries",
+        type=str,
+        default=None,
+        help="Comma-separated lengths, e.g. 1024,2048,4096: write the samples into one set "
+        "of shards per length bucket, with their token length in a `length` field.",
+    )
+    parser.add_argument(
+        "--histogram_bin_size",
+        type=int,
+        default=512,
+        help="Width of the bins of the length histogram.",
+    )
+    args = parser.parse_args()
+
+    if args.tokenizer is None:
+        logging.warning("no --tokenizer given, measuring lengths in words")
+
+    record_files = find_record_files(args.input_dir)
+    logging.info(f"found {len(record_files)} record files in {args.input_dir}")
+
+    sample = functools.partial(
+        sample_record_file,
+        input_dir=args.input_dir,
+        max_length=args.max_length,
+        max_samples=args.max_lens_for_repo,
+        seed=args.seed,
+        batch_size=args.batch_size,
+    )
+    if args.workers > 1:
+        executor = ProcessPoolExecutor(
+            max_workers=args.workers,
+            initializer=init_worker,
+            initargs=(args.tokenizer,),
+        )
+        # `map` keeps the order of the files, so the output is reproducible
+        results = executor.map(sample, record_files)
+    else:
+        executor = None
+        init_worker(args.tokenizer)
+        results = map(sample, record_files)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    # drop the shards of a previous run
+    for file in os.listdir(args.output_dir):
+        if file.startswith("train-") and is_record_file(file):
+            os.remove(os.path.join(args.output_dir, file))
+    extension = get_record_extension("jsonl", args.compression)
+    bucket_boundaries = []
+    if args.bucket_boundaries:
+        bucket_boundaries = sorted(int(x) for x in args.bucket_boundaries.split(","))
+    # without buckets, every sample goes to the single bucket 0
+    shard_writers = [
+        ShardWriter(
+            args.output_dir,
+            args.shard_size,
+            extension,
+            f"train-bucket{i:02d}" if bucket_boundaries else "train",
+        )
+        for i in range(len(bucket_boundaries) + 1)
+    ]
+    all_lengths = []
+    over_num = 0
+    for records, lengths, this_over_num in results:
+        for record, length in zip(records, lengths):
+            if bucket_boundaries:
+                record = dict(record, length=length)
+            shard_writers[get_bucket(length, bucket_boundaries)].write(record)
+        all_lengths.extend(lengths)
+        over_num += this_over_num
+    for shard_writer in shard_writers:
+        shard_writer.close()
+    shard_paths = [
+        x for shard_writer in shard_writers for x in shard_writer.shard_paths
+    ]
+
+    if executor is not None:
+        executor.shutdown()
+
+    # next to the shards, so that the data directory only holds data files
+    stats_path = args.output_dir.rstrip("/") + ".stats.json"
+    with open(stats_path, "w") as f:
+        json.dump(
+            {
+                "tokenizer": args.tokenizer,
+                "max_length": args.max_length,
+                "max_lens_for_repo": args.max_lens_for_repo,
+                "seed": args.seed,
+                "over": over_num,
+                "saved": len(all_lengths),
+                "shards": [os.path.basename(x) for x in shard_paths],
+                "buckets": [
+                    {
+                        "max_length": (
+                            bucket_boundaries[i] if i < len(bucket_boundaries) else None
+                        ),
+                        "shards": [
+                            os.path.basename(x) for x in shard_writer.shard_paths
+                        ],
+                        "samples": sum(
+                            get_bucket(x, bucket_boundaries) == i for x in all_lengths
+                        ),
+                    }
+                    for i, shard_writer in enumerate(shard_writers)
+                ]
+                if bucket_boundaries
+                else None,
+                "max_tokens": max(all_lengths, default=0),
+                "mean_tokens": sum(all_lengths) / max(len(all_lengths), 1),
+                "length_histogram": get_length_histogram(
+                    all_lengths, args.histogram_bin_size
+                ),
+            },
+            f,
+            indent=4,
+        )
+
+    logging.info(f"over: {over_num}")
+    logging.info(f"saved: {len(all_lengths)} in {len(shard_paths)} shards")
+    logging.info(f"statistics saved to {stats_path}")
+    logging.info("done!")
@@ -2,18 +2,29 @@
 # Licensed under the MIT license.
 import logging
 import json
+import contextlib
+import cProfile
 import sys
 import os
 import re
+import hashlib
+import functools
+import io
+import time
+import tokenize
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
 
 import black
 import ast
 import astor
 import pathlib
+from typing import NamedTuple
 
 sys.path.append(str(pathlib.Path(__file__).parent.absolute()))
 import prompt_construction_utils as prpt_util
+from parse_utils import get_parseable_prefix
+from record_utils import RecordWriter, get_record_extension
 
 repo_path = None
 
@@ -22,6 +33,84 @@ logging.basicConfig(
 )
 
 
+class Profiler:
+    """
+    Opt-in instrumentation of the extraction (see `--profile_dir`): the time spent
+    in each named stage and in the parse/format calls, and the cache hits and misses.
+    Stages are timed inclusively, e.g. "relevant_sketch" is part of "function_body".
+    While disabled, a stage costs a no-op context manager.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.timings = {}
+        self.counters = {}
+
+    def stage(self, name):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self.timed(name)
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            timing = self.timings.setdefault(name, {"calls": 0, "total_time": 0.0})
+            timing["calls"] += 1
+            timing["total_time"] += time.perf_counter() - start_time
+
+    def count(self, name, hit):
+        if self.enabled:
+            counter = self.counters.setdefault(name, {"hits": 0, "misses": 0})
+            counter["hits" if hit else "misses"] += 1
+
+    @contextlib.contextmanager
+    def profile(self, profile_path, use_cprofile=False):
+        """
+        Profile the code run in the context into `<profile_path>.json`
+        (and `<profile_path>.pstats` with `use_cprofile`).
+        """
+        self.enabled = True
+        self.timings = {}
+        self.counters = {}
+        cprofiler = cProfile.Profile() if use_cprofile else None
+        try:
+            if cprofiler is not None:
+                cprofiler.enable()
+            with self.timed("total"):
+                yield
+        finally:
+            self.enabled = False
+            os.makedirs(os.path.dirname(profile_path), exist_ok=True)
+            if cprofiler is not None:
+                cprofiler.disable()
+                cprofiler.dump_stats(profile_path + ".pstats")
+            with open(profile_path + ".json", "w") as f:
+                json.dump(
+                    {"timings": self.timings, "counters": self.counters}, f, indent=4
+                )
+
+
+profiler = Profiler()
+
+
+def parse_code(source_code):
+    with profiler.stage("ast.parse"):
+        return ast.parse(source_code)
+
+
+def unparse_code(parsed_code):
+    with profiler.stage("astor.to_source"):
+        return astor.to_source(parsed_code)
+
+
+def format_code(source_code):
+    with profiler.stage("black.format_str"):
+        return black.format_str(source_code, mode=black.FileMode())
+
+
 def extract_imports(python_file_content):
     all_lines = python_file_content.split("\n")
     imports_list = []
@@ -53,138 +142,333 @@ def zip_imports(imports_list):
     return base_prompt.strip()
 
 
-def get_tree(directory, prefix="", tree_lists=[(".", "None")]):
+class RepoTreeEntry(NamedTuple):
+    item: str  # line of the rendered tree, e.g. "├── utils.py"
+    path: str  # path of the file or folder, "None" for the root line
+
+
+class RepoTree:
     """
-    Get the tree structure of the given directory.
+    The tree of a repository, as the list of its entries in rendering order,
+    indexed by path, by module (see `ModuleIndex`) and by path component (see
+    `extract_relevant_file_paths`). The indexes and the rendered string are built
+    on first use, so a tree must not be mutated: `with_items` makes a new one.
+
+    It iterates like the `(item, path)` tree lists it replaces.
     """
-    files = []
-    dirs = []
-    items = os.listdir(directory)
-    items.sort()  # Sort files and directories to maintain consistent order
-    for item in items:
-        path = os.path.join(directory, item)
-        if os.path.isdir(path):
-            dirs.append(item)
-        else:
-            files.append(item)
-
-    # Handle files in the current directory
-    for index, item in enumerate(files):
-        if item.endswith(".py") or item == "README.md" or item.endswith(".sh"):
-            connector = "└── " if index == len(files) - 1 and not dirs else "├── "
-            tree_lists.append(
-                (prefix + connector + item, os.path.join(directory, item))
-            )
 
-    # Handle subdirectories in the current directory
-    for index, item in enumerate(dirs):
-        connector = "└── " if index == len(dirs) - 1 else "├── "
-        tree_lists.append((prefix + connector + item, os.path.join(directory, item)))
-        new_prefix = prefix + "    " if index == len(dirs) - 1 else prefix + "|   "
-        get_tree(os.path.join(directory, item), new_prefix, tree_lists)
+    def __init__(self, entries, repo_path=None):
+        self.entries = [RepoTreeEntry(*entry) for entry in entries]
+        self.repo_path = repo_path
+        self.positions = {}
+        for position, entry in enumerate(self.entries):
+            self.positions.setdefault(entry.path, position)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, index):
+        return self.entries[index]
+
+    def get(self, path):
+        """
+        Entry of a path, or None.
+        """
+        if path not in self.positions:
+            return None
+        return self.entries[self.positions[path]]
+
+    def with_items(self, items):
+        """
+        New tree with the same paths and the given items (e.g. annotated with imports).
+        """
+        return RepoTree(
+            [(item, entry.path) for item, entry in zip(items, self.entries)],
+            self.repo_path,
+        )
+
+    @functools.cached_property
+    def module_index(self):
+        repo_path = self.repo_path
+        if repo_path is None:
+            repo_path = get_tree_root(self.entries)
+        return ModuleIndex(self.entries, repo_path)
+
+    def resolve(self, level, module, importer_path=None):
+        """
+        Entries an imported module refers to, see `ModuleIndex.resolve`.
+        """
+        return self.module_index.resolve(level, module, importer_path)
+
+    @functools.cached_property
+    def component_positions(self):
+        """
+        {path component without extension: positions of the Python files with it}.
+        """
+        component_positions = {}
+        for position, entry in enumerate(self.entries):
+            if not entry.path.endswith(".py"):
+                continue
+            for component in parse_path_to_lists(entry.path):
+                positions = component_positions.setdefault(component, [])
+                if not positions or positions[-1] != position:
+                    positions.append(position)
+        return component_positions
+
+    @functools.cached_property
+    def tree_str(self):
+        return "".join(entry.item + "\n" for entry in self.entries)
+
 
-    return tree_lists
+def build_repo_tree(repo_path):
+    """
+    Get the tree of a repository: its Python, shell and README.md files and all its folders.
+    Folders are walked depth-first with `os.scandir`, files before subfolders, both sorted.
+    """
+    entries = [(".", "None")]
+    # a folder pushes its entries and subfolders in reverse, so that they pop in order
+    stack = [("folder", (repo_path, ""))]
+    while stack:
+        kind, value = stack.pop()
+        if kind == "entry":
+            entries.append(value)
+            continue
+        path, prefix = value
+
+        files = []
+        dirs = []
+        with os.scandir(path) as scanned:
+            for entry in sorted(scanned, key=lambda x: x.name):
+                if entry.is_dir():
+                    dirs.append(entry.name)
+                else:
+                    files.append(entry.name)
+
+        children = []
+        for index, item in enumerate(files):
+            if item.endswith(".py") or item == "README.md" or item.endswith(".sh"):
+                # the last file gets the last connector even if it is not listed
+                connector = "└── " if index == len(files) - 1 and not dirs else "├── "
+                children.append(
+                    ("entry", (prefix + connector + item, os.path.join(path, item)))
+                )
+        for index, item in enumerate(dirs):
+            connector = "└── " if index == len(dirs) - 1 else "├── "
+            new_prefix = prefix + "    " if index == len(dirs) - 1 else prefix + "|   "
+            children.append(
+                ("entry", (prefix + connector + item, os.path.join(path, item)))
+            )
+            children.append(("folder", (os.path.join(path, item), new_prefix)))
+        stack.extend(reversed(children))
+
+    return RepoTree(entries, repo_path)
 
 
 def get_tree_str(tree_lists):
     """
     Transform the tree lists into a string.
     """
+    if isinstance(tree_lists, RepoTree):
+        return tree_lists.tree_str
     tree_str = ""
     for item, path in tree_lists:
         tree_str += item + "\n"
     return tree_str
 
 
-def is_import_line_in_repo_sketch(import_line, tree_lists):
+IGNORE_KEY_WORDS = {
+    "re",
+    "json",
+    "ast",
+    "os",
+    "socket",
+    "typing",
+    "dis",
+    "io",
+    "six",
+    "config",
+    "time",
+    "logging",
+    "unittest",
+    "sys",
+    "random",
+    "pickle",
+    "inspect",
+    "subprocess",
+    "multiprocessing",
+    "threading",
+    "collections",
+    "functools",
+    "math",
+    "numpy",
+    "pandas",
+    "scipy",
+    "sklearn",
+    "torch",
+    "tensorflow",
+    "keras",
+    "mxnet",
+    "cntk",
+    "jax",
+    "chainer",
+    "cupy",
+    "paddle",
+    "tvm",
+    "onnx",
+    "pytorch_lightning",
+    "transformers",
+    "nltk",
+    "spacy",
+    "gensim",
+    "textblob",
+    "jupyter",
+    "matplotlib",
+    "seaborn",
+    "plotly",
+    "bokeh",
+    "dash",
+    "streamlit",
+    "pyecharts",
+    "pydot",
+    "graphviz",
+    "pytorch_geometric",
+    "dgl",
+    "networkx",
+    "scikit-image",
+    "opencv-python",
+    "pillow",
+    "imageio",
+    "scikit-learn",
+    "string",
+    "base64",
+    "csv",
+    "pygame",
+}
+
+
+def parse_import_line(import_line):
     """
-    Judge whether the import line is in the repository sketch.
+    Parse an import line into `(level, module, names)` tuples, e.g.
+    `from ..a.b import c` -> `[(2, "a.b", ["c"])]`, `import a, b.c` -> `[(0, "a", []), (0, "b.c", [])]`.
+    Works on a single line, so multi-line imports are parsed as far as they go.
     """
+    import_line = import_line.split("#")[0].strip()
+    match = re.match(r"^from\s+(\.*)\s*([\w.]*)\s+import\b(.*)$", import_line)
+    if match:
+        names = [
+            name.split(" as ")[0].strip(" ()\\")
+            for name in match.group(3).split(",")
+        ]
+        return [
+            (len(match.group(1)), match.group(2), [name for name in names if name])
+        ]
 
-    ignore_key_words = [
-        "re",
-        "json",
-        "ast",
-        "os",
-        "socket",
-        "typing",
-        "dis",
-        "io",
-        "six",
-        "config",
-        "time",
-        "logging",
-        "unittest",
-        "sys",
-        "random",
-        "pickle",
-        "inspect",
-        "subprocess",
-        "multiprocessing",
-        "threading",
-        "collections",
-        "functools",
-        "math",
-        "numpy",
-        "pandas",
-        "scipy",
-        "sklearn",
-        "torch",
-        "tensorflow",
-        "keras",
-        "mxnet",
-        "cntk",
-        "jax",
-        "chainer",
-        "cupy",
-        "paddle",
-        "tvm",
-        "onnx",
-        "pytorch_lightning",
-        "transformers",
-        "nltk",
-        "spacy",
-        "gensim",
-        "textblob",
-        "jupyter",
-        "matplotlib",
-        "seaborn",
-        "plotly",
-        "bokeh",
-        "dash",
-        "streamlit",
-        "pyecharts",
-        "pydot",
-        "graphviz",
-        "pytorch_geometric",
-        "dgl",
-        "networkx",
-        "scikit-image",
-        "opencv-python",
-        "pillow",
-        "imageio",
-        "scikit-learn",
-        "string",
-        "base64",
-        "csv",
-        "pygame",
-    ]
+    match = re.match(r"^import\s+(.*)$", import_line)
+    if match:
+        modules = [
+            module.split(" as ")[0].strip(" ()\\")
+            for module in match.group(1).split(",")
+        ]
+        return [(0, module, []) for module in modules if module]
 
-    key_words = extract_key_names([import_line])
+    return []
 
-    # ipdb.set_trace()
-    for key_word in key_words:
-        if key_word in ignore_key_words:
-            continue
 
-        tree_str = get_tree_str(tree_lists)
-        if key_word in tree_str:
+class ModuleIndex:
+    """
+    Index of the Python modules and packages of a repository, built once from the tree lists.
+
+    Every module is indexed under all the suffixes of its dotted path (`src/pkg/mod.py`
+    -> `src.pkg.mod`, `pkg.mod`, `mod`), so that absolute imports resolve whichever folder
+    the code is run from.
+    """
+
+    def __init__(self, tree_lists, repo_path):
+        self.repo_path = repo_path
+        self.full_names = {}  # dotted path from the repository root -> tree entry
+        self.suffix_names = {}  # any dotted suffix -> tree entries
+        for entry in tree_lists:
+            item, path = entry
+            parts = self.get_module_parts(path)
+            if not parts:
+                continue
+            self.full_names[".".join(parts)] = entry
+            for i in range(len(parts)):
+                self.suffix_names.setdefault(".".join(parts[i:]), []).append(entry)
+
+    def get_module_parts(self, path):
+        if path == "None":
+            return []
+        rel_path = os.path.relpath(path, self.repo_path)
+        if rel_path == ".":
+            return []
+        if rel_path.endswith(".py"):
+            parts = rel_path[: -len(".py")].split(os.sep)
+            if parts[-1] == "__init__":
+                parts = parts[:-1]
+            return parts
+        if rel_path.endswith(".sh") or os.path.basename(rel_path) == "README.md":
+            return []
+        return rel_path.split(os.sep)  # package folder
+
+    def resolve(self, level, module, importer_path=None):
+        """
+        Get the tree entries an imported module refers to, or an empty list.
+        """
+        if level > 0:
+            if importer_path is None:
+                return []
+            package_parts = self.get_module_parts(os.path.dirname(importer_path))
+            if level > 1:
+                package_parts = package_parts[: -(level - 1)]
+            target = ".".join(package_parts + (module.split(".") if module else []))
+            if target == "":
+                return [(".", "None")]
+            return [self.full_names[target]] if target in self.full_names else []
+
+        if module.split(".")[0] in IGNORE_KEY_WORDS:
+            return []
+        # `import a.b.c` where `c` (and maybe `b`) are attributes rather than modules
+        parts = module.split(".")
+        for i in range(len(parts), 0, -1):
+            name = ".".join(parts[:i])
+            if name in self.suffix_names:
+                return self.suffix_names[name]
+        return []
+
+
+def is_import_line_in_repo_sketch(
+    import_line, tree_lists, module_index=None, importer_path=None, repo_path=None
+):
+    """
+    Judge whether the import line is in the repository sketch.
+    """
+    if module_index is None and isinstance(tree_lists, RepoTree):
+        module_index = tree_lists.module_index
+    if module_index is None:
+        module_index = ModuleIndex(tree_lists, repo_path or get_tree_root(tree_lists))
+
+    for level, module, names in parse_import_line(import_line):
+        if module_index.resolve(level, module, importer_path):
             return True
 
     return False
 
 
-def load_relevant_imports(python_path, tree_lists):
+def get_tree_root(tree_lists):
+    """
+    Get the repository path the tree lists were built from.
+    """
+    for item, path in tree_lists:
+        if path != "None":
+            return os.path.dirname(path)
+    return ""
+
+
+def load_relevant_imports(python_path, tree_lists, module_index=None):
     """
     Get relevant imports from the given python file according to the repository sketch.
     """
@@ -197,29 +481,43 @@ def load_relevant_imports(python_path, tree_lists):
         if line.startswith("import") or line.startswith("from"):
             imports_list.append(line)
 
+    if module_index is None and isinstance(tree_lists, RepoTree):
+        module_index = tree_lists.module_index
+    if module_index is None:
+        module_index = ModuleIndex(tree_lists, get_tree_root(tree_lists))
+
     # extract relevant imports
     relevant_imports = []
     for import_line in imports_list:
-        if is_import_line_in_repo_sketch(import_line, tree_lists):
+        if is_import_line_in_repo_sketch(
+            import_line, tree_lists, module_index, python_path
+        ):
             if "version" not in import_line:
                 relevant_imports.append(import_line)
 
     return relevant_imports
 
 
-def add_imports_infos(tree_lists):
-    new_tree_lists = []
+def add_imports_infos(tree_lists, repo_path=None):
+    """
+    Annotate the Python files of a repository tree with their imports of the repository.
+    """
+    if not isinstance(tree_lists, RepoTree):
+        tree_lists = RepoTree(tree_lists, repo_path or get_tree_root(tree_lists))
+    new_items = []
     for name, path in tree_lists:
         if path.endswith(".py"):
-            relevant_imports = load_relevant_imports(path, tree_lists)
+            relevant_imports = load_relevant_imports(
+                path, tree_lists, tree_lists.module_index
+            )
             if len(relevant_imports) > 0:
                 # print(relevant_imports)
                 # ipdb.set_trace()
                 name += " " + zip_imports(relevant_imports)
 
-        new_tree_lists.append((name, path))
+        new_items.append(name)
 
-    return new_tree_lists
+    return tree_lists.with_items(new_items)
 
 
 class FunctionNameCollector(ast.NodeVisitor):
@@ -235,13 +533,51 @@ def get_all_function_names(source_code):
     """
     Get all function names from the given source code.
     """
-    parsed_code = ast.parse(source_code)
+    parsed_code = parse_code(source_code)
     collector = FunctionNameCollector()
     collector.visit(parsed_code)
 
     return collector.function_names
 
 
+def index_function_names(function_names):
+    """
+    Index the repeated function names by occurrence: [(index, function_name), ...].
+    """
+    function_names_cnt = {}
+    all_indexed_function_names = []
+    for function_name in function_names:
+        index = function_names_cnt.get(function_name, 0)
+        function_names_cnt[function_name] = index + 1
+        all_indexed_function_names.append((index, function_name))
+
+    return all_indexed_function_names
+
+
+class FunctionNodeCollector(ast.NodeVisitor):
+    """
+    Collect the functions in the order of `FunctionNameCollector`, each with its
+    occurrence index among the functions `ReplaceFunctionBody` can mark as TODO
+    (None for the functions nested in another function).
+    """
+
+    def __init__(self):
+        self.functions = []
+        self.sketch_counts = {}
+        self.depth = 0
+
+    def visit_FunctionDef(self, node):
+        sketch_index = None
+        if self.depth == 0:
+            sketch_index = self.sketch_counts.get(node.name, 0)
+            self.sketch_counts[node.name] = sketch_index + 1
+        self.functions.append((node, sketch_index))
+
+        self.depth += 1
+        self.generic_visit(node)
+        self.depth -= 1
+
+
 class ReplaceFunctionBody(ast.NodeTransformer):
     def __init__(self, unimplemented_function_name="", index=0):
         super().__init__()
@@ -258,14 +594,15 @@ class ReplaceFunctionBody(ast.NodeTransformer):
         else:
             docstring = None
 
-        if node.name == self.unimplemented_function_name:
-            if self.index > 0:
-                self.index -= 1
-            else:
-                node.body = [ast.Expr(value=ast.Str(s="TODO"))]
+        if node.name == self.unimplemented_function_name and self.index == 0:
+            node.body = [ast.Expr(value=ast.Str(s="TODO"))]
         else:
             node.body = [ast.Pass()]
 
+        if node.name == self.unimplemented_function_name:
+            # only the `index`-th function with this name is marked as TODO
+            self.index -= 1
+
         if docstring:
             node.body.insert(0, docstring)
 
@@ -276,16 +613,83 @@ def replace_function_body(source_code, unimplemented_function_name="", index=0):
     """
     Get file sketch from the given source code by replacing the function body with "pass" or "TODO".
     """
-    parsed_code = ast.parse(source_code)
+    parsed_code = parse_code(source_code)
     transformer = ReplaceFunctionBody(unimplemented_function_name, index)
     new_code = transformer.visit(parsed_code)
-    new_code = astor.to_source(new_code)
+    new_code = unparse_code(new_code)
 
-    new_code_beautified = black.format_str(new_code, mode=black.FileMode())
+    new_code_beautified = format_code(new_code)
 
     return new_code_beautified.strip()
 
 
+class SketchFunctionCollector(ast.NodeVisitor):
+    """
+    Collect the functions of a file sketch in the order `ReplaceFunctionBody` visits them.
+    """
+
+    def __init__(self):
+        self.functions = []
+
+    def visit_FunctionDef(self, node):
+        # `ReplaceFunctionBody` does not descend into function bodies either
+        self.functions.append(node)
+
+
+class FileSketchVariants:
+    """
+    All the sketches of a file computed from a single parse/unparse/format pass.
+
+    `file_sketch` has every function body replaced with `pass`; the "TODO" variant
+    of a function is obtained by splicing its `pass` line in the file sketch, and is
+    equal to `replace_function_body(source_code, function_name, index)`.
+    """
+
+    def __init__(self, source_code):
+        self.source_code = source_code
+        self.file_sketch = replace_function_body(source_code)
+        self.lines = self.file_sketch.split("\n")
+
+        # (function_name, occurrence) -> line index of the `pass` statement
+        self.pass_lines = {}
+        counts = {}
+        collector = SketchFunctionCollector()
+        collector.visit(parse_code(self.file_sketch))
+        for node in collector.functions:
+            occurrence = counts.get(node.name, 0)
+            counts[node.name] = occurrence + 1
+            pass_node = node.body[-1]
+            line = self.lines[pass_node.lineno - 1]
+            if isinstance(pass_node, ast.Pass) and line.strip() == "pass":
+                self.pass_lines[(node.name, occurrence)] = pass_node.lineno - 1
+            else:
+                self.pass_lines[(node.name, occurrence)] = None
+
+    def get_todo_sketch(self, function_name, index=0):
+        """
+        Same as `replace_function_body(source_code, function_name, index)`.
+        An `index` of None (a nested function, not in the sketch) gives the file sketch.
+        """
+        if (function_name, index) not in self.pass_lines:
+            return self.file_sketch
+
+        line_index = self.pass_lines[(function_name, index)]
+        if line_index is None:
+            return replace_function_body(self.source_code, function_name, index)
+
+        lines = list(self.lines)
+        line = lines[line_index]
+        lines[line_index] = line[: len(line) - len(line.lstrip())] + '"""TODO"""'
+        return "\n".join(lines)
+
+    def iter_todo_sketches(self):
+        """
+        Yield `(function_name, index, sketch)` for every function that can be marked TODO.
+        """
+        for function_name, index in self.pass_lines:
+            yield function_name, index, self.get_todo_sketch(function_name, index)
+
+
 def extract_key_names(all_imports):
     """
     Extract key names from all imports.
@@ -308,60 +712,158 @@ def extract_key_names(all_imports):
     return key_names
 
 
+def parse_path_to_lists(path):
+    """
+    Path components without their extension, e.g. "./pkg/mod.py" -> ["pkg", "mod"].
+    """
+    kw_path_list = path.split("/")
+    new_kw_path_list = []
+    for index, item in enumerate(kw_path_list):
+        if item == ".":
+            continue
+        if "." in item:
+            new_kw_path_list.append(item.split(".")[0])
+        else:
+            new_kw_path_list.append(item)
+    return new_kw_path_list
+
+
 def extract_relevant_file_paths(import_key_word_list, tree_lists):
     """
-    Extract relevant file paths from the given path.
+    Extract the Python files with an import key word among their path components,
+    in tree order.
     """
+    if not isinstance(tree_lists, RepoTree):
+        tree_lists = RepoTree(tree_lists)
 
-    def parse_path_to_lists(path):
-        kw_path_list = path.split("/")
-        new_kw_path_list = []
-        for index, item in enumerate(kw_path_list):
-            if item == ".":
-                continue
-            if "." in item:
-                new_kw_path_list.append(item.split(".")[0])
-            else:
-                new_kw_path_list.append(item)
-        return new_kw_path_list
+    positions = set()
+    for key_word in import_key_word_list:
+        positions.update(tree_lists.component_positions.get(key_word, []))
 
-    relevant_file_paths = []
-    for item, this_path in tree_lists:
-        if not this_path.endswith(".py"):
-            continue
+    return [tree_lists[position].path for position in sorted(positions)]
 
-        for key_word in import_key_word_list:
-            if key_word in parse_path_to_lists(this_path):
-                relevant_file_paths.append(this_path)
-                break
 
-    return relevant_file_paths
+def get_file_sketch_variants(python_content):
+    """
+    Get the sketch variants of the largest parseable prefix of the given source code.
+    """
+    python_content = get_parseable_prefix(python_content)
+    while python_content.strip() != "":
+        try:
+            return FileSketchVariants(python_content)
+        except:
+            # parseable but not sketchable, e.g. rejected by black
+            python_content = get_parseable_prefix(
+                "\n".join(python_content.split("\n")[:-1])
+            )
+
+    return None
+
+
+class ParsedFileCache:
+    """
+    Per-repository, in-memory cache of file contents, parsed modules, file
+    sketches and function bodies, so that each file is read, parsed and
+    sketched once however many functions refer to it.
+    """
+
+    def __init__(self, insts=None):
+        self.insts = insts
+        self.contents = {}
+        self.modules = {}
+        self.sketch_variants = {}
+        self.function_bodies = {}
+        self.function_headers = {}
+
+    def get_content(self, path):
+        profiler.count("parsed_cache.contents", path in self.contents)
+        if path not in self.contents:
+            if self.insts:
+                self.contents[path] = self.insts[path]["parsed"]
+            else:
+                with open(path, "r") as f:
+                    self.contents[path] = f.read()
+        return self.contents[path]
+
+    def get_module(self, path):
+        """
+        Parsed module of the file, which must not be mutated by the caller.
+        """
+        profiler.count("parsed_cache.modules", path in self.modules)
+        if path not in self.modules:
+            self.modules[path] = parse_code(self.get_content(path))
+        return self.modules[path]
+
+    def get_sketch_variants(self, path):
+        profiler.count("parsed_cache.sketch_variants", path in self.sketch_variants)
+        if path not in self.sketch_variants:
+            self.sketch_variants[path] = get_file_sketch_variants(
+                self.get_content(path)
+            )
+        return self.sketch_variants[path]
+
+    def get_file_sketch(self, path):
+        sketch_variants = self.get_sketch_variants(path)
+        return sketch_variants.file_sketch if sketch_variants is not None else ""
+
+    def get_todo_sketch(self, path, function_name, index=0):
+        sketch_variants = self.get_sketch_variants(path)
+        if sketch_variants is None:
+            return ""
+        return sketch_variants.get_todo_sketch(function_name, index)
+
+    def get_function_header(self, path, function_name, index=0):
+        """
+        Header of the `index`-th function with the given name, all the headers of the
+        file being formatted at once.
+        """
+        profiler.count("parsed_cache.function_headers", path in self.function_headers)
+        if path not in self.function_headers:
+            self.function_headers[path] = get_function_headers(
+                self.get_content(path), self.get_module(path)
+            )
+        headers = self.function_headers[path]
+        assert (
+            index,
+            function_name,
+        ) in headers, f"cannot find function header for {function_name}"
+        return headers[(index, function_name)]
+
+    def get_function_body(self, path, function_name, index=0):
+        key = (path, function_name, index)
+        profiler.count("parsed_cache.function_bodies", key in self.function_bodies)
+        if key not in self.function_bodies:
+            self.function_bodies[key] = get_function_body(
+                path, function_name, self, index
+            )
+        return self.function_bodies[key]
 
 
 def get_relevant_final_prompt(
-    path, relevant_file_paths, function_name, repo_path=repo_path, insts=None, index=0
+    path,
+    relevant_file_paths,
+    function_name,
+    repo_path=repo_path,
+    insts=None,
+    index=0,
+    parsed_cache=None,
+    file_sketches=None,
 ):
     """
     Get the final prompt for relevant file sketch.
+    `file_sketches` may replace the sketch of some relevant files (e.g. elided ones).
     """
+    if parsed_cache is None:
+        parsed_cache = ParsedFileCache(insts)
 
     final_prompt = ""
     idx = 1
 
     for this_relevant_path in relevant_file_paths:
-        if insts:
-            this_python_content = insts[this_relevant_path]["parsed"]
+        if file_sketches is not None and this_relevant_path in file_sketches:
+            this_python_file_sketch = file_sketches[this_relevant_path]
         else:
-            with open(this_relevant_path, "r") as f:
-                this_python_content = f.read()
-
-        this_python_file_sketch = ""
-        while this_python_content.strip() != "":
-            try:
-                this_python_file_sketch = replace_function_body(this_python_content)
-                break
-            except:
-                this_python_content = "\n".join(this_python_content.split("\n")[:-1])
+            this_python_file_sketch = parsed_cache.get_file_sketch(this_relevant_path)
 
         this_relevant_path = this_relevant_path[
             (len(repo_path) + 1) if len(repo_path) > 0 else 0 :
@@ -371,19 +873,7 @@ def get_relevant_final_prompt(
         )
         idx += 1
 
-    if insts:
-        python_content = insts[path]["parsed"]
-    else:
-        with open(path, "r") as f:
-            python_content = f.read()
-    while python_content.strip() != "":
-        try:
-            current_python_content = replace_function_body(
-                python_content, function_name, index
-            )
-            break
-        except:
-            python_content = "\n".join(python_content.split("\n")[:-1])
+    current_python_content = parsed_cache.get_todo_sketch(path, function_name, index)
     path = path[(len(repo_path) + 1) if len(repo_path) > 0 else 0 :]
     final_prompt += prpt_util.get_current_file_sketch_content(
         idx, path, current_python_content
@@ -392,12 +882,25 @@ def get_relevant_final_prompt(
     return final_prompt
 
 
-def get_relevant_file_sketch(path, all_imports, tree_lists, function_name, repo_path):
+def get_relevant_file_sketch(
+    path,
+    all_imports,
+    tree_lists,
+    function_name,
+    repo_path,
+    parsed_cache=None,
+    index=0,
+):
     import_key_word_list = extract_key_names(all_imports)
     relevant_file_paths = extract_relevant_file_paths(import_key_word_list, tree_lists)
 
     relevant_file_prompt = get_relevant_final_prompt(
-        path, relevant_file_paths, function_name, repo_path
+        path,
+        relevant_file_paths,
+        function_name,
+        repo_path,
+        index=index,
+        parsed_cache=parsed_cache,
     )
 
     return relevant_file_prompt.strip()
@@ -411,89 +914,416 @@ def get_relevant_file_meta(
     repo_path=repo_path,
     insts=None,
     index=0,
+    parsed_cache=None,
 ):
     import_key_word_list = extract_key_names(all_imports)
     relevant_file_paths = extract_relevant_file_paths(import_key_word_list, tree_lists)
 
     relevant_file_prompt = get_relevant_final_prompt(
-        path, relevant_file_paths, function_name, repo_path, insts, index
+        path,
+        relevant_file_paths,
+        function_name,
+        repo_path,
+        insts,
+        index,
+        parsed_cache,
     )
 
     return relevant_file_paths, relevant_file_prompt.strip()
 
 
+def get_import_graph(file_contents, module_index):
+    """
+    Get the repository files each Python file imports: {path: [imported paths]}.
+    """
+    py_paths = {path for path in file_contents if path.endswith(".py")}
+
+    def get_py_paths(entries):
+        paths = []
+        for item, this_path in entries:
+            if not this_path.endswith(".py"):
+                # a package imports its `__init__.py`
+                this_path = os.path.join(this_path, "__init__.py")
+            if this_path in py_paths:
+                paths.append(this_path)
+        return paths
+
+    import_graph = {}
+    for path in py_paths:
+        imported_paths = []
+        for line in file_contents[path].split("\n"):
+            if not line.startswith("import") and not line.startswith("from"):
+                continue
+            for level, module, names in parse_import_line(line):
+                imported_paths.extend(
+                    get_py_paths(module_index.resolve(level, module, path))
+                )
+                # `from pkg import mod` imports the module `pkg.mod`
+                for name in names:
+                    name = f"{module}.{name}" if module else name
+                    imported_paths.extend(
+                        get_py_paths(module_index.resolve(level, name, path))
+                    )
+        import_graph[path] = [x for x in dict.fromkeys(imported_paths) if x != path]
+
+    return import_graph
+
+
+class ElideFileSketch(ast.NodeTransformer):
+    """
+    Keep only the imports, classes and function signatures of a file sketch.
+    """
+
+    KEPT_NODES = (
+        ast.Import,
+        ast.ImportFrom,
+        ast.ClassDef,
+        ast.FunctionDef,
+        ast.AsyncFunctionDef,
+    )
+
+    def elide_body(self, body, keep_all=False):
+        new_body = []
+        for node in body:
+            if isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant):
+                continue  # docstrings
+            if keep_all or isinstance(node, self.KEPT_NODES):
+                new_body.append(self.visit(node))
+        return new_body or [ast.Pass()]
+
+    def visit_Module(self, node):
+        node.body = self.elide_body(node.body)
+        return node
+
+    def visit_ClassDef(self, node):
+        node.body = self.elide_body(node.body)
+        return node
+
+    def visit_FunctionDef(self, node):
+        node.body = self.elide_body(node.body, keep_all=True)
+        return node
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+
+def elide_file_sketch(file_sketch):
+    """
+    Get the elided version of a file sketch, or None if it cannot be elided.
+    """
+    try:
+        parsed_code = ElideFileSketch().visit(parse_code(file_sketch))
+        new_code = unparse_code(parsed_code)
+        return format_code(new_code).strip()
+    except Exception:
+        return None
+
+
+class TokenCounter:
+    """
+    Count tokens with the tokenizer of the model the data is made for.
+
+    The counts of the last `max_cached_texts` texts are cached: a counter lives as
+    long as its worker process, across all the repositories it extracts.
+    """
+
+    def __init__(self, tokenizer_name_or_path, max_cached_texts=4096):
+        try:
+            from transformers import AutoTokenizer
+        except ImportError:
+            raise ImportError(
+                "Please install transformers via `pip install transformers`"
+            )
+        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_name_or_path)
+        self.count = functools.lru_cache(maxsize=max_cached_texts)(self.count_uncached)
+
+    def count_uncached(self, text):
+        return len(self.tokenizer(text, add_special_tokens=False)["input_ids"])
+
+    def count_prompt(self, prompt_template, *args):
+        """
+        Count the tokens of a prompt without tokenizing its prefix again.
+        """
+        return len(
+            prompt_template.encode(self.tokenizer, *args, add_special_tokens=False)
+        )
+
+
+@functools.lru_cache(maxsize=None)
+def get_token_counter(tokenizer_name_or_path):
+    """
+    One token counter per tokenizer and process.
+    """
+    return TokenCounter(tokenizer_name_or_path)
+
+
+class ContextPacker:
+    """
+    Fit the relevant file sketches of a function body record into a token budget.
+
+    The relevant files are ranked by their import distance from the current file
+    (direct imports first, then transitive ones, then the files only matched by
+    name); they are added in that order, elided (see `ElideFileSketch`) when their
+    full sketch does not fit, and dropped when neither fits. The budget covers the
+    instruction and the output of the record.
+    """
+
+    def __init__(self, token_counter, token_budget, import_graph, repo_path):
+        self.token_counter = token_counter
+        self.token_budget = token_budget
+        self.import_graph = import_graph
+        self.repo_path = repo_path
+        self.elided_sketches = {}
+
+    def get_import_distances(self, path):
+        distances = {path: 0}
+        queue = [path]
+        for this_path in queue:
+            for imported_path in self.import_graph.get(this_path, []):
+                if imported_path not in distances:
+                    distances[imported_path] = distances[this_path] + 1
+                    queue.append(imported_path)
+        return distances
+
+    def rank_relevant_file_paths(self, path, relevant_file_paths):
+        distances = self.get_import_distances(path)
+        # the current file is already shown as the current file sketch
+        distances[path] = float("inf")
+        return sorted(
+            relevant_file_paths,
+            key=lambda x: distances.get(x, len(self.import_graph) + 1),
+        )
+
+    def get_elided_sketch(self, path, parsed_cache):
+        if path not in self.elided_sketches:
+            self.elided_sketches[path] = elide_file_sketch(
+                parsed_cache.get_file_sketch(path)
+            )
+        return self.elided_sketches[path]
+
+    def count_record(self, prompt_template, content, function_header_content, output):
+        return self.token_counter.count_prompt(
+            prompt_template, content, function_header_content
+        ) + self.token_counter.count(output)
+
+    def pack(
+        self,
+        path,
+        relevant_file_paths,
+        function_name,
+        index,
+        parsed_cache,
+        prompt_template,
+        function_header_content,
+        output,
+    ):
+        """
+        Get the relevant file paths kept and the relevant file sketch content.
+        `prompt_template` renders the instruction from a relevant file sketch content
+        and `function_header_content`.
+        """
+
+        def count_record(content):
+            return self.count_record(
+                prompt_template, content, function_header_content, output
+            )
+
+        def get_content(paths, file_sketches):
+            return get_relevant_final_prompt(
+                path,
+                [x for x in relevant_file_paths if x in paths],
+                function_name,
+                self.repo_path,
+                index=index,
+                parsed_cache=parsed_cache,
+                file_sketches=file_sketches,
+            ).strip()
+
+        content = get_content(relevant_file_paths, None)
+        if count_record(content) <= self.token_budget:
+            return relevant_file_paths, content
+
+        remaining = self.token_budget - count_record(get_content([], None))
+        kept_paths = []
+        file_sketches = {}
+        for this_path in self.rank_relevant_file_paths(path, relevant_file_paths):
+            rel_path = os.path.relpath(this_path, self.repo_path)
+            for file_sketch in [
+                parsed_cache.get_file_sketch(this_path),
+                self.get_elided_sketch(this_path, parsed_cache),
+            ]:
+                if file_sketch is None:
+                    continue
+                num_tokens = self.token_counter.count(
+                    prpt_util.get_relervant_file_sketch_content(
+                        0, rel_path, file_sketch
+                    )
+                )
+                if num_tokens <= remaining:
+                    kept_paths.append(this_path)
+                    file_sketches[this_path] = file_sketch
+                    remaining -= num_tokens
+                    break
+
+        # the chunks were counted separately, drop the least relevant ones until it fits
+        content = get_content(kept_paths, file_sketches)
+        while kept_paths and count_record(content) > self.token_budget:
+            kept_paths.pop()
+            content = get_content(kept_paths, file_sketches)
+
+        return [x for x in relevant_file_paths if x in kept_paths], content
+
+
 def remove_duplicates(a):
     """
     Remove duplicates in a list.
     """
-    duplicates = {x for x in a if a.count(x) > 1}
-    unique_elements = [x for x in a if x not in duplicates]
+    counts = {}
+    for x in a:
+        counts[x] = counts.get(x, 0) + 1
+    unique_elements = [x for x in a if counts[x] == 1]
     return unique_elements
 
 
-def get_function_body(file_path, function_name):
+def get_function_body(file_path, function_name, parsed_cache=None, index=0):
     """
-    Get function body from the given file path and function name.
+    Get function body of the `index`-th function with the given name in the given file path.
     """
-    with open(file_path, "r") as file:
-        source_code = file.read()
+    if parsed_cache is not None:
+        parsed_code = parsed_cache.get_module(file_path)
+    else:
+        with open(file_path, "r") as file:
+            source_code = file.read()
 
-    parsed_code = ast.parse(source_code)
+        parsed_code = parse_code(source_code)
 
-    for node in ast.walk(parsed_code):
-        if isinstance(node, ast.FunctionDef) and node.name == function_name:
-            try:
-                source = astor.to_source(ast.Module(body=node.body)).strip()
-            except Exception as e:
-                print(f"cannot parse {file_path} {function_name}")
-                print(ast.dump(node))
-                print(e)
-                return None
+    collector = FunctionNodeCollector()
+    collector.visit(parsed_code)
+    nodes = [node for node, _ in collector.functions if node.name == function_name]
+    if index >= len(nodes):
+        return None
 
-            return black.format_str(source, mode=black.FileMode())
+    node = nodes[index]
+    try:
+        source = unparse_code(ast.Module(body=node.body)).strip()
+    except Exception as e:
+        print(f"cannot parse {file_path} {function_name}")
+        print(ast.dump(node))
+        print(e)
+        return None
 
-    return None
+    return format_code(source)
 
 
-def extract_function_header(python_content, this_function_name, index=0):
-    all_lines = python_content.split("\n")
-    header_lines = []
-    flag = False
-    for line in all_lines:
-        if this_function_name in line and "def " in line:
-            if index > 0:
-                index -= 1
+def get_header_source(source_lines, node):
+    """
+    Source of the header of a function node, from its `def` to the colon ending its
+    signature (found with `tokenize`, so that the colons of annotations, lambdas,
+    strings and comments are skipped).
+    """
+    lines = source_lines[node.lineno - 1 : node.body[0].lineno]
+    lines[0] = lines[0][node.col_offset :]
+    header = "\n".join(lines)
+    offsets = [0]
+    for line in lines:
+        offsets.append(offsets[-1] + len(line) + 1)
+
+    depth = 0
+    try:
+        for token in tokenize.generate_tokens(io.StringIO(header).readline):
+            if token.type != tokenize.OP:
                 continue
-            header_lines.append(line)
-            flag = True
-        if flag == True and "def " not in line:
-            header_lines.append(line)
-        if flag == True and ":" in line:
-            break
-
-    assert (
-        len(header_lines) > 0
-    ), f"cannot find function header for {this_function_name}"
-    function_header = "\n".join(header_lines)
+            if token.string in "([{":
+                depth += 1
+            elif token.string in ")]}":
+                depth -= 1
+            elif token.string == ":" and depth == 0:
+                row, col = token.end
+                return header[: offsets[row - 1] + col]
+    except (tokenize.TokenError, IndentationError):
+        pass
+    return header.strip()
+
+
+def format_function_headers(headers):
+    """
+    Format function headers with black, all in a single call when possible.
+    """
+    if not headers:
+        return []
+
     try:
-        function_header_beatiful = (
-            black.format_str(function_header.strip() + "pass", mode=black.FileMode())
-            .replace("pass", "")
-            .strip()
+        formatted = format_code(
+            "".join(header + "\n    pass\n\n\n" for header in headers)
         )
-        return function_header_beatiful
-    except:
-        return function_header.strip()
+        source_lines = formatted.split("\n")
+        nodes = [
+            node
+            for node in parse_code(formatted).body
+            if isinstance(node, ast.FunctionDef)
+        ]
+        if len(nodes) == len(headers):
+            return [get_header_source(source_lines, node) for node in nodes]
+    except Exception:
+        pass
+
+    # some header black cannot format, format them one by one
+    formatted_headers = []
+    for header in headers:
+        try:
+            formatted_headers.append(format_function_header(header))
+        except Exception:
+            formatted_headers.append(header.strip())
+    return formatted_headers
+
+
+def format_function_header(header):
+    formatted = format_code(header + "\n    pass\n")
+    return get_header_source(formatted.split("\n"), parse_code(formatted).body[0])
+
+
+def get_function_headers(python_content, parsed_code=None):
+    """
+    Get the formatted header of every function of the source code, keyed by the
+    `(index, function_name)` of `index_function_names`, with one black call for the
+    whole file.
+    """
+    if parsed_code is None:
+        parsed_code = parse_code(python_content)
+    collector = FunctionNodeCollector()
+    collector.visit(parsed_code)
 
+    source_lines = python_content.split("\n")
+    headers = format_function_headers(
+        [get_header_source(source_lines, node) for node, _ in collector.functions]
+    )
+    indexed_function_names = index_function_names(
+        [node.name for node, _ in collector.functions]
+    )
+    return dict(zip(indexed_function_names, headers))
 
-def get_function_header(path, this_function_name):
+
+def extract_function_header(python_content, this_function_name, index=0):
     """
-    Get function header from the given file path and function name.
+    Get the formatted header of the `index`-th function with the given name.
     """
-    with open(path, "r") as f:
-        python_content = f.read()
+    parsed_code = parse_code(python_content)
+    collector = FunctionNodeCollector()
+    collector.visit(parsed_code)
+    nodes = [node for node, _ in collector.functions if node.name == this_function_name]
+    assert index < len(nodes), f"cannot find function header for {this_function_name}"
 
-    return extract_function_header(python_content, this_function_name)
+    header = get_header_source(python_content.split("\n"), nodes[index])
+    return format_function_headers([header])[0]
+
+
+def get_function_header(path, this_function_name, parsed_cache=None, index=0):
+    """
+    Get function header of the `index`-th function with the given name in the given file path.
+    """
+    if parsed_cache is None:
+        parsed_cache = ParsedFileCache()
+
+    return parsed_cache.get_function_header(path, this_function_name, index)
 
 
 def add_four_spaces(a):
@@ -547,247 +1377,740 @@ def judge_a_content_empty(python_content):
     return True
 
 
-if __name__ == "__main__":
-    import argparse
+def get_repo_sketch_content(tree_lists):
+    """
+    Get the repository sketch from the tree lists annotated with imports.
+    """
+    return get_tree_str(tree_lists).strip()
 
-    parser = argparse.ArgumentParser(
-        description="Running extract sketch script for given repository."
-    )
-    parser.add_argument("--base_path", type=str, help="Path to repository.")
-    parser.add_argument("--repo_names", type=str, help="Repository names.")
-    parser.add_argument("--output_path", type=str, help="Path to save the sketch.")
-    parser.add_argument(
-        "--validation", action="store_true", help="Whether to generate validation data."
-    )
 
-    args = parser.parse_args()
+def get_repo_sketch_records(readme_content, repo_sketch_content, validation=False):
+    """
+    Get the repository sketch generation records of a repository.
+    """
+    repo_sketch_instruction = prpt_util.get_repo_sketch_prompt(readme_content)
+    repo_sketch_output = f"""Here is a practicable repository sketch.
 
-    repo_names = args.repo_names.split(",")
-    logging.info(f"processing {len(repo_names)} repositories")
-    for repo_name in tqdm(repo_names, desc="repo_name"):
-        repo_path = os.path.join(args.base_path, repo_name)
-        logging.info(f"processing {repo_path}")
+```
+{repo_sketch_content}
+```"""
+    if validation:
+        return [
+            {
+                "readme": readme_content,
+                "instruction": repo_sketch_instruction,
+                "input": "",
+                "output": repo_sketch_output,
+            }
+        ]
+
+    return [
+        {
+            "instruction": repo_sketch_instruction,
+            "input": "",
+            "output": repo_sketch_output,
+        }
+    ]
+
+
+def get_file_sketch_records(
+    path,
+    content,
+    readme_content,
+    repo_sketch_content,
+    repo_path,
+    validation=False,
+    parsed_cache=None,
+    prompt_template=None,
+):
+    """
+    Get the file sketch generation records (at most one) of a Python or shell file.
+    `prompt_template` is the file sketch template of the repository (see `PromptTemplate`).
+    """
+    full_path = path
+    path = path.replace(repo_path, "")[1:]
+    # get_all_function_names(python_content)
+    if prompt_template is None:
+        prompt_template = prpt_util.get_file_sketch_template(
+            readme_content, repo_sketch_content
+        )
+    file_sketch_instruction = prompt_template.render(path)
+    if path.endswith(".py"):
+        if parsed_cache is not None:
+            python_file_sketch = parsed_cache.get_file_sketch(full_path)
+        else:
+            python_file_sketch = replace_function_body(content, "")
+        if judge_a_content_empty(python_file_sketch):
+            return []
+        # debugging
+        # if "\n\n\n\n" in python_file_sketch:
+        #     ipdb.set_trace()
+        file_sketch_output = f"""Here is a practicable file sketch.
+
+```python
+{python_file_sketch}
+```"""
+    elif path.endswith(".sh"):
+        file_content = content.strip()
+        file_sketch_output = f"""Here is a practicable file content.
 
-        # 1. getting readme content
-        readme_content = ""
-        readme_path = os.path.join(repo_path, "README.md")
-        if os.path.exists(readme_path):
-            with open(readme_path, "r") as f:
-                readme_content = f.read()
+```bash
+{file_content}
+```"""
 
-        readme_content = readme_content.strip()
+    if validation:
+        return [
+            {
+                "readme": readme_content,
+                "repo_sketch": repo_sketch_content,
+                "file_path": path,
+                "instruction": file_sketch_instruction,
+                "input": "",
+                "output": file_sketch_output,
+            }
+        ]
 
-        tree_lists = [(".", "None")]
-        tree_lists = get_tree(repo_path, "", tree_lists)
+    return [
+        {
+            "instruction": file_sketch_instruction,
+            "input": "",
+            "output": file_sketch_output,
+        }
+    ]
 
-        tree_str = get_tree_str(tree_lists)
-        # print(tree_str)
-        # ipdb.set_trace()
 
-        # logging.info(f"repo name: {repo_name}")
-        # add repo-relevanted imports for each Python line
-        tree_lists = add_imports_infos(tree_lists)
+def get_function_body_records(
+    path,
+    python_content,
+    readme_content,
+    repo_sketch_content,
+    tree_lists,
+    repo_path,
+    validation=False,
+    parsed_cache=None,
+    context_packer=None,
+    prompt_template=None,
+):
+    """
+    Get the function body generation records of a Python file.
+    With a `context_packer`, the relevant file sketches are fit into its token budget.
+    `prompt_template` is the function body template of the repository.
+    """
+    if parsed_cache is None:
+        parsed_cache = ParsedFileCache()
+    readme_summary = extract_summary_from_readme(readme_content)
+    if prompt_template is None:
+        prompt_template = prpt_util.get_function_body_template(
+            readme_summary, repo_sketch_content
+        )
 
-        # 2. getting repository sketch
-        repo_sketch_content = ""
-        for item, path in tree_lists:
-            repo_sketch_content += item + "\n"
+    function_body_list = []
 
-        repo_sketch_content = repo_sketch_content.strip()
+    # every occurrence of a repeated function name (e.g. the `__init__` of each
+    # class) gets its own record, indexed as in `utils.generate_function_body_input`
+    collector = FunctionNodeCollector()
+    collector.visit(parsed_cache.get_module(path))
+    all_indexed_function_names = index_function_names(
+        [node.name for node, _ in collector.functions]
+    )
+    # the nested functions are not marked as TODO in the sketch, so the occurrences
+    # of a repeated nested name would get the same instruction for different outputs
+    nested_function_names_cnt = {}
+    for node, sketch_index in collector.functions:
+        if sketch_index is None:
+            nested_function_names_cnt[node.name] = (
+                nested_function_names_cnt.get(node.name, 0) + 1
+            )
+    all_imports = extract_imports(python_content)
+    for (index, this_function_name), (_, sketch_index) in zip(
+        all_indexed_function_names, collector.functions
+    ):
+        if sketch_index is None and nested_function_names_cnt[this_function_name] > 1:
+            continue
+        # extract function header and function body
+        # readme_content
+        # repo_sketch_content
+        # relevant_file_sketch_content
+        function_body_content = parsed_cache.get_function_body(
+            path, this_function_name, index
+        )
+        if not function_body_content:
+            continue
+        function_header_content = get_function_header(
+            path, this_function_name, parsed_cache, index
+        )
+        function_body_content_added_spaces = add_four_spaces(function_body_content)
+        function_header_body = (
+            function_header_content + "\n" + function_body_content_added_spaces
+        )
+        if (
+            function_header_body.strip() == ""
+            or function_body_content_added_spaces.strip() == ""
+            or function_body_content_added_spaces.strip() == "pass"
+        ):
+            continue
+        try:
+            function_header_body = format_code(function_header_body).strip()
+        except:
+            pass
 
-        # ==============================
-        # 1. repo sketch generation
-        # ==============================
-        json_path = os.path.join(args.output_path, repo_name, "repo_sketch.json")
-        os.makedirs(os.path.dirname(json_path), exist_ok=True)
-        repo_sketch_instruction = prpt_util.get_repo_sketch_prompt(readme_content)
-        repo_sketch_output = f"""Here is a practicable repository sketch.
+        function_body_output = f"""Here is a complete function body.
 
-```
-{repo_sketch_content}
+```python
+{function_header_body}
 ```"""
-        if args.validation:
-            repo_sketch_list = [
+
+        with profiler.stage("relevant_sketch"):
+            relevant_file_meta = get_relevant_file_meta(
+                path,
+                all_imports,
+                tree_lists,
+                this_function_name,
+                repo_path,
+                index=sketch_index,
+                parsed_cache=parsed_cache,
+            )
+            if context_packer is not None:
+                relevant_file_meta = context_packer.pack(
+                    path,
+                    relevant_file_meta[0],
+                    this_function_name,
+                    sketch_index,
+                    parsed_cache,
+                    prompt_template,
+                    function_header_content,
+                    function_body_output,
+                )
+        function_body_instruction = prompt_template.render(
+            relevant_file_meta[1], function_header_content
+        )
+
+        if validation:
+            function_body_list.append(
                 {
-                    "readme": readme_content,
-                    "instruction": repo_sketch_instruction,
+                    "readme": readme_summary,
+                    "repo_sketch": repo_sketch_content,
+                    "relevant_file_paths": [
+                        x[(len(repo_path) + 1) if len(repo_path) > 0 else 0 :]
+                        for x in relevant_file_meta[0]
+                    ],
+                    "relevant_file_sketches": relevant_file_meta[1],
+                    "current_file_path": path[
+                        (len(repo_path) + 1) if len(repo_path) > 0 else 0 :
+                    ],
+                    "instruction": function_body_instruction,
                     "input": "",
-                    "output": repo_sketch_output,
+                    "output": function_body_output,
                 }
-            ]
+            )
         else:
-            repo_sketch_list = [
+            function_body_list.append(
                 {
-                    "instruction": repo_sketch_instruction,
+                    "instruction": function_body_instruction,
                     "input": "",
-                    "output": repo_sketch_output,
+                    "output": function_body_output,
                 }
-            ]
+            )
 
-        with open(json_path, "w+") as f:
-            json.dump(repo_sketch_list, f, indent=4)
+    return function_body_list
 
-        logging.info(f"saved {len(repo_sketch_list)} repo sketch to {json_path}")
 
-        # ==============================
-        # 2. file sketch generation
-        # ==============================
-        file_sketch_path = os.path.join(args.output_path, repo_name, "file_sketch.json")
-        file_sketch_list = []
+def hash_content(content):
+    return hashlib.sha256(content.encode("utf-8", "surrogateescape")).hexdigest()
 
-        python_content = ""
-        for item, path in tree_lists:
-            if not path.endswith(".py") and not path.endswith(".sh"):
-                continue
 
-            with open(path, "r") as f:
-                content = f.read()
+def get_extractor_hash():
+    """
+    Hash of the extraction code (with the parsing, prompt and record helpers it
+    relies on), so that cached records are dropped whenever it changes.
+    """
+    import parse_utils
+    import prompt_store
+    import record_utils
+
+    sha = hashlib.sha256()
+    for module_path in [
+        __file__,
+        prpt_util.__file__,
+        parse_utils.__file__,
+        record_utils.__file__,
+        prompt_store.__file__,
+    ]:
+        with open(module_path, "rb") as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+
+def get_file_fingerprints(tree_lists, file_contents):
+    """
+    Fingerprint each source file by its content hash plus the hashes of the
+    relevant files it imports (see `extract_relevant_file_paths`).
+    """
+    content_hashes = {
+        path: hash_content(content) for path, content in file_contents.items()
+    }
+    fingerprints = {}
+    for path, content in file_contents.items():
+        relevant_file_paths = []
+        if path.endswith(".py"):
+            import_key_word_list = extract_key_names(extract_imports(content))
+            relevant_file_paths = extract_relevant_file_paths(
+                import_key_word_list, tree_lists
+            )
+        fingerprints[path] = hash_content(
+            content_hashes[path]
+            + "".join(content_hashes.get(x, "") for x in relevant_file_paths)
+        )
+
+    return fingerprints
+
+
+class SketchCache:
+    """
+    Per-repository cache of the extracted records of each source file, used by
+    the incremental mode to only regenerate the records whose inputs changed.
+    The records of each file are kept in their own file and loaded on demand.
+    """
+
+    def __init__(self, cache_path, context):
+        self.cache_path = cache_path
+        self.context = context
+        self.fingerprints = {}
+        index_path = os.path.join(cache_path, "index.json")
+        if os.path.exists(index_path):
+            with open(index_path, "r") as f:
+                cache = json.load(f)
+            if cache.get("context") == context:
+                self.fingerprints = cache.get("fingerprints", {})
+
+    def get_records_path(self, path):
+        return os.path.join(
+            self.cache_path, "files", hashlib.sha1(path.encode("utf-8")).hexdigest()
+        )
+
+    def has(self, path, fingerprint):
+        return self.fingerprints.get(path) == fingerprint
 
-            path = path.replace(repo_path, "")[1:]
-            # get_all_function_names(python_content)
-            file_sketch_instruction = prpt_util.get_file_sketch_prompt(
-                readme_content, repo_sketch_content, path
+    def get(self, path, fingerprint):
+        if not self.has(path, fingerprint):
+            return None
+        with open(self.get_records_path(path), "r") as f:
+            return json.load(f)
+
+    def put(self, path, fingerprint, file_sketch_records, function_body_records):
+        records_path = self.get_records_path(path)
+        os.makedirs(os.path.dirname(records_path), exist_ok=True)
+        with open(records_path + ".tmp", "w") as f:
+            json.dump(
+                {
+                    "file_sketch": file_sketch_records,
+                    "function_body": function_body_records,
+                },
+                f,
             )
-            if path.endswith(".py"):
-                python_file_sketch = replace_function_body(content, "")
-                if judge_a_content_empty(python_file_sketch):
-                    continue
-                # debugging
-                # if "\n\n\n\n" in python_file_sketch:
-                #     ipdb.set_trace()
-                file_sketch_output = f"""Here is a practicable file sketch.
+        os.replace(records_path + ".tmp", records_path)
+        self.fingerprints[path] = fingerprint
+
+    def save(self, paths):
+        # only keep the entries of the files still in the repository
+        self.fingerprints = {
+            path: self.fingerprints[path] for path in paths if path in self.fingerprints
+        }
+        kept_records = {
+            os.path.basename(self.get_records_path(path)) for path in self.fingerprints
+        }
+        records_dir = os.path.join(self.cache_path, "files")
+        for file_name in os.listdir(records_dir) if os.path.isdir(records_dir) else []:
+            if file_name not in kept_records:
+                os.remove(os.path.join(records_dir, file_name))
+
+        os.makedirs(self.cache_path, exist_ok=True)
+        index_path = os.path.join(self.cache_path, "index.json")
+        with open(index_path + ".tmp", "w") as f:
+            json.dump({"context": self.context, "fingerprints": self.fingerprints}, f)
+        os.replace(index_path + ".tmp", index_path)
+
+
+def extract_repo(
+    repo_name,
+    base_path,
+    output_path,
+    validation=False,
+    cache_dir=None,
+    output_extension=".json",
+    token_budget=None,
+    tokenizer_name_or_path=None,
+):
+    """
+    Extract the repository sketch, file sketch and function body data of a repository.
+    When `cache_dir` is given, only the records of the files whose fingerprint
+    changed are regenerated and unchanged repositories are skipped.
+    Records are streamed to the output files (see `record_utils.RecordWriter`).
+    With a `token_budget`, the relevant file sketches of the function body records
+    are packed to fit it (see `ContextPacker`).
+    """
+    repo_path = os.path.join(base_path, repo_name)
+    logging.info(f"processing {repo_path}")
 
-```python
-{python_file_sketch}
-```"""
-            elif path.endswith(".sh"):
-                file_content = content.strip()
-                file_sketch_output = f"""Here is a practicable file content.
+    # 1. getting readme content
+    readme_content = ""
+    readme_path = os.path.join(repo_path, "README.md")
+    if os.path.exists(readme_path):
+        with open(readme_path, "r") as f:
+            readme_content = f.read()
 
-```bash
-{file_content}
-```"""
+    readme_content = readme_content.strip()
 
-            if args.validation:
-                file_sketch_list.append(
-                    {
-                        "readme": readme_content,
-                        "repo_sketch": repo_sketch_content,
-                        "file_path": path,
-                        "instruction": file_sketch_instruction,
-                        "input": "",
-                        "output": file_sketch_output,
-                    }
-                )
-            else:
-                file_sketch_list.append(
-                    {
-                        "instruction": file_sketch_instruction,
-                        "input": "",
-                        "output": file_sketch_output,
-                    }
-                )
+    with profiler.stage("tree_build"):
+        tree_lists = build_repo_tree(repo_path)
 
-        with open(file_sketch_path, "w+") as f:
-            json.dump(file_sketch_list, f, indent=4)
+    # logging.info(f"repo name: {repo_name}")
+    # add repo-relevanted imports for each Python line
+    with profiler.stage("import_annotation"):
+        tree_lists = add_imports_infos(tree_lists, repo_path)
 
-        logging.info(f"saved {len(file_sketch_list)} file sketch to {file_sketch_path}")
+    # 2. getting repository sketch
+    with profiler.stage("repo_sketch"):
+        repo_sketch_content = get_repo_sketch_content(tree_lists)
 
-        # ==============================
-        # 3. function body generation
-        # ==============================
-        function_body_path = os.path.join(
-            args.output_path, repo_name, "function_body.json"
-        )
-        function_body_list = []
+    json_path = os.path.join(output_path, repo_name, "repo_sketch" + output_extension)
+    file_sketch_path = os.path.join(
+        output_path, repo_name, "file_sketch" + output_extension
+    )
+    function_body_path = os.path.join(
+        output_path, repo_name, "function_body" + output_extension
+    )
+    os.makedirs(os.path.dirname(json_path), exist_ok=True)
 
+    file_contents = {}
+    with profiler.stage("read_files"):
         for item, path in tree_lists:
-            if not path.endswith(".py"):
+            if not path.endswith(".py") and not path.endswith(".sh"):
                 continue
             with open(path, "r") as f:
-                python_content = f.read()
-
-            all_function_names = get_all_function_names(python_content)
-            all_filted_function_names = remove_duplicates(all_function_names)
-            all_imports = load_imports(path)
-            for this_function_name in all_filted_function_names:
-                relevant_file_sketch_content = get_relevant_file_sketch(
-                    path, all_imports, tree_lists, this_function_name, repo_path
-                )
-
-                # extract function header and function body
-                # readme_content
-                # repo_sketch_content
-                # relevant_file_sketch_content
-                function_body_content = get_function_body(path, this_function_name)
-                if not function_body_content:
-                    continue
-                function_header_content = get_function_header(path, this_function_name)
-                function_body_instruction = prpt_util.get_function_body_prompt(
-                    extract_summary_from_readme(readme_content),
+                file_contents[path] = f.read()
+
+    sketch_cache = None
+    fingerprints = {}
+    if cache_dir is not None:
+        context = hash_content(
+            "\n".join(
+                [
+                    get_extractor_hash(),
+                    str(validation),
+                    str(token_budget),
+                    str(tokenizer_name_or_path),
+                    readme_content,
                     repo_sketch_content,
-                    relevant_file_sketch_content,
-                    function_header_content,
-                )
-                function_body_content_added_spaces = add_four_spaces(
-                    function_body_content
-                )
-                function_header_body = (
-                    function_header_content + "\n" + function_body_content_added_spaces
-                )
-                if (
-                    function_header_body.strip() == ""
-                    or function_body_content_added_spaces.strip() == ""
-                    or function_body_content_added_spaces.strip() == "pass"
-                ):
-                    continue
-                try:
-                    function_header_body = black.format_str(
-                        function_header_body, mode=black.FileMode()
-                    ).strip()
-                except:
-                    pass
+                ]
+            )
+        )
+        with profiler.stage("sketch_cache"):
+            sketch_cache = SketchCache(os.path.join(cache_dir, repo_name), context)
+            fingerprints = get_file_fingerprints(tree_lists, file_contents)
+        if all(
+            sketch_cache.has(os.path.relpath(path, repo_path), fingerprint)
+            for path, fingerprint in fingerprints.items()
+        ) and all(
+            os.path.exists(x) for x in [json_path, file_sketch_path, function_body_path]
+        ):
+            logging.info(f"{repo_path} unchanged, skipping.")
+            return
+
+    # ==============================
+    # 1. repo sketch generation
+    # ==============================
+    with profiler.stage("repo_sketch"):
+        repo_sketch_list = get_repo_sketch_records(
+            readme_content, repo_sketch_content, validation
+        )
 
-                function_body_output = f"""Here is a complete function body.
+    with profiler.stage("write_records"), RecordWriter(json_path) as writer:
+        for record in repo_sketch_list:
+            writer.write(record)
+
+    logging.info(f"saved {len(repo_sketch_list)} repo sketch to {json_path}")
+
+    # ==============================
+    # 2. file sketch generation
+    # 3. function body generation
+    # ==============================
+    num_regenerated = 0
+    parsed_cache = ParsedFileCache()
+    parsed_cache.contents.update(file_contents)
+
+    context_packer = None
+    if token_budget is not None:
+        import_graph = get_import_graph(file_contents, tree_lists.module_index)
+        context_packer = ContextPacker(
+            get_token_counter(tokenizer_name_or_path),
+            token_budget,
+            import_graph,
+            repo_path,
+        )
 
-```python
-{function_header_body}
-```"""
-                if args.validation:
-                    relevant_file_meta = get_relevant_file_meta(
-                        path, all_imports, tree_lists, this_function_name
+    file_sketch_template = prpt_util.get_file_sketch_template(
+        readme_content, repo_sketch_content
+    )
+    function_body_template = prpt_util.get_function_body_template(
+        extract_summary_from_readme(readme_content), repo_sketch_content
+    )
+    # the outputs of a repository failing halfway are not replaced by partial ones
+    with RecordWriter(file_sketch_path) as file_sketch_writer, RecordWriter(
+        function_body_path
+    ) as function_body_writer:
+        for path, content in file_contents.items():
+            rel_path = os.path.relpath(path, repo_path)
+            cached = None
+            if sketch_cache is not None:
+                cached = sketch_cache.get(rel_path, fingerprints[path])
+                profiler.count("sketch_cache", cached is not None)
+
+            if cached is not None:
+                file_sketch_records = cached["file_sketch"]
+                function_body_records = cached["function_body"]
+            else:
+                num_regenerated += 1
+                with profiler.stage("file_sketch"):
+                    file_sketch_records = get_file_sketch_records(
+                        path,
+                        content,
+                        readme_content,
+                        repo_sketch_content,
+                        repo_path,
+                        validation,
+                        parsed_cache,
+                        file_sketch_template,
                     )
-                    function_body_list.append(
-                        {
-                            "readme": extract_summary_from_readme(readme_content),
-                            "repo_sketch": repo_sketch_content,
-                            "relevant_file_paths": [
-                                x[(len(repo_path) + 1) if len(repo_path) > 0 else 0 :]
-                                for x in relevant_file_meta[0]
-                            ],
-                            "relevant_file_sketches": relevant_file_meta[1],
-                            "current_file_path": path[
-                                (len(repo_path) + 1) if len(repo_path) > 0 else 0 :
-                            ],
-                            "instruction": function_body_instruction,
-                            "input": "",
-                            "output": function_body_output,
-                        }
-                    )
-                else:
-                    function_body_list.append(
-                        {
-                            "instruction": function_body_instruction,
-                            "input": "",
-                            "output": function_body_output,
-                        }
+                function_body_records = []
+                if path.endswith(".py"):
+                    with profiler.stage("function_body"):
+                        function_body_records = get_function_body_records(
+                            path,
+                            content,
+                            readme_content,
+                            repo_sketch_content,
+                            tree_lists,
+                            repo_path,
+                            validation,
+                            parsed_cache,
+                            context_packer,
+                            function_body_template,
+                        )
+                if sketch_cache is not None:
+                    sketch_cache.put(
+                        rel_path,
+                        fingerprints[path],
+                        file_sketch_records,
+                        function_body_records,
                     )
 
-        with open(function_body_path, "w+") as f:
-            json.dump(function_body_list, f, indent=4)
+            with profiler.stage("write_records"):
+                for record in file_sketch_records:
+                    file_sketch_writer.write(record)
+                for record in function_body_records:
+                    function_body_writer.write(record)
 
+    logging.info(
+        f"saved {file_sketch_writer.num_records} file sketch to {file_sketch_path}"
+    )
+    logging.info(
+        f"saved {function_body_writer.num_records} function body to {function_body_path}"
+    )
+
+    if sketch_cache is not None:
+        with profiler.stage("sketch_cache"):
+            sketch_cache.save([os.path.relpath(x, repo_path) for x in file_contents])
         logging.info(
-            f"saved {len(function_body_list)} function body to {function_body_path}"
+            f"regenerated {num_regenerated}/{len(file_contents)} files of {repo_path}"
         )
 
-    logging.info(f"done!")
\ No newline at end of file
+
+def get_repo_size(repo_path):
+    """
+    Total size of the Python and shell files of a repository, used to extract the largest first.
+    """
+    size = 0
+    for root, dirs, files in os.walk(repo_path):
+        for file in files:
+            if file.endswith(".py") or file.endswith(".sh"):
+                size += os.path.getsize(os.path.join(root, file))
+    return size
+
+
+def init_worker_logging(log_dir):
+    """
+    Send the logs of a worker process to its own file.
+    """
+    handler = logging.FileHandler(os.path.join(log_dir, f"worker-{os.getpid()}.log"))
+    handler.setFormatter(
+        logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    )
+    root_logger = logging.getLogger()
+    for old_handler in list(root_logger.handlers):
+        root_logger.removeHandler(old_handler)
+    root_logger.addHandler(handler)
+
+
+def extract_repo_timed(repo_name, profile_dir, use_cprofile, *args):
+    """
+    Extract a repository, profiling it into `profile_dir` if given (see `Profiler`).
+    """
+    start_time = time.time()
+    if profile_dir is None:
+        extract_repo(repo_name, *args)
+    else:
+        with profiler.profile(os.path.join(profile_dir, repo_name), use_cprofile):
+            extract_repo(repo_name, *args)
+    return repo_name, time.time() - start_time
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Running extract sketch script for given repository."
+    )
+    parser.add_argument("--base_path", type=str, help="Path to repository.")
+    parser.add_argument("--repo_names", type=str, help="Repository names.")
+    parser.add_argument("--output_path", type=str, help="Path to save the sketch.")
+    parser.add_argument(
+        "--validation", action="store_true", help="Whether to generate validation data."
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only regenerate the records of the files whose content or imported files changed.",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="Where to keep the incremental cache (default: <output_path>/.sketch_cache).",
+    )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        default="json",
+        choices=["json", "jsonl", "store"],
+        help="Write indented JSON lists, one record per line, or prompt stores "
+        "(see prompt_store.py).",
+    )
+    parser.add_argument(
+        "--compression",
+        type=str,
+        default="none",
+        choices=["none", "gzip", "zstd"],
+        help="Compression of the jsonl/store outputs.",
+    )
+    parser.add_argument(
+        "--token_budget",
+        type=int,
+        default=None,
+        help="Max tokens of the instruction and output of a function body record; "
+        "the relevant file sketches are ranked and elided or dropped to fit it.",
+    )
+    parser.add_argument(
+        "--tokenizer",
+        type=str,
+        default=None,
+        help="Tokenizer (name or path) measuring the token budget.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes extracting repositories in parallel.",
+    )
+    parser.add_argument(
+        "--profile_dir",
+        type=str,
+        default=None,
+        help="Save a profile of each repository there: stage timings, parse/format "
+        "calls and cache hits (<repo>.json).",
+    )
+    parser.add_argument(
+        "--cprofile",
+        action="store_true",
+        help="Also save a cProfile of each repository (<repo>.pstats) in --profile_dir.",
+    )
+    parser.add_argument(
+        "--log_dir",
+        type=str,
+        default=None,
+        help="Where to keep the log file of each worker (default: <output_path>/.logs).",
+    )
+
+    args = parser.parse_args()
+
+    cache_dir = None
+    if args.incremental:
+        cache_dir = args.cache_dir or os.path.join(args.output_path, ".sketch_cache")
+
+    output_extension = get_record_extension(args.output_format, args.compression)
+    if args.token_budget is not None:
+        assert args.tokenizer is not None, "--token_budget needs a --tokenizer."
+    if args.cprofile:
+        assert args.profile_dir is not None, "--cprofile needs a --profile_dir."
+
+    extract_args = (
+        args.base_path,
+        args.output_path,
+        args.validation,
+        cache_dir,
+        output_extension,
+        args.token_budget,
+        args.tokenizer,
+    )
+
+    repo_names = args.repo_names.split(",")
+    logging.info(f"processing {len(repo_names)} repositories")
+    if args.workers <= 1:
+        for repo_name in tqdm(repo_names, desc="repo_name"):
+            extract_repo_timed(
+                repo_name, args.profile_dir, args.cprofile, *extract_args
+            )
+    else:
+        log_dir = args.log_dir or os.path.join(args.output_path, ".logs")
+        os.makedirs(log_dir, exist_ok=True)
+        logging.info(f"using {args.workers} workers, logging to {log_dir}")
+
+        # the workers take the repositories from a shared queue, largest first,
+        # so that a large repository does not end up alone at the tail
+        repo_names = sorted(
+            repo_names,
+            key=lambda x: get_repo_size(os.path.join(args.base_path, x)),
+            reverse=True,
+        )
+        failed_repo_names = []
+        with ProcessPoolExecutor(
+            max_workers=args.workers,
+            initializer=init_worker_logging,
+            initargs=(log_dir,),
+        ) as executor:
+            futures = {
+                executor.submit(
+                    extract_repo_timed,
+                    repo_name,
+                    args.profile_dir,
+                    args.cprofile,
+                    *extract_args,
+                ): repo_name
+                for repo_name in repo_names
+            }
+            progress = tqdm(total=len(futures), desc="repo_name")
+            for future in as_completed(futures):
+                try:
+                    repo_name, seconds = future.result()
+                    logging.info(f"extracted {repo_name} in {seconds:.2f}s")
+                except Exception as e:
+                    logging.error(f"failed to extract {futures[future]}: {e!r}")
+                    failed_repo_names.append(futures[future])
+                progress.update(1)
+            progress.close()
+
+        if failed_repo_names:
+            logging.error(f"failed repositories: {','.join(failed_repo_names)}")
+            sys.exit(1)
+
+    logging.info(f"done!")
@@ -0,0 +1,55 @@
+import ast
+
+
+def is_blank_line(line):
+    """
+    Whether the line is empty or only a comment, which never changes whether a
+    prefix of the source code parses.
+    """
+    line = line.strip()
+    return line == "" or line.startswith("#")
+
+
+def get_parseable_prefix(source_code):
+    """
+    Get the largest prefix of whole lines of the source code that `ast.parse` accepts
+    ("" if none), e.g. to recover a truncated model output.
+
+    Same result as dropping the trailing lines one by one until it parses, but with
+    a few parses instead of one per dropped line: a syntax error reported at line `n`
+    before the last line (an invalid token, or the start of a bracket or string that
+    is never closed) fails every prefix reaching line `n`, so the search jumps right
+    before it.
+    """
+    lines = source_code.split("\n")
+    end = len(lines)
+    while end > 0:
+        # last line that is not blank, which decides whether the prefix parses
+        last = end
+        while last > 0 and is_blank_line(lines[last - 1]):
+            last -= 1
+        if last == 0:
+            # only comments left
+            prefix = "\n".join(lines[:end])
+            return prefix if prefix.strip() != "" else ""
+
+        prefix = "\n".join(lines[:end])
+        try:
+            ast.parse(prefix)
+            return prefix
+        except SyntaxError as e:
+            if e.lineno is not None and 0 < e.lineno < last:
+                end = e.lineno - 1
+            else:
+                end = last - 1
+        except (ValueError, RecursionError, MemoryError):
+            end = last - 1
+
+    return ""
+
+
+def parse_prefix(source_code):
+    """
+    Parse the largest parseable prefix of the source code, see `get_parseable_prefix`.
+    """
+    return ast.parse(get_parseable_prefix(source_code))
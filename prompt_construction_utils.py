@@ -90,4 +90,82 @@ Here is the file sketch of `{path}`.
 ```
 
 """
-    return instruction
\ No newline at end of file
+    return instruction
+
+def get_template_pieces(prompt_function, num_args):
+    """
+    Get the literal pieces around the arguments of a prompt function.
+    """
+    sentinels = [f"\x00{i}\x00" for i in range(num_args)]
+    rendered = prompt_function(*sentinels)
+    pieces = []
+    for sentinel in sentinels:
+        piece, rendered = rendered.split(sentinel)
+        pieces.append(piece)
+    pieces.append(rendered)
+    return pieces
+
+class PromptTemplate:
+    """
+    A prompt function compiled with its leading arguments fixed, e.g. the README and
+    the repository sketch shared by all the prompts of a repository.
+
+    The prefix is rendered once, and tokenized once per tokenizer, so each prompt
+    only renders (and tokenizes) its own suffix:
+
+        template = PromptTemplate(get_function_body_prompt, 4, [readme_summary, repo_sketch_content])
+        template.render(relevant_file_sketch_content, function_header_content)
+    """
+
+    # the prefixes end with a newline, so the suffixes are tokenized after one as well
+    ANCHOR = "\n"
+
+    def __init__(self, prompt_function, num_args, prefix_args):
+        pieces = get_template_pieces(prompt_function, num_args)
+        self.prefix = pieces[0] + "".join(arg + piece for arg, piece in zip(prefix_args, pieces[1:]))
+        self.suffix_pieces = pieces[len(prefix_args) + 1:]
+        self.prefix_ids = {}
+
+    def render_suffix(self, *args):
+        return "".join(arg + piece for arg, piece in zip(args, self.suffix_pieces))
+
+    def render(self, *args):
+        return self.prefix + self.render_suffix(*args)
+
+    def encode_suffix(self, tokenizer, text):
+        anchor_ids = tokenizer.encode(self.ANCHOR, add_special_tokens=False)
+        input_ids = tokenizer.encode(self.ANCHOR + text, add_special_tokens=False)
+        if input_ids[:len(anchor_ids)] != anchor_ids:
+            return None
+        return input_ids[len(anchor_ids):]
+
+    def encode(self, tokenizer, *args, wrapper="{}", add_special_tokens=True):
+        """
+        Token ids of `wrapper.format(self.render(*args))`, where `wrapper` is e.g. a chat template.
+
+        The ids of the prefix are reused when encoding the prefix and the suffix separately
+        gives the ids of the whole prompt, which is checked on the first prompt of each tokenizer.
+        """
+        head, tail = wrapper.split("{}")
+        key = (tokenizer, wrapper, add_special_tokens)
+        text = head + self.render(*args) + tail
+        if key not in self.prefix_ids:
+            prefix_ids = tokenizer.encode(head + self.prefix, add_special_tokens=add_special_tokens)
+            suffix_ids = self.encode_suffix(tokenizer, self.render_suffix(*args) + tail)
+            input_ids = tokenizer.encode(text, add_special_tokens=add_special_tokens)
+            # e.g. the tokenizer appends an EOS token or merges tokens across the newline
+            self.prefix_ids[key] = prefix_ids if suffix_ids is not None and prefix_ids + suffix_ids == input_ids else None
+            return input_ids
+
+        if self.prefix_ids[key] is None:
+            return tokenizer.encode(text, add_special_tokens=add_special_tokens)
+        suffix_ids = self.encode_suffix(tokenizer, self.render_suffix(*args) + tail)
+        if suffix_ids is None:
+            return tokenizer.encode(text, add_special_tokens=add_special_tokens)
+        return self.prefix_ids[key] + suffix_ids
+
+def get_file_sketch_template(readme_content, repo_sketch_content):
+    return PromptTemplate(get_file_sketch_prompt, 3, [readme_content, repo_sketch_content])
+
+def get_function_body_template(readme_summary, repo_sketch_content):
+    return PromptTemplate(get_function_body_prompt, 4, [readme_summary, repo_sketch_content])
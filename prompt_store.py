@@ -0,0 +1,332 @@
+"""
+A normalized storage format for the extracted records.
+
+Every function body record embeds the README summary, the repository sketch and
+the sketches of its relevant files, so the same texts are repeated in most of
+the records of a repository. A prompt store keeps each of these texts once and
+describes each record field as a (small) spec referencing them by ID:
+
+- an int is the ID of a text in `texts`;
+- a str is a literal;
+- `{"value": x}` is a literal JSON value;
+- `{"template": name, "args": [spec, ...]}` renders one of the prompt templates
+  of `prompt_construction_utils` (stored in the file as the literal pieces
+  around their arguments, so that reading a store needs no other module);
+- `{"join": [spec, ...], "strip": bool}` concatenates specs;
+- `{"todo": spec, "line": n}` is a file sketch whose n-th line (a `pass`) is
+  replaced with `\"\"\"TODO\"\"\"`.
+
+The records are only rebuilt when they are accessed (see `PromptStore`).
+"""
+
+import argparse
+import json
+import logging
+import os
+
+import prompt_construction_utils as prpt_util
+from record_utils import (
+    RecordWriter,
+    is_prompt_store,
+    is_record_file,
+    load_records,
+    open_text,
+)
+
+STORE_VERSION = 1
+
+# texts shorter than this are kept inline in the specs
+MIN_TEXT_LENGTH = 64
+
+TODO_LINE = '"""TODO"""'
+
+
+def get_templates():
+    return {
+        "repo_sketch_prompt": prpt_util.get_template_pieces(
+            prpt_util.get_repo_sketch_prompt, 1
+        ),
+        "file_sketch_prompt": prpt_util.get_template_pieces(
+            prpt_util.get_file_sketch_prompt, 3
+        ),
+        "function_body_prompt": prpt_util.get_template_pieces(
+            prpt_util.get_function_body_prompt, 4
+        ),
+        "relevant_file_sketch": prpt_util.get_template_pieces(
+            prpt_util.get_relervant_file_sketch_content, 3
+        ),
+        "current_file_sketch": prpt_util.get_template_pieces(
+            prpt_util.get_current_file_sketch_content, 3
+        ),
+    }
+
+
+def render_spec(spec, texts, templates):
+    """
+    Rebuild the value described by a spec.
+    """
+    if isinstance(spec, int):
+        return texts[spec]
+    if isinstance(spec, str):
+        return spec
+    if "value" in spec:
+        return spec["value"]
+    if "template" in spec:
+        pieces = templates[spec["template"]]
+        args = [render_spec(arg, texts, templates) for arg in spec["args"]]
+        return pieces[0] + "".join(arg + piece for arg, piece in zip(args, pieces[1:]))
+    if "join" in spec:
+        content = "".join(render_spec(x, texts, templates) for x in spec["join"])
+        return content.strip() if spec["strip"] else content
+    if "todo" in spec:
+        lines = render_spec(spec["todo"], texts, templates).split("\n")
+        line = lines[spec["line"]]
+        lines[spec["line"]] = line[: len(line) - len(line.lstrip())] + TODO_LINE
+        return "\n".join(lines)
+    raise ValueError(f"Unknown prompt store spec: {spec}")
+
+
+def split_template(pieces, content):
+    """
+    Get the arguments of a template rendered as `content`, or None if it does not match.
+    """
+    if not content.startswith(pieces[0]):
+        return None
+
+    args = []
+    pos = len(pieces[0])
+    for piece in pieces[1:-1]:
+        end = content.find(piece, pos)
+        if end == -1:
+            return None
+        args.append(content[pos:end])
+        pos = end + len(piece)
+
+    if not content.endswith(pieces[-1]) or len(content) - len(pieces[-1]) < pos:
+        return None
+    args.append(content[pos : len(content) - len(pieces[-1])])
+    return args
+
+
+class PromptStoreWriter:
+    """
+    Normalize records into a prompt store at `path`, complete once closed. The record
+    specs are streamed to the file as they are written, only the shared texts staying
+    in memory. Use `record_utils.RecordWriter`, which moves the store into place.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.templates = get_templates()
+        self.texts = []
+        self.text_ids = {}
+        self.num_records = 0
+        self.file = open_text(path, "w")
+        # the texts go last, once all the records are written
+        self.file.write(
+            f'{{"version": {STORE_VERSION}, '
+            f'"templates": {json.dumps(self.templates)}, "records": ['
+        )
+
+    def add_text(self, text):
+        if len(text) < MIN_TEXT_LENGTH:
+            return text
+        if text not in self.text_ids:
+            self.text_ids[text] = len(self.texts)
+            self.texts.append(text)
+        return self.text_ids[text]
+
+    def get_sketch_spec(self, sketch):
+        """
+        Spec of a file sketch, sharing the text of the plain sketch for a TODO variant.
+        """
+        lines = sketch.split("\n")
+        todo_lines = [i for i, line in enumerate(lines) if line.strip() == TODO_LINE]
+        if len(todo_lines) != 1:
+            return self.add_text(sketch)
+
+        line = lines[todo_lines[0]]
+        lines[todo_lines[0]] = line[: len(line) - len(line.lstrip())] + "pass"
+        return {"todo": self.add_text("\n".join(lines)), "line": todo_lines[0]}
+
+    def get_file_sketches_spec(self, content):
+        """
+        Spec of the relevant/current file sketches of a function body prompt.
+        """
+        # `get_relevant_file_sketch` strips the trailing blank lines of the last sketch
+        content += "\n\n"
+        chunk_names = ["relevant_file_sketch", "current_file_sketch"]
+        chunk_starts = [self.templates[name][0] for name in chunk_names]
+
+        chunks = []
+        pos = 0
+        while pos < len(content):
+            name = next(
+                (
+                    x
+                    for x in chunk_names
+                    if content.startswith(self.templates[x][0], pos)
+                ),
+                None,
+            )
+            if name is None:
+                return None
+            pieces = self.templates[name]
+            end = content.find(pieces[-1], pos)
+            # the sketch may contain the closing piece, so look for the next chunk
+            while end != -1:
+                next_pos = end + len(pieces[-1])
+                if next_pos == len(content) or any(
+                    content.startswith(x, next_pos) for x in chunk_starts
+                ):
+                    break
+                end = content.find(pieces[-1], end + 1)
+            if end == -1:
+                return None
+            args = split_template(pieces, content[pos:next_pos])
+            if args is None:
+                return None
+            chunks.append(
+                {
+                    "template": name,
+                    "args": [args[0], args[1], self.get_sketch_spec(args[2])],
+                }
+            )
+            pos = next_pos
+
+        return {"join": chunks, "strip": True}
+
+    def get_instruction_spec(self, instruction):
+        templates = self.templates
+        args = split_template(templates["function_body_prompt"], instruction)
+        if args is not None:
+            file_sketches_spec = self.get_file_sketches_spec(args[2])
+            if file_sketches_spec is not None:
+                return {
+                    "template": "function_body_prompt",
+                    "args": [
+                        self.add_text(args[0]),
+                        self.add_text(args[1]),
+                        file_sketches_spec,
+                        self.add_text(args[3]),
+                    ],
+                }
+
+        for name in ["file_sketch_prompt", "repo_sketch_prompt"]:
+            args = split_template(templates[name], instruction)
+            if args is not None:
+                return {"template": name, "args": [self.add_text(x) for x in args]}
+
+        return self.add_text(instruction)
+
+    def get_record_spec(self, record, verified=True):
+        instruction_spec = None
+        if verified and isinstance(record.get("instruction"), str):
+            instruction_spec = self.get_instruction_spec(record["instruction"])
+
+        spec = {}
+        for key, value in record.items():
+            if key == "instruction" and instruction_spec is not None:
+                spec[key] = instruction_spec
+            elif (
+                key == "relevant_file_sketches"
+                and isinstance(instruction_spec, dict)
+                and instruction_spec["template"] == "function_body_prompt"
+            ):
+                # the validation records repeat the file sketches of the instruction
+                spec[key] = instruction_spec["args"][2]
+            elif isinstance(value, str):
+                spec[key] = self.add_text(value)
+            else:
+                spec[key] = {"value": value}
+
+        return spec
+
+    def write(self, record):
+        spec = self.get_record_spec(record)
+        if self.render(spec) != record:
+            logging.warning("cannot normalize a record, storing its instruction as is")
+            spec = self.get_record_spec(record, verified=False)
+        self.file.write((", " if self.num_records > 0 else "") + json.dumps(spec))
+        self.num_records += 1
+
+    def render(self, spec):
+        return {
+            key: render_spec(value, self.texts, self.templates)
+            for key, value in spec.items()
+        }
+
+    def close(self):
+        self.file.write(f'], "texts": {json.dumps(self.texts)}}}')
+        self.file.close()
+
+
+class PromptStore:
+    """
+    Read-only view of a prompt store, rebuilding each record when it is accessed.
+    """
+
+    def __init__(self, path):
+        with open_text(path, "r") as f:
+            store = json.load(f)
+        assert (
+            store.get("version") == STORE_VERSION
+        ), f"unsupported prompt store version in {path}"
+        self.templates = store["templates"]
+        self.texts = store["texts"]
+        self.records = store["records"]
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, index):
+        return {
+            key: render_spec(value, self.texts, self.templates)
+            for key, value in self.records[index].items()
+        }
+
+    def __iter__(self):
+        for index in range(len(self.records)):
+            yield self[index]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    )
+    parser = argparse.ArgumentParser(
+        description="Convert extracted records (.json/.jsonl[.gz|.zst]) to prompt stores."
+    )
+    parser.add_argument("--input_dir", type=str, required=True)
+    parser.add_argument(
+        "--compression",
+        type=str,
+        default="none",
+        choices=["none", "gzip", "zstd"],
+    )
+    parser.add_argument(
+        "--remove_input",
+        action="store_true",
+        help="Remove the converted record files.",
+    )
+    args = parser.parse_args()
+
+    store_extension = {"none": "", "gzip": ".gz", "zstd": ".zst"}[args.compression]
+    for root, dirs, files in os.walk(args.input_dir):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for file in sorted(files):
+            if not is_record_file(file) or is_prompt_store(file):
+                continue
+            input_path = os.path.join(root, file)
+            name = file.split(".")[0]
+            store_path = os.path.join(root, name + ".store.json" + store_extension)
+            with RecordWriter(store_path) as writer:
+                for record in load_records(input_path):
+                    writer.write(record)
+            logging.info(
+                f"{input_path}: {os.path.getsize(input_path)} -> "
+                f"{os.path.getsize(store_path)} bytes"
+            )
+            if args.remove_input:
+                os.remove(input_path)
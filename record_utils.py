@@ -0,0 +1,168 @@
+import gzip
+import json
+import os
+
+RECORD_EXTENSIONS = [
+    ".json",
+    ".jsonl",
+    ".jsonl.gz",
+    ".jsonl.zst",
+    # prompt stores, see `prompt_store.py`
+    ".store.json",
+    ".store.json.gz",
+    ".store.json.zst",
+]
+
+
+def open_text(path, mode="r"):
+    """
+    Open a (possibly gzip or zstd compressed) text file.
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    if path.endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("Please install zstandard via `pip install zstandard`")
+        return zstandard.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def get_record_extension(output_format="json", compression="none"):
+    """
+    Get the file extension of the records for the given output format and compression.
+    """
+    if output_format == "json":
+        assert (
+            compression == "none"
+        ), "Compression is only supported for jsonl and store."
+        return ".json"
+    extension = {"none": "", "gzip": ".gz", "zstd": ".zst"}[compression]
+    if output_format == "store":
+        return ".store.json" + extension
+    return ".jsonl" + extension
+
+
+def get_record_name(path):
+    """
+    Name of the records of a file whatever its format, e.g. "function_body" for
+    "function_body.jsonl.zst".
+    """
+    file_name = os.path.basename(path)
+    for extension in sorted(RECORD_EXTENSIONS, key=len, reverse=True):
+        if file_name.endswith(extension):
+            return file_name[: -len(extension)]
+    return file_name
+
+
+def find_record_file(directory, name):
+    """
+    Find the records `name` (e.g. "function_body") in the given directory, whatever its format.
+    """
+    for extension in RECORD_EXTENSIONS:
+        path = os.path.join(directory, name + extension)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def is_prompt_store(path):
+    return ".store.json" in os.path.basename(path)
+
+
+def is_record_file(path):
+    return any(path.endswith(extension) for extension in RECORD_EXTENSIONS)
+
+
+class RecordWriter:
+    """
+    Write records one at a time, either as an indented JSON list (`.json`, same
+    output as `json.dump(records, f, indent=4)`), as JSON lines (`.jsonl`,
+    optionally `.gz`/`.zst` compressed) or as a prompt store (`.store.json`, see
+    `prompt_store.PromptStoreWriter`), so the records never pile up in memory.
+
+    The records go to a temporary file, moved into place when the writer is closed:
+    a writer left by an exception (in a `with` block) or a crash never replaces the
+    file at `path` with a partial one.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # keep the extension of the temporary file for `open_text`
+        self.tmp_path = os.path.join(
+            os.path.dirname(path), ".tmp-" + os.path.basename(path)
+        )
+        self.store_writer = None
+        self.num_records = 0
+        if is_prompt_store(path):
+            from prompt_store import PromptStoreWriter
+
+            self.store_writer = PromptStoreWriter(self.tmp_path)
+            return
+        self.is_json = path.endswith(".json")
+        self.file = open_text(self.tmp_path, "w")
+
+    def write(self, record):
+        if self.store_writer is not None:
+            self.store_writer.write(record)
+            self.num_records += 1
+            return
+        if self.is_json:
+            lines = json.dumps(record, indent=4).split("\n")
+            self.file.write(("[\n" if self.num_records == 0 else ",\n"))
+            self.file.write("\n".join("    " + line for line in lines))
+        else:
+            self.file.write(json.dumps(record) + "\n")
+        self.num_records += 1
+
+    def close(self):
+        if self.store_writer is not None:
+            self.store_writer.close()
+        else:
+            if self.is_json:
+                self.file.write("\n]" if self.num_records > 0 else "[]")
+            self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        """
+        Drop the records written so far, leaving any previous file at `path` in place.
+        """
+        if self.store_writer is not None:
+            self.store_writer.file.close()
+        else:
+            self.file.close()
+        os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+            return
+        self.close()
+
+
+def iter_records(path):
+    """
+    Iterate over the records of a `.json`, `.jsonl`, `.jsonl.gz` or `.jsonl.zst` file,
+    or of a prompt store.
+    """
+    if is_prompt_store(path):
+        from prompt_store import PromptStore
+
+        yield from PromptStore(path)
+        return
+    with open_text(path, "r") as f:
+        if path.endswith(".json"):
+            yield from json.load(f)
+            return
+        for line in f:
+            if line.strip() != "":
+                yield json.loads(line)
+
+
+def load_records(path):
+    return list(iter_records(path))
@@ -4,6 +4,8 @@
 
 BASE_PATH="./repos/"
 NEW_BASE_PATH="./cleaned_repos/"
+WORKERS=8
+FORMAT_CACHE_DIR="./.format_cache/"
 
 REPO_NAMEs="snake-ai-master,big-list-of-naughty-strings-master,PySnooper-master,Photon-master,icecream-master,TrumpScript-master,latexify_py-main,maybe-master,autoscraper-master,vibora-master,peda-master,httpstat-master,whereami-master,acme-tiny-master,Arjun-master,better-exceptions-master,arxiv-latex-cleaner-main,open-interpreter-main,Depix-main"
 REPO_NAMEs="$REPO_NAMEs,pytorch-captcha-recognition-master,simple-neural-network-master,gorilla-cli-main,cachebrowser-master,FlapPyBird-master,waf-bypass-master,Silver-master,CTags-development,RSS-to-Telegram-Bot-dev,Instabruteforce-master,ANGRYsearch-master,ddt4all-master"
@@ -15,6 +17,10 @@ REPO_NAMEs="CloakQuest3r-main,csvs-to-sqlite-main,django-solo-master,elasticsear
 Run_Command_Args=" --base_path $BASE_PATH"
 Run_Command_Args="$Run_Command_Args --repo_names $REPO_NAMEs"
 Run_Command_Args="$Run_Command_Args --new_base_path $NEW_BASE_PATH"
+Run_Command_Args="$Run_Command_Args --workers $WORKERS"
+# add `--resume` to skip the repositories (and files) a previous run already cleaned
+# with the same cleaning code; by default every repository is cleaned again
+Run_Command_Args="$Run_Command_Args --format_cache_dir $FORMAT_CACHE_DIR"
 
 echo "Run Command Args: $Run_Command_Args"
 
@@ -4,6 +4,7 @@
 
 BASE_PATH="./cleaned_repos/"
 OUTPUT_PATH="./outputs/"
+WORKERS=8
 # Delete all files in the output path
 rm -rf $OUTPUT_PATH/*
 
@@ -17,6 +18,8 @@ REPO_NAMEs="$REPO_NAMEs,CloakQuest3r-main,csvs-to-sqlite-main,django-solo-master
 Run_Command_Args=" --base_path $BASE_PATH"
 Run_Command_Args="$Run_Command_Args --repo_names $REPO_NAMEs"
 Run_Command_Args="$Run_Command_Args --output_path $OUTPUT_PATH"
+Run_Command_Args="$Run_Command_Args --incremental"
+Run_Command_Args="$Run_Command_Args --workers $WORKERS"
 
 echo "Run Command Args: $Run_Command_Args"
 
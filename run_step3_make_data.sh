@@ -2,4 +2,16 @@
 # Copyright (c) Huawei Cloud.
 # Licensed under the MIT license.
 
-python craft_train_data.py
\ No newline at end of file
+INPUT_DIR="./outputs/"
+OUTPUT_DIR="./training_data/codes_train_data"
+TOKENIZER="codellama/CodeLlama-7b-Instruct-hf"
+WORKERS=8
+
+Run_Command_Args=" --input_dir $INPUT_DIR"
+Run_Command_Args="$Run_Command_Args --output_dir $OUTPUT_DIR"
+Run_Command_Args="$Run_Command_Args --tokenizer $TOKENIZER"
+Run_Command_Args="$Run_Command_Args --workers $WORKERS"
+
+echo "Run Command Args: $Run_Command_Args"
+
+python craft_train_data.py $Run_Command_Args
\ No newline at end of file
@@ -0,0 +1,71 @@
+import pathlib
+import sys
+
+sys.path.append(str(pathlib.Path(__file__).parent.parent.absolute()))
+import extract_sketch
+
+SOURCE = """import sys
+
+
+def write_stdout(prefix):
+    def write(s):
+        sys.stdout.write(prefix + s)
+
+    return write
+
+
+def write_stderr(prefix):
+    def write(s):
+        sys.stderr.write(prefix + s)
+
+    return write
+
+
+def outer():
+    def helper():
+        return 1
+
+    return helper()
+
+
+class A:
+    def __init__(self):
+        self.x = 1
+
+
+class B:
+    def __init__(self):
+        self.y = 2
+"""
+
+
+def get_records(tmp_path):
+    path = tmp_path / "tracer.py"
+    path.write_text(SOURCE)
+    repo_path = str(tmp_path)
+    return extract_sketch.get_function_body_records(
+        str(path),
+        SOURCE,
+        "# Demo",
+        ".\n└── tracer.py",
+        extract_sketch.build_repo_tree(repo_path),
+        repo_path,
+    )
+
+
+def get_function_name(record):
+    return record["output"].split("def ")[1].split("(")[0]
+
+
+def test_repeated_nested_functions_are_skipped(tmp_path):
+    records = get_records(tmp_path)
+    names = [get_function_name(record) for record in records]
+    assert "write" not in names
+    assert names.count("helper") == 1
+    assert names.count("__init__") == 2
+
+
+def test_instructions_are_unique(tmp_path):
+    records = get_records(tmp_path)
+    instructions = [record["instruction"] for record in records]
+    assert len(set(instructions)) == len(instructions)
@@ -0,0 +1,57 @@
+import os
+import pathlib
+import sys
+
+import pytest
+
+sys.path.append(str(pathlib.Path(__file__).parent.parent.absolute()))
+from record_utils import RecordWriter, iter_records
+
+RECORDS = [
+    {"instruction": "Implement the function.\n" * 8, "input": "", "output": "a"},
+    {"instruction": "Implement the function.\n" * 8, "input": "", "output": "b"},
+]
+
+EXTENSIONS = [".json", ".jsonl", ".jsonl.gz", ".store.json", ".store.json.gz"]
+
+
+@pytest.mark.parametrize("extension", EXTENSIONS)
+def test_records_round_trip(tmp_path, extension):
+    path = str(tmp_path / ("function_body" + extension))
+    with RecordWriter(path) as writer:
+        for record in RECORDS:
+            writer.write(record)
+    assert list(iter_records(path)) == RECORDS
+    assert os.listdir(tmp_path) == [os.path.basename(path)]
+
+
+@pytest.mark.parametrize("extension", EXTENSIONS)
+def test_failed_writer_publishes_nothing(tmp_path, extension):
+    path = str(tmp_path / ("function_body" + extension))
+    with pytest.raises(RuntimeError):
+        with RecordWriter(path) as writer:
+            writer.write(RECORDS[0])
+            raise RuntimeError("extraction failed")
+    assert not os.path.exists(path)
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.parametrize("extension", EXTENSIONS)
+def test_failed_writer_keeps_previous_file(tmp_path, extension):
+    path = str(tmp_path / ("function_body" + extension))
+    with RecordWriter(path) as writer:
+        writer.write(RECORDS[0])
+    with pytest.raises(RuntimeError):
+        with RecordWriter(path) as writer:
+            writer.write(RECORDS[1])
+            raise RuntimeError("extraction failed")
+    assert list(iter_records(path)) == RECORDS[:1]
+
+
+def test_unclosed_writer_publishes_nothing(tmp_path):
+    path = str(tmp_path / "function_body.json")
+    writer = RecordWriter(path)
+    writer.write(RECORDS[0])
+    assert not os.path.exists(path)
+    writer.close()
+    assert list(iter_records(path)) == RECORDS[:1]
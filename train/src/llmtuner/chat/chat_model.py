@@ -7,6 +7,7 @@ from transformers import GenerationConfig, TextIteratorStreamer
 
 from llmtuner.data.template import get_template_and_fix_tokenizer
 from llmtuner.extras.misc import get_logits_processor
+from llmtuner.extras.prefix_cache import PrefixCache, get_expand_size
 from llmtuner.model import dispatch_model, get_infer_args, load_model_and_tokenizer
 
 
@@ -30,6 +31,7 @@ class ChatModel:
         self.tokenizer.padding_side = "left" if self.can_generate else "right"
         self.model = dispatch_model(self.model)
         self.template = get_template_and_fix_tokenizer(data_args.template, self.tokenizer)
+        self.prefix_cache = PrefixCache(self.model) if self.can_generate else None
 
     def _process_args(
         self,
@@ -52,6 +54,7 @@ class ChatModel:
         repetition_penalty = input_kwargs.pop("repetition_penalty", None)
         max_length = input_kwargs.pop("max_length", None)
         max_new_tokens = input_kwargs.pop("max_new_tokens", None)
+        prefix = input_kwargs.pop("prefix", None)
 
         generating_args = self.generating_args.to_dict()
         generating_args.update(dict(
@@ -82,6 +85,17 @@ class ChatModel:
             logits_processor=get_logits_processor()
         )
 
+        if prefix is not None and self.prefix_cache is not None: # reuse the states of a query prefix
+            prefix_ids, _ = self.template.encode_oneturn(
+                tokenizer=self.tokenizer, query=prefix, resp="", history=history, system=system
+            )
+            cached_inputs = self.prefix_cache.prepare_inputs(
+                [prompt], prefix_ids, self.tokenizer.pad_token_id, get_expand_size(gen_kwargs["generation_config"])
+            )
+            if cached_inputs is not None:
+                gen_kwargs.pop("inputs")
+                gen_kwargs.update(cached_inputs)
+
         return gen_kwargs, prompt_length
 
     @torch.inference_mode()
@@ -95,6 +109,8 @@ class ChatModel:
         r"""
         Args: query, history, system, **input_kwargs
 
+        `input_kwargs` may hold a `prefix` of the query shared with other queries, whose states are cached.
+
         Returns: [(response_text, prompt_length, response_length)] * n (default n=1)
         """
         gen_kwargs, prompt_length = self._process_args(query, history, system, **input_kwargs)
@@ -1,20 +1,29 @@
 import os
 from typing import TYPE_CHECKING, Any, Dict, List, Union
 
-from datasets import concatenate_datasets, interleave_datasets, load_dataset, load_from_disk
+from datasets import Dataset, concatenate_datasets, interleave_datasets, load_dataset, load_from_disk
 
-from llmtuner.data.utils import checksum
+from llmtuner.data.utils import checksum, is_prompt_store, iter_prompt_stores
 from llmtuner.extras.constants import FILEEXT2TYPE
 from llmtuner.extras.logging import get_logger
 
 if TYPE_CHECKING:
-    from datasets import Dataset, IterableDataset
+    from datasets import IterableDataset
     from llmtuner.hparams import ModelArguments, DataArguments
 
 
 logger = get_logger(__name__)
 
 
+def get_file_type(file_name: str) -> Union[str, None]:
+    if is_prompt_store(file_name): # normalized records of extract_sketch.py
+        return "prompt_store"
+    for compression_ext in [".gz", ".zst"]: # compressed shards of craft_train_data.py
+        if file_name.endswith(compression_ext):
+            file_name = file_name[:-len(compression_ext)]
+    return FILEEXT2TYPE.get(file_name.split(".")[-1], None)
+
+
 def get_dataset(
     model_args: "ModelArguments",
     data_args: "DataArguments"
@@ -50,20 +59,28 @@ def get_dataset(
                 for file_name in os.listdir(local_path):
                     data_files.append(os.path.join(local_path, file_name))
                     if data_path is None:
-                        data_path = FILEEXT2TYPE.get(file_name.split(".")[-1], None)
+                        data_path = get_file_type(file_name)
                     else:
-                        assert data_path == FILEEXT2TYPE.get(file_name.split(".")[-1], None), "file types are not identical."
+                        assert data_path == get_file_type(file_name), "file types are not identical."
             elif os.path.isfile(local_path): # is file
                 data_files.append(local_path)
-                data_path = FILEEXT2TYPE.get(local_path.split(".")[-1], None)
+                data_path = get_file_type(local_path)
             else:
                 raise ValueError("File not found.")
 
-            assert data_path, "File extension must be txt, csv, json or jsonl."
+            assert data_path, "File extension must be txt, csv, json, jsonl or store.json[.gz|.zst]."
             checksum(data_files, dataset_attr.dataset_sha1)
         else:
             raise NotImplementedError
 
+        # sharded local files are read lazily, one shard after another
+        stream_shards = (
+            data_args.streaming
+            and dataset_attr.load_from == "file"
+            and data_path != "prompt_store"
+            and len(data_files) > 1
+        )
+
         if dataset_attr.load_from == "ms_hub":
             try:
                 from modelscope import MsDataset
@@ -82,6 +99,12 @@ def get_dataset(
                 ).to_hf_dataset()
             except ImportError:
                 raise ImportError("Please install modelscope via `pip install modelscope -U`")
+        elif data_path == "prompt_store":
+            dataset = Dataset.from_generator(
+                iter_prompt_stores,
+                gen_kwargs={"data_files": data_files},
+                cache_dir=model_args.cache_dir
+            )
         else:
             dataset = load_dataset(
                 path=data_path,
@@ -91,10 +114,10 @@ def get_dataset(
                 split=data_args.split,
                 cache_dir=model_args.cache_dir,
                 token=model_args.hf_hub_token,
-                streaming=(data_args.streaming and (dataset_attr.load_from != "file"))
+                streaming=(data_args.streaming and (dataset_attr.load_from != "file" or stream_shards))
             )
 
-        if data_args.streaming and (dataset_attr.load_from == "file"): # faster than specifying streaming=True
+        if data_args.streaming and (dataset_attr.load_from == "file") and not stream_shards: # faster than specifying streaming=True
             dataset = dataset.to_iterable_dataset() # TODO: add num shards parameter
 
         if max_samples is not None: # truncate dataset
@@ -1,5 +1,8 @@
+import gzip
 import hashlib
-from typing import TYPE_CHECKING, Dict, List, Optional, Union
+import json
+import os
+from typing import TYPE_CHECKING, Any, Dict, Generator, List, Optional, Union
 
 from llmtuner.extras.logging import get_logger
 
@@ -27,6 +30,61 @@ def checksum(data_files: List[str], file_sha1: Optional[str] = None) -> None:
             logger.warning("Checksum failed: mismatched SHA-1 hash value at {}.".format(data_files[0]))
 
 
+def is_prompt_store(file_path: str) -> bool:
+    return ".store.json" in os.path.basename(file_path)
+
+
+def render_prompt_spec(spec: Any, texts: List[str], templates: Dict[str, List[str]]) -> Any:
+    r"""
+    Rebuilds a field of a prompt store record (see `prompt_store.py` in the repository root).
+    """
+    if isinstance(spec, int):
+        return texts[spec]
+    if isinstance(spec, str):
+        return spec
+    if "value" in spec:
+        return spec["value"]
+    if "template" in spec:
+        pieces = templates[spec["template"]]
+        args = [render_prompt_spec(arg, texts, templates) for arg in spec["args"]]
+        return pieces[0] + "".join(arg + piece for arg, piece in zip(args, pieces[1:]))
+    if "join" in spec:
+        content = "".join(render_prompt_spec(x, texts, templates) for x in spec["join"])
+        return content.strip() if spec["strip"] else content
+    if "todo" in spec:
+        lines = render_prompt_spec(spec["todo"], texts, templates).split("\n")
+        line = lines[spec["line"]]
+        lines[spec["line"]] = line[:len(line) - len(line.lstrip())] + '"""TODO"""'
+        return "\n".join(lines)
+    raise ValueError("Unknown prompt store spec: {}".format(spec))
+
+
+def iter_prompt_stores(data_files: List[str]) -> Generator[Dict[str, Any], None, None]:
+    r"""
+    Yields the records of prompt stores, rebuilding the instructions lazily.
+    """
+    for file_path in data_files:
+        if file_path.endswith(".gz"):
+            f = gzip.open(file_path, "rt", encoding="utf-8")
+        elif file_path.endswith(".zst"):
+            try:
+                import zstandard
+            except ImportError:
+                raise ImportError("Please install zstandard via `pip install zstandard`")
+            f = zstandard.open(file_path, "rt", encoding="utf-8")
+        else:
+            f = open(file_path, "r", encoding="utf-8")
+
+        with f:
+            store = json.load(f)
+
+        for record in store["records"]:
+            yield {
+                key: render_prompt_spec(value, store["texts"], store["templates"])
+                for key, value in record.items()
+            }
+
+
 def split_dataset(
     dataset: Union["Dataset", "IterableDataset"],
     data_args: "DataArguments",
@@ -0,0 +1,200 @@
+import copy
+import torch
+from collections import OrderedDict
+from packaging import version
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Sequence, Tuple
+
+from llmtuner.extras.logging import get_logger
+from llmtuner.extras.packages import get_package_version
+
+
+if TYPE_CHECKING:
+    from transformers import GenerationConfig, PreTrainedModel
+
+
+logger = get_logger(__name__)
+
+
+PastKeyValues = Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+
+
+def get_common_prefix_length(input_ids_list: Sequence[Sequence[int]], prefix_ids: Sequence[int]) -> int:
+    r"""
+    Returns the length of the longest common prefix of `prefix_ids` and all the prompts.
+    """
+    length = len(prefix_ids)
+    for input_ids in input_ids_list:
+        length = min(length, len(input_ids))
+        for i in range(length):
+            if input_ids[i] != prefix_ids[i]:
+                length = i
+                break
+
+    return length
+
+
+def get_expand_size(generation_config: "GenerationConfig") -> Optional[int]:
+    r"""
+    Returns the number of sequences `generate` runs for each prompt, i.e. its batch expansion,
+    or None for the contrastive search, which expands the cache by itself.
+    """
+    if generation_config.penalty_alpha is not None and (generation_config.top_k or 0) > 1:
+        return None
+
+    if generation_config.num_beams > 1:
+        return generation_config.num_beams
+
+    return generation_config.num_return_sequences or 1
+
+
+def to_legacy_cache(past_key_values: Any) -> PastKeyValues:
+    r"""
+    Returns the key/value states of a model output as a tuple of (key, value) per layer,
+    whether the model returned tuples or a `Cache` object.
+    """
+    if isinstance(past_key_values, tuple):
+        return past_key_values
+
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+
+    if hasattr(past_key_values, "layers"): # transformers>=5.0.0
+        return tuple((layer.keys, layer.values) for layer in past_key_values.layers)
+
+    return tuple(zip(past_key_values.key_cache, past_key_values.value_cache))
+
+
+def from_legacy_cache(model: "PreTrainedModel", past_key_values: PastKeyValues) -> Any:
+    r"""
+    Returns the key/value states in the form `generate` expects: a new `DynamicCache`, since
+    `generate` extends it in place, or the tuples themselves for the models without `Cache`
+    support and for transformers<4.42.0, which only infers the cached length from tuples.
+    """
+    if (
+        version.parse(get_package_version("transformers")) < version.parse("4.42.0")
+        or not getattr(model, "_supports_cache_class", True) # removed in transformers>=5.0.0
+    ):
+        return past_key_values
+
+    from transformers import DynamicCache
+
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(past_key_values)
+
+    return DynamicCache(past_key_values)
+
+
+class PrefixCache:
+    r"""
+    Caches the key/value states of prompt prefixes, so that the prompts sharing a long
+    prefix (e.g. the function body prompts of a repository, which differ only after the
+    README summary and the repository sketch) prefill it once instead of once per prompt.
+    """
+
+    def __init__(self, model: "PreTrainedModel", max_size: Optional[int] = 4) -> None:
+        self.model = model
+        self.max_size = max_size
+        self.entries: "OrderedDict[Tuple[int, ...], PastKeyValues]" = OrderedDict()
+
+    @torch.inference_mode()
+    def get_past_key_values(self, prefix_ids: Sequence[int]) -> PastKeyValues:
+        r"""
+        Returns the key/value states of the prefix for a batch of one, computing them on a miss.
+        """
+        key = tuple(prefix_ids)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        input_ids = torch.tensor([prefix_ids], device=self.model.device)
+        past_key_values = to_legacy_cache(self.model(input_ids=input_ids, use_cache=True).past_key_values)
+
+        self.entries[key] = past_key_values
+        if self.max_size is not None and len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+        return past_key_values
+
+    @torch.inference_mode()
+    def prepare_inputs(
+        self,
+        input_ids_list: Sequence[Sequence[int]],
+        prefix_ids: Sequence[int],
+        pad_token_id: int,
+        expand_size: Optional[int] = 1
+    ) -> Optional[Dict[str, Any]]:
+        r"""
+        Returns the `input_ids`, `attention_mask` and `past_key_values` to pass to `generate`
+        for the prompts, reusing the cached states of their common prefix with `prefix_ids`.
+
+        The prompts are padded between the prefix and their own tokens, the padding being
+        masked so that the positions of the tokens are unchanged. The states of the prefix
+        are repeated for the `expand_size` sequences generated from each prompt.
+        Returns None if there is no prefix to reuse.
+        """
+        if expand_size is None or len(input_ids_list) == 0:
+            return None
+
+        # `generate` needs at least one uncached token in every prompt
+        prefix_length = min(
+            get_common_prefix_length(input_ids_list, prefix_ids),
+            min(len(input_ids) for input_ids in input_ids_list) - 1
+        )
+        if prefix_length <= 0:
+            return None
+
+        past_key_values = self.get_past_key_values(input_ids_list[0][:prefix_length])
+        batch_size = len(input_ids_list) * expand_size
+        past_key_values = from_legacy_cache(self.model, tuple(
+            (
+                key.expand(batch_size, -1, -1, -1).contiguous(),
+                value.expand(batch_size, -1, -1, -1).contiguous()
+            )
+            for key, value in past_key_values
+        ))
+
+        max_suffix_length = max(len(input_ids) for input_ids in input_ids_list) - prefix_length
+        input_ids, attention_mask = [], []
+        for prompt_ids in input_ids_list:
+            suffix_ids = list(prompt_ids[prefix_length:])
+            pad_length = max_suffix_length - len(suffix_ids)
+            input_ids.append(list(prompt_ids[:prefix_length]) + [pad_token_id] * pad_length + suffix_ids)
+            attention_mask.append([1] * prefix_length + [0] * pad_length + [1] * len(suffix_ids))
+
+        return dict(
+            input_ids=torch.tensor(input_ids, device=self.model.device),
+            attention_mask=torch.tensor(attention_mask, device=self.model.device),
+            past_key_values=past_key_values
+        )
+
+    @torch.inference_mode()
+    def generate(
+        self,
+        input_ids_list: Sequence[Sequence[int]],
+        prefix_ids: Sequence[int],
+        pad_token_id: int,
+        **generate_kwargs
+    ) -> List[List[int]]:
+        r"""
+        Generates from a batch of prompts sharing a prefix, falling back to a left-padded batch
+        when nothing can be reused. Returns the generated token ids of each sequence.
+        """
+        generation_config = copy.deepcopy(generate_kwargs.pop("generation_config", None) or self.model.generation_config)
+        generate_kwargs = generation_config.update(**generate_kwargs)
+        inputs = self.prepare_inputs(input_ids_list, prefix_ids, pad_token_id, get_expand_size(generation_config))
+        if inputs is None:
+            logger.warning("No prefix to reuse, generating without the prefix cache.")
+            max_length = max(len(input_ids) for input_ids in input_ids_list)
+            inputs = dict(
+                input_ids=torch.tensor(
+                    [[pad_token_id] * (max_length - len(x)) + list(x) for x in input_ids_list], device=self.model.device
+                ),
+                attention_mask=torch.tensor(
+                    [[0] * (max_length - len(x)) + [1] * len(x) for x in input_ids_list], device=self.model.device
+                )
+            )
+
+        outputs = self.model.generate(
+            **inputs, generation_config=generation_config, pad_token_id=pad_token_id, **generate_kwargs
+        )
+        return outputs[:, inputs["input_ids"].size(1):].tolist()
@@ -116,6 +116,11 @@ class DataArguments:
         default=None,
         metadata={"help": "Path to save or load the preprocessed datasets."}
     )
+    bucket_boundaries: Optional[str] = field(
+        default=None,
+        metadata={"help": "Upper token lengths of the buckets whose batches are drawn from a single bucket. \
+                  Use commas to separate multiple lengths, e.g. `1024,2048,4096`."}
+    )
 
     def __post_init__(self):
         if self.reserved_label_len >= self.cutoff_len:
@@ -127,6 +132,9 @@ class DataArguments:
         if self.streaming and self.max_samples is not None:
             raise ValueError("`max_samples` is incompatible with `streaming`.")
 
+        if self.streaming and self.bucket_boundaries is not None:
+            raise ValueError("`bucket_boundaries` is incompatible with `streaming`.")
+
     def init_for_training(self, seed: int): # support mixing multiple datasets
         self.seed = seed
         dataset_names = [ds.strip() for ds in self.dataset.split(",")] if self.dataset is not None else []
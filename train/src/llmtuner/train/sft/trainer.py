@@ -3,7 +3,8 @@ import json
 import torch
 import numpy as np
 import torch.nn as nn
-from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple, Union
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional, Tuple, Union
+from torch.utils.data import Sampler
 from transformers import Seq2SeqTrainer
 
 from llmtuner.extras.constants import IGNORE_INDEX
@@ -16,11 +17,74 @@ if TYPE_CHECKING:
 logger = get_logger(__name__)
 
 
+class LengthBucketSampler(Sampler):
+    r"""
+    Yields the indices in batches drawn from a single length bucket, so that the batches are barely padded.
+
+    The samples are shuffled within their buckets and the batches are shuffled across the buckets at every epoch.
+    """
+
+    def __init__(
+        self,
+        lengths: List[int],
+        bucket_boundaries: List[int],
+        batch_size: int,
+        seed: Optional[int] = 0
+    ) -> None:
+        self.batch_size = batch_size
+        self.seed = seed
+        self.epoch = 0
+        self.buckets: List[List[int]] = [[] for _ in range(len(bucket_boundaries) + 1)]
+        for index, length in enumerate(lengths):
+            bucket = next((i for i, boundary in enumerate(bucket_boundaries) if length <= boundary), -1)
+            self.buckets[bucket].append(index)
+
+    def __len__(self) -> int:
+        return sum(len(bucket) for bucket in self.buckets)
+
+    def __iter__(self) -> Iterator[int]:
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        self.epoch += 1
+
+        batches: List[List[int]] = []
+        for bucket in self.buckets:
+            indices = [bucket[i] for i in torch.randperm(len(bucket), generator=generator).tolist()]
+            batches.extend(indices[i : i + self.batch_size] for i in range(0, len(indices), self.batch_size))
+
+        # keep the incomplete batches last to not break a full batch across buckets
+        full_batches = [batch for batch in batches if len(batch) == self.batch_size]
+        partial_batches = [batch for batch in batches if len(batch) < self.batch_size]
+        for i in torch.randperm(len(full_batches), generator=generator).tolist():
+            yield from full_batches[i]
+        for batch in partial_batches:
+            yield from batch
+
+
 class CustomSeq2SeqTrainer(Seq2SeqTrainer):
     r"""
     Inherits PeftTrainer to compute generative metrics such as BLEU and ROUGE.
     """
 
+    def __init__(self, bucket_boundaries: Optional[List[int]] = None, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.bucket_boundaries = bucket_boundaries
+
+    def _get_train_sampler(self) -> Optional["Sampler"]:
+        r"""
+        Draws each batch from a single length bucket if `bucket_boundaries` is given.
+        """
+        if self.bucket_boundaries is None or self.train_dataset is None:
+            return super()._get_train_sampler()
+
+        # the batches are split across the processes, so a global batch must fit in a bucket
+        return LengthBucketSampler(
+            lengths=self.train_dataset[self.args.length_column_name],
+            bucket_boundaries=self.bucket_boundaries,
+            batch_size=self.args.train_batch_size * self.args.world_size,
+            seed=self.args.seed
+        )
+
     def prediction_step(
         self,
         model: nn.Module,
@@ -5,6 +5,7 @@ from transformers import DataCollatorForSeq2Seq, Seq2SeqTrainingArguments
 
 from llmtuner.data import get_dataset, preprocess_dataset, split_dataset
 from llmtuner.extras.constants import IGNORE_INDEX
+from llmtuner.extras.logging import get_logger
 from llmtuner.extras.misc import get_logits_processor
 from llmtuner.extras.ploting import plot_loss
 from llmtuner.model import load_model_and_tokenizer
@@ -17,6 +18,9 @@ if TYPE_CHECKING:
     from llmtuner.hparams import ModelArguments, DataArguments, FinetuningArguments, GeneratingArguments
 
 
+logger = get_logger(__name__)
+
+
 def run_sft(
     model_args: "ModelArguments",
     data_args: "DataArguments",
@@ -29,6 +33,22 @@ def run_sft(
     model, tokenizer = load_model_and_tokenizer(model_args, finetuning_args, training_args.do_train)
     dataset = preprocess_dataset(dataset, tokenizer, data_args, training_args, stage="sft")
 
+    bucket_boundaries = None
+    if data_args.bucket_boundaries is not None:
+        bucket_boundaries = sorted(int(length.strip()) for length in data_args.bucket_boundaries.split(","))
+
+    if training_args.do_train and (training_args.group_by_length or bucket_boundaries is not None):
+        if data_args.streaming:
+            logger.warning("Grouping the samples by length is not supported in streaming mode.")
+        else: # computed once here instead of by the sampler at every epoch
+            dataset = dataset.map(
+                lambda examples: {training_args.length_column_name: [len(input_ids) for input_ids in examples["input_ids"]]},
+                batched=True,
+                num_proc=data_args.preprocessing_num_workers,
+                load_from_cache_file=(not data_args.overwrite_cache),
+                desc="Computing lengths"
+            )
+
     if training_args.predict_with_generate:
         tokenizer.padding_side = "left" # use left-padding in generation
 
@@ -57,6 +77,7 @@ def run_sft(
         data_collator=data_collator,
         callbacks=callbacks,
         compute_metrics=ComputeMetrics(tokenizer) if training_args.predict_with_generate else None,
+        bucket_boundaries=bucket_boundaries,
         **split_dataset(dataset, data_args, training_args)
     )
 
@@ -0,0 +1,100 @@
+import os
+import sys
+
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+from llmtuner.extras.prefix_cache import PrefixCache
+
+
+EOS_TOKEN_ID = 1
+MAX_NEW_TOKENS = 8
+PREFIX_IDS = [5, 17, 23, 8, 42, 11, 30, 7, 19, 3]
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    config = transformers.LlamaConfig(
+        vocab_size=64,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        max_position_embeddings=128,
+        bos_token_id=0,
+        eos_token_id=EOS_TOKEN_ID,
+        pad_token_id=EOS_TOKEN_ID
+    )
+    return transformers.LlamaForCausalLM(config).double().eval()
+
+
+def trim(output_ids):
+    r"""
+    Drops the padding after the end of the sequence.
+    """
+    if EOS_TOKEN_ID in output_ids:
+        return output_ids[:output_ids.index(EOS_TOKEN_ID) + 1]
+    return output_ids
+
+
+def generate_one(model, input_ids):
+    with torch.inference_mode():
+        outputs = model.generate(
+            input_ids=torch.tensor([input_ids]),
+            attention_mask=torch.ones(1, len(input_ids), dtype=torch.long),
+            do_sample=False,
+            max_new_tokens=MAX_NEW_TOKENS,
+            pad_token_id=EOS_TOKEN_ID
+        )
+    return trim(outputs[0, len(input_ids):].tolist())
+
+
+def generate_cached(prefix_cache, input_ids_list, prefix_ids):
+    outputs = prefix_cache.generate(
+        input_ids_list, prefix_ids, EOS_TOKEN_ID, do_sample=False, max_new_tokens=MAX_NEW_TOKENS
+    )
+    return [trim(output_ids) for output_ids in outputs]
+
+
+def test_prefix_cache_matches_generate(model):
+    input_ids_list = [
+        PREFIX_IDS + [12],
+        PREFIX_IDS + [40, 9, 27],
+        PREFIX_IDS + [33, 2, 14, 60, 21, 6]
+    ]
+    prefix_cache = PrefixCache(model)
+    expected = [generate_one(model, input_ids) for input_ids in input_ids_list]
+
+    assert generate_cached(prefix_cache, input_ids_list, PREFIX_IDS) == expected
+    assert list(prefix_cache.entries) == [tuple(PREFIX_IDS)]
+
+    # the second batch reuses the cached states, in reverse order
+    assert generate_cached(prefix_cache, input_ids_list[::-1], PREFIX_IDS) == expected[::-1]
+    assert list(prefix_cache.entries) == [tuple(PREFIX_IDS)]
+
+
+def test_prefix_cache_partial_prefix(model):
+    # the prompts share only the start of the prefix, and one of them is shorter than it
+    input_ids_list = [
+        PREFIX_IDS[:4] + [50, 51],
+        PREFIX_IDS[:6] + [52],
+        PREFIX_IDS + [53, 54, 55]
+    ]
+    prefix_cache = PrefixCache(model)
+    expected = [generate_one(model, input_ids) for input_ids in input_ids_list]
+
+    assert generate_cached(prefix_cache, input_ids_list, PREFIX_IDS) == expected
+    assert list(prefix_cache.entries) == [tuple(PREFIX_IDS[:4])]
+
+
+def test_prefix_cache_without_common_prefix(model):
+    input_ids_list = [[13, 4, 25], [36, 22, 10, 45, 9]]
+    prefix_cache = PrefixCache(model)
+    expected = [generate_one(model, input_ids) for input_ids in input_ids_list]
+
+    assert generate_cached(prefix_cache, input_ids_list, PREFIX_IDS) == expected
+    assert len(prefix_cache.entries) == 0
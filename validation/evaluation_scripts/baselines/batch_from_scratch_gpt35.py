@@ -16,9 +16,7 @@ output_dir = args.output_dir
 if not os.path.exists(output_dir):
     os.makedirs(output_dir)
 
-for dirname in os.listdir(input_dir):
-    if dirname == ".DS_Store":
-        continue
-    cmd = f"python from_scratch_gpt35_eval.py --project {dirname} --repo_dir {input_dir} --output_dir {output_dir} --model gpt-3.5-turbo-0613"
-    logger.info(cmd)
-    os.system(cmd)
+# a single run requests all the repositories concurrently
+cmd = f"python from_scratch_gpt35_eval.py --repo_dir {input_dir} --output_dir {output_dir} --model gpt-3.5-turbo-0613"
+logger.info(cmd)
+os.system(cmd)
@@ -3,13 +3,14 @@ import pathlib
 
 sys.path.append(str(pathlib.Path(__file__).parent.parent.absolute()))
 import utils
+import extract_sketch as sketch_utils
 import os
 import json
+import asyncio
 from loguru import logger
 import argparse
 from tqdm import tqdm
-from openai import OpenAI
-import openai
+from openai_client import AsyncOpenAIClient
 
 TEMPLATE_DICT = {
     "repo_sketch.json": """You are a senior software engineer. You are asked to design a code repository sketch according to its README. This repository uses mainly the Python language.
@@ -81,56 +82,45 @@ parser.add_argument(
     default="../evaluation_results/from_scratch_inference_results",
 )
 parser.add_argument("--model", type=str, default="gpt-3.5-turbo-1106")
+parser.add_argument(
+    "--max_concurrency", type=int, default=16, help="Max requests in flight."
+)
+parser.add_argument(
+    "--requests_per_minute",
+    type=float,
+    default=3500,
+    help="Rate limit of the account.",
+)
+parser.add_argument(
+    "--max_retries",
+    type=int,
+    default=6,
+    help="Retries of a request failing with a transient error.",
+)
+parser.add_argument(
+    "--cache_file",
+    type=str,
+    default=None,
+    help="Cache of the responses, so that a rerun only sends the missing requests "
+    "(default: <output_dir>/<model>_cache.jsonl).",
+)
 
 args = parser.parse_args()
 
-openai_api_base_url = os.environ.get("OPENAI_API_BASE_URL")
-openai_api_key = os.environ.get("OPENAI_API_KEY")
+model_name = args.model.split("/")[-1]
+cache_file = args.cache_file or os.path.join(
+    args.output_dir, f"{model_name}_cache.jsonl"
+)
 
 
-def openai_request(instruction, temp=0.0):
-    logger.info(f"temperature: {temp}")
-    client = OpenAI(base_url=openai_api_base_url, api_key=openai_api_key)
-    try:
-        completion = client.chat.completions.create(
-            model=args.model,
-            temperature=temp,
-            messages=[
-                {"role": "user", "content": instruction},
-            ],
-        )
-        logger.info(f"OpenAI API prompt: {instruction}")
-        logger.info(f"OpenAI API response: {completion.choices[0].message}")
-        return completion.choices[0].message.content
-    except openai.APIError as e:
-        print(f"OpenAI API returned an API Error: {e}")
-        pass
-    except openai.OpenAIErrorAPIConnectionError as e:
-        print(f"Failed to connect to OpenAI API: {e}")
-        pass
-    except openai.OpenAIErrorRateLimitError as e:
-        print(f"OpenAI API request exceeded rate limit: {e}")
-        pass
-    except openai.OpenAIErrorTimeout as e:
-        print(f"OpenAI API request timed out: {e}")
-        pass
-    except openai.OpenAIErrorInvalidRequestError as e:
-        print(f"Invalid request to OpenAI API: {e}")
-        pass
-    except openai.OpenAIErrorAuthenticationError as e:
-        print(f"Authentication error with OpenAI API: {e}")
-        pass
-    except openai.OpenAIErrorServiceUnavailableError as e:
-        print(f"OpenAI API service unavailable: {e}")
-        pass
-
-    return None
-
-
-for repo in [args.project] if args.project else os.listdir(args.repo_dir):
-    if not os.path.exists(os.path.join(args.repo_dir, repo, "README.md")):
-        continue
-    output_dir = os.path.join(args.output_dir, args.model.split("/")[-1], repo)
+async def generate(client, instruction, progress):
+    sequence = await client.chat(instruction, temperature=0.0)
+    progress.update(1)
+    return sequence
+
+
+async def infer_repo(client, repo, progress):
+    output_dir = os.path.join(args.output_dir, model_name, repo)
     if not os.path.exists(output_dir):
         os.system(f"mkdir -p {output_dir}")
 
@@ -152,33 +142,25 @@ for repo in [args.project] if args.project else os.listdir(args.repo_dir):
     for to_infer in ["repo_sketch.json", "file_sketch.json", "function_body.json"]:
         logger.info(f"Processing {repo} {to_infer}")
         input_file = os.path.join(output_dir, to_infer)
-        with open(os.path.join(output_dir, to_infer), "r") as f:
-            output_file = os.path.join(output_dir, to_infer + ".jsonl")
-            with open(output_file, "w") as f1:
-                pass
-
-            with open(input_file, "r") as f1:
-                data = json.load(f1)
-
-            prepared_next_input = []
-            insts = {}
-            for each in tqdm(data):
-                sequence = None
-                try_time = 5
-                while sequence == None and try_time > 0:
-                    try_time -= 1
-                    sequence = openai_request(
-                        each["instruction"], temp=0.0 if try_time == 4 else 0.1
-                    )
-
-                if sequence == None:
-                    logger.error("can't connect to openai api")
-                    exit(1)
+        output_file = os.path.join(output_dir, to_infer + ".jsonl")
+        with open(input_file, "r") as f:
+            data = json.load(f)
+
+        # the records of a stage are requested concurrently, and with the stages of
+        # the other repositories
+        progress.total += len(data)
+        progress.refresh()
+        sequences = await asyncio.gather(
+            *[generate(client, each["instruction"], progress) for each in data]
+        )
 
+        prepared_next_input = []
+        insts = {}
+        with open(output_file, "w") as f1:
+            for each, sequence in zip(data, sequences):
                 each["generated"] = sequence
                 each["parsed"] = utils.parse_reponse(each["generated"])
-                with open(output_file, "a") as f1:
-                    f1.write(json.dumps(each) + "\n")
+                f1.write(json.dumps(each) + "\n")
 
                 if to_infer == "file_sketch.json":
                     insts[each["file_path"]] = each
@@ -190,26 +172,63 @@ for repo in [args.project] if args.project else os.listdir(args.repo_dir):
                         )
                     )
 
-            if to_infer == "file_sketch.json":
-                for each in insts.values():
-                    if each["file_path"].endswith(".py"):
-                        prepared_next_input.extend(
-                            utils.generate_function_body_input_openai(
-                                each,
-                                readme_content,
-                                insts,
-                                "",
-                                TEMPLATE_DICT["function_body.json"],
-                            )
+        if to_infer == "file_sketch.json":
+            parsed_cache = sketch_utils.ParsedFileCache(insts)
+            for each in insts.values():
+                if each["file_path"].endswith(".py"):
+                    prepared_next_input.extend(
+                        utils.generate_function_body_input_openai(
+                            each,
+                            readme_content,
+                            insts,
+                            "",
+                            TEMPLATE_DICT["function_body.json"],
+                            parsed_cache,
                         )
+                    )
 
-            next_input_file = None
-
-            if to_infer == "repo_sketch.json":
-                next_input_file = os.path.join(output_dir, "file_sketch.json")
-            elif to_infer == "file_sketch.json":
-                next_input_file = os.path.join(output_dir, "function_body.json")
-
-            if next_input_file:
-                with open(next_input_file, "w") as f1:
-                    f1.write(json.dumps(prepared_next_input))
+        next_input_file = None
+
+        if to_infer == "repo_sketch.json":
+            next_input_file = os.path.join(output_dir, "file_sketch.json")
+        elif to_infer == "file_sketch.json":
+            next_input_file = os.path.join(output_dir, "function_body.json")
+
+        if next_input_file:
+            with open(next_input_file, "w") as f1:
+                f1.write(json.dumps(prepared_next_input))
+
+
+async def main():
+    repos = [
+        repo
+        for repo in ([args.project] if args.project else os.listdir(args.repo_dir))
+        if os.path.exists(os.path.join(args.repo_dir, repo, "README.md"))
+    ]
+    os.makedirs(args.output_dir, exist_ok=True)
+    failed_repos = []
+    async with AsyncOpenAIClient(
+        args.model,
+        max_concurrency=args.max_concurrency,
+        requests_per_minute=args.requests_per_minute,
+        max_retries=args.max_retries,
+        cache_path=cache_file,
+    ) as client:
+        with tqdm(total=0, desc="requests") as progress:
+
+            async def run(repo):
+                # a failing repository must not stop the others; the responses
+                # received so far are cached for a rerun
+                try:
+                    await infer_repo(client, repo, progress)
+                except Exception:
+                    logger.exception(f"Failed to infer {repo}")
+                    failed_repos.append(repo)
+
+            await asyncio.gather(*[run(repo) for repo in repos])
+
+    if failed_repos:
+        logger.error(f"{len(failed_repos)} repositories failed: {failed_repos}")
+
+
+asyncio.run(main())
@@ -1,16 +1,20 @@
 import utils
-from transformers import AutoTokenizer
-import transformers
-import torch
+from generation_scheduler import GenerationScheduler
+from inference_checkpoint import InferenceCheckpoint, write_text_atomic
+from generation_backends import add_backend_args, get_backend
 import os
 import sys
 import json
+import functools
 from loguru import logger
 import argparse
 import pathlib
-from tqdm import tqdm
 
 sys.path.append(str(pathlib.Path(__file__).parent.parent.parent.absolute()))
+sys.path.append(
+    str(pathlib.Path(__file__).parent.parent.parent.absolute() / "train" / "src")
+)
+import extract_sketch as sketch_utils
 import prompt_construction_utils as prpt_utils
 
 template = """[INST] <<SYS>>\nYou are a helpful, respectful and honest assistant. Always answer as helpfully as possible, while being safe. Your answers should not include any harmful, unethical, racist, sexist, toxic, dangerous, or illegal content. Please ensure that your responses are socially unbiased and positive in nature.
@@ -26,97 +30,153 @@ parser.add_argument(
     default="../evaluation_results/from_scratch_inference_results",
 )
 parser.add_argument("--model", type=str, default=None)
-
-args = parser.parse_args()
-
-tokenizer = AutoTokenizer.from_pretrained(args.model)
-pipeline = transformers.pipeline(
-    "text-generation",
-    model=args.model,
-    torch_dtype=torch.float16,
-    device_map="auto",
+parser.add_argument(
+    "--batch_size",
+    type=int,
+    default=8,
+    help="Prompts per generate call, taken from all the repositories.",
+)
+parser.add_argument(
+    "--resume",
+    action="store_true",
+    help="Keep the records already generated in the output directory, only generating the rest.",
 )
+add_backend_args(parser)
 
-for repo in [args.project] if args.project else os.listdir(args.repo_dir):
-    if not os.path.exists(os.path.join(args.repo_dir, repo, "README.md")):
-        continue
-    output_dir = os.path.join(args.output_dir, args.model.split("/")[-1], repo)
-    if not os.path.exists(output_dir):
-        os.system(f"mkdir -p {output_dir}")
+args = parser.parse_args()
 
-    with open(os.path.join(output_dir, "repo_sketch.json"), "w") as f:
-        with open(os.path.join(args.repo_dir, repo, "README.md"), "r") as f2:
-            readme_content = f2.read().strip()
-        json.dump(
+backend = get_backend(args, template)
+
+
+class RepoJob:
+    """
+    Generate a repository from its README: the repo sketch, then the sketches of its
+    files, then the bodies of their functions. Each stage is submitted as a whole
+    once the previous one is done, its inputs and outputs being saved as
+    `<stage>.json` and `<stage>.json.jsonl` in the output directory.
+
+    The outputs are appended as they are generated, and sorted in the order of the
+    inputs once the stage is done. With `--resume`, the records found in the outputs
+    of a previous run are not generated again.
+    """
+
+    def __init__(self, repo, readme_content, output_dir, scheduler):
+        self.repo = repo
+        self.readme_content = readme_content
+        self.output_dir = output_dir
+        self.scheduler = scheduler
+        self.to_infer = None
+        self.data = []
+        self.remaining = 0
+        self.checkpoint = None
+
+    def start(self):
+        self.run_stage(
+            "repo_sketch.json",
             [
                 {
-                    "readme": readme_content,
-                    "instruction": prpt_utils.get_repo_sketch_prompt(readme_content),
+                    "readme": self.readme_content,
+                    "instruction": prpt_utils.get_repo_sketch_prompt(
+                        self.readme_content
+                    ),
                 }
             ],
-            f,
         )
 
-    for to_infer in ["repo_sketch.json", "file_sketch.json", "function_body.json"]:
-        logger.info(f"Processing {repo} {to_infer}")
-        input_file = os.path.join(output_dir, to_infer)
-        with open(os.path.join(output_dir, to_infer), "r") as f:
-            output_file = os.path.join(output_dir, to_infer + ".jsonl")
-            with open(output_file, "w") as f1:
-                pass
-
-            with open(input_file, "r") as f1:
-                data = json.load(f1)
-
-            prepared_next_input = []
-            insts = {}
-            for each in tqdm(data):
-                sequences = pipeline(
-                    template.format(each["instruction"]),
-                    do_sample=False,
-                    num_return_sequences=1,
-                    eos_token_id=tokenizer.eos_token_id,
-                    pad_token_id=tokenizer.eos_token_id,
-                    max_length=8192,
-                    # max_new_tokens=2048,
-                )
+    def run_stage(self, to_infer, data):
+        write_text_atomic(os.path.join(self.output_dir, to_infer), json.dumps(data))
 
-                for idx, seq in enumerate(sequences):
-                    each["generated"] = (
-                        seq["generated_text"].split("[/INST]")[-1].strip()
-                    )
-                    each["parsed"] = utils.parse_reponse(each["generated"])
-                    with open(output_file, "a") as f1:
-                        f1.write(json.dumps(each) + "\n")
+        self.to_infer = to_infer
+        self.data = data
+        self.checkpoint = InferenceCheckpoint(
+            os.path.join(self.output_dir, to_infer + ".jsonl"), args.resume
+        )
+        to_generate = []
+        for each in data:
+            done = self.checkpoint.get(each["instruction"])
+            if done is not None:
+                each["generated"] = done["generated"]
+                each["parsed"] = done["parsed"]
+            else:
+                to_generate.append(each)
+        logger.info(
+            f"Processing {self.repo} {to_infer} ({len(to_generate)} prompts, "
+            f"{len(data) - len(to_generate)} done)"
+        )
 
-                    if to_infer == "file_sketch.json":
-                        insts[each["file_path"]] = each
+        self.remaining = len(to_generate)
+        if self.remaining == 0:
+            self.finish_stage()
+            return
+
+        prefix = None
+        if backend.supports_prefix and to_infer == "function_body.json":
+            # shared by the function body prompts of the repository
+            prefix = prpt_utils.get_function_body_template(
+                data[0]["readme_summary"], data[0]["repo_sketch"]
+            ).prefix
+        for each in to_generate:
+            self.scheduler.submit(
+                each["instruction"],
+                functools.partial(self.on_generated, each),
+                prefix,
+            )
+
+    def on_generated(self, each, generated):
+        each["generated"] = generated
+        each["parsed"] = utils.parse_reponse(generated)
+        self.checkpoint.write(each)
+        self.remaining -= 1
+        if self.remaining == 0:
+            self.finish_stage()
+
+    def finish_stage(self):
+        # in the order of the inputs, whatever the order of generation
+        self.checkpoint.close()
+        write_text_atomic(
+            self.checkpoint.path,
+            "".join(json.dumps(each) + "\n" for each in self.data),
+        )
 
-                    if to_infer == "repo_sketch.json":
-                        prepared_next_input.extend(
-                            utils.generate_file_sketch_input(idx, each, readme_content)
+        prepared_next_input = []
+        if self.to_infer == "repo_sketch.json":
+            for each in self.data:
+                prepared_next_input.extend(
+                    utils.generate_file_sketch_input(0, each, self.readme_content)
+                )
+            self.run_stage("file_sketch.json", prepared_next_input)
+        elif self.to_infer == "file_sketch.json":
+            insts = {each["file_path"]: each for each in self.data}
+            parsed_cache = sketch_utils.ParsedFileCache(insts)
+            for each in insts.values():
+                if each["file_path"].endswith(".py"):
+                    prepared_next_input.extend(
+                        utils.generate_function_body_input(
+                            0,
+                            each,
+                            self.readme_content,
+                            insts,
+                            "",
+                            parsed_cache,
                         )
+                    )
+            self.run_stage("function_body.json", prepared_next_input)
+        else:
+            logger.info(f"Finished {self.repo}")
 
-            if to_infer == "file_sketch.json":
-                for each in insts.values():
-                    if each["file_path"].endswith(".py"):
-                        prepared_next_input.extend(
-                            utils.generate_function_body_input(
-                                idx,
-                                each,
-                                readme_content,
-                                insts,
-                                "",
-                            )
-                        )
 
-            next_input_file = None
+scheduler = GenerationScheduler(backend.generate, args.batch_size)
+for repo in [args.project] if args.project else os.listdir(args.repo_dir):
+    if not os.path.exists(os.path.join(args.repo_dir, repo, "README.md")):
+        continue
+    output_dir = os.path.join(args.output_dir, args.model.split("/")[-1], repo)
+    if not os.path.exists(output_dir):
+        os.system(f"mkdir -p {output_dir}")
 
-            if to_infer == "repo_sketch.json":
-                next_input_file = os.path.join(output_dir, "file_sketch.json")
-            elif to_infer == "file_sketch.json":
-                next_input_file = os.path.join(output_dir, "function_body.json")
+    with open(os.path.join(args.repo_dir, repo, "README.md"), "r") as f:
+        readme_content = f.read().strip()
+    RepoJob(repo, readme_content, output_dir, scheduler).start()
 
-            if next_input_file:
-                with open(next_input_file, "w") as f1:
-                    f1.write(json.dumps(prepared_next_input))
+# the repositories are generated together, their ready prompts sharing the batches
+scheduler.run()
+backend.close()
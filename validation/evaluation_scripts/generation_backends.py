@@ -0,0 +1,301 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+BACKENDS = ["pipeline", "chat_model", "openai", "vllm"]
+
+
+class GenerationBackend:
+    """
+    Generate the responses of batches of instructions with a model.
+
+    `template` wraps an instruction into the prompt of the model (e.g. the Llama-2
+    chat format), for the backends given raw text; the others apply the chat template
+    of the model themselves. `max_length` bounds the prompt and the response together.
+    """
+
+    # whether the backend reuses the states of a prefix shared by a batch
+    supports_prefix = False
+
+    def __init__(self, model, template="{}", max_length=8192):
+        self.model = model
+        self.template = template
+        self.max_length = max_length
+
+    def generate(self, instructions, prefix=None):
+        """
+        Responses of the instructions, greedily decoded. `prefix` is a text all the
+        instructions start with, which the backends supporting it only prefill once.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class PipelineBackend(GenerationBackend):
+    """
+    The model of a `transformers.pipeline`, generating from batches padded on the
+    left, with an optional `llmtuner` prefix cache.
+    """
+
+    def __init__(self, model, template="{}", max_length=8192, prefix_cache=False):
+        super().__init__(model, template, max_length)
+        try:
+            import torch
+            import transformers
+        except ImportError:
+            raise ImportError(
+                "Please install transformers via `pip install transformers torch`"
+            )
+
+        self.tokenizer = transformers.AutoTokenizer.from_pretrained(model)
+        # batched generation of a decoder-only model pads on the left
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.pipeline = transformers.pipeline(
+            "text-generation",
+            model=model,
+            tokenizer=self.tokenizer,
+            torch_dtype=torch.float16,
+            device_map="auto",
+        )
+
+        # token ids of the last 16 prefixes, by text
+        self.prefix_ids = {}
+        self.prefix_cache = None
+        if prefix_cache:
+            try:
+                from llmtuner.extras.prefix_cache import PrefixCache
+            except ImportError:
+                raise ImportError(
+                    "Please install llmtuner via `pip install -e ./train`"
+                )
+            self.prefix_cache = PrefixCache(self.pipeline.model)
+            self.supports_prefix = True
+
+    def get_prefix_ids(self, prefix):
+        if prefix not in self.prefix_ids:
+            if len(self.prefix_ids) >= 16:
+                self.prefix_ids.pop(next(iter(self.prefix_ids)))
+            self.prefix_ids[prefix] = self.tokenizer.encode(
+                self.template.split("{}")[0] + prefix
+            )
+        return self.prefix_ids[prefix]
+
+    def generate_padded(self, input_ids_list, **generate_kwargs):
+        inputs = self.tokenizer.pad(
+            {"input_ids": input_ids_list}, return_tensors="pt"
+        ).to(self.pipeline.model.device)
+        outputs = self.pipeline.model.generate(
+            **inputs, pad_token_id=self.tokenizer.pad_token_id, **generate_kwargs
+        )
+        return outputs[:, inputs["input_ids"].size(1) :].tolist()
+
+    def generate(self, instructions, prefix=None):
+        input_ids_list = self.tokenizer(
+            [self.template.format(instruction) for instruction in instructions]
+        )["input_ids"]
+        # like `max_length` in `transformers`, minus the prompt but not its padding
+        max_new_tokens = [
+            max(self.max_length - len(input_ids), 1) for input_ids in input_ids_list
+        ]
+        generate_kwargs = dict(
+            do_sample=False,
+            num_return_sequences=1,
+            eos_token_id=self.tokenizer.eos_token_id,
+            max_new_tokens=max(max_new_tokens),
+        )
+        if prefix is not None and self.prefix_cache is not None:
+            # the cache reuses the common prefix of the prompts
+            outputs = self.prefix_cache.generate(
+                input_ids_list,
+                self.get_prefix_ids(prefix),
+                self.tokenizer.pad_token_id,
+                **generate_kwargs,
+            )
+        else:
+            outputs = self.generate_padded(input_ids_list, **generate_kwargs)
+        # greedy decoding does not depend on the rest of the batch, so cutting the
+        # longest budget to the one of each prompt gives its response alone
+        return [
+            self.tokenizer.decode(output_ids[:length], skip_special_tokens=True).strip()
+            for output_ids, length in zip(outputs, max_new_tokens)
+        ]
+
+
+class ChatModelBackend(GenerationBackend):
+    """
+    `llmtuner.ChatModel`, applying the chat template the model was trained with
+    (`chat_template`), one instruction at a time with its prefix cache.
+    """
+
+    supports_prefix = True
+
+    def __init__(self, model, template="{}", max_length=8192, chat_template="llama2"):
+        super().__init__(model, template, max_length)
+        try:
+            from llmtuner import ChatModel
+        except ImportError:
+            raise ImportError("Please install llmtuner via `pip install -e ./train`")
+        self.chat_model = ChatModel(
+            {"model_name_or_path": model, "template": chat_template}
+        )
+
+    def generate(self, instructions, prefix=None):
+        responses = []
+        for instruction in instructions:
+            results = self.chat_model.chat(
+                instruction,
+                do_sample=False,
+                max_length=self.max_length,
+                prefix=prefix,
+            )
+            responses.append(results[0].response_text.strip())
+        return responses
+
+
+class OpenAIBackend(GenerationBackend):
+    """
+    The chat endpoint of an OpenAI-compatible HTTP server (e.g.
+    `vllm.entrypoints.openai.api_server`, which applies the chat template of the
+    model), sending the instructions of a batch concurrently.
+    """
+
+    def __init__(
+        self,
+        model,
+        template="{}",
+        max_length=8192,
+        base_url=None,
+        api_key=None,
+        max_workers=8,
+        max_retries=5,
+    ):
+        super().__init__(model, template, max_length)
+        try:
+            from openai import OpenAI
+        except ImportError:
+            raise ImportError("Please install openai via `pip install openai`")
+        self.client = OpenAI(
+            base_url=base_url or os.environ.get("OPENAI_API_BASE_URL"),
+            api_key=api_key or os.environ.get("OPENAI_API_KEY", "EMPTY"),
+            max_retries=max_retries,
+        )
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def generate_one(self, instruction):
+        completion = self.client.chat.completions.create(
+            model=self.model,
+            temperature=0.0,
+            messages=[{"role": "user", "content": instruction}],
+        )
+        return completion.choices[0].message.content.strip()
+
+    def generate(self, instructions, prefix=None):
+        # the client retries the failed requests itself
+        return list(self.executor.map(self.generate_one, instructions))
+
+    def close(self):
+        self.executor.shutdown()
+        self.client.close()
+
+
+class VLLMBackend(GenerationBackend):
+    """
+    The offline `vllm` engine, which schedules the sequences of a batch with continuous
+    batching (a finished sequence makes room for the next one at once), so it should
+    be given large batches. `prefix_cache` turns on its automatic prefix caching.
+    """
+
+    def __init__(self, model, template="{}", max_length=8192, prefix_cache=False):
+        super().__init__(model, template, max_length)
+        try:
+            from vllm import LLM, SamplingParams
+        except ImportError:
+            raise ImportError("Please install vllm via `pip install vllm`")
+        self.sampling_params_class = SamplingParams
+        self.llm = LLM(
+            model=model,
+            max_model_len=max_length,
+            enable_prefix_caching=prefix_cache,
+        )
+        self.tokenizer = self.llm.get_tokenizer()
+
+    def generate(self, instructions, prefix=None):
+        prompts = [self.template.format(instruction) for instruction in instructions]
+        # like `max_length` in `transformers`, minus the prompt
+        sampling_params = [
+            self.sampling_params_class(
+                temperature=0.0,
+                max_tokens=max(self.max_length - len(self.tokenizer.encode(prompt)), 1),
+            )
+            for prompt in prompts
+        ]
+        outputs = self.llm.generate(prompts, sampling_params, use_tqdm=False)
+        return [output.outputs[0].text.strip() for output in outputs]
+
+
+def add_backend_args(parser):
+    """
+    Add the arguments of `get_backend` to an `argparse` parser.
+    """
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="pipeline",
+        choices=BACKENDS,
+        help="How to run the model: `transformers` pipeline, llmtuner ChatModel, "
+        "OpenAI-compatible server or vllm offline engine.",
+    )
+    parser.add_argument(
+        "--max_length",
+        type=int,
+        default=8192,
+        help="Max tokens of a prompt and its response.",
+    )
+    parser.add_argument(
+        "--prefix_cache",
+        action="store_true",
+        help="Prefill the prefix shared by the function body prompts of a repository "
+        "(system prompt, README summary and repository sketch) once per repository "
+        "(pipeline and vllm backends; ChatModel always does).",
+    )
+    parser.add_argument(
+        "--chat_template",
+        type=str,
+        default="llama2",
+        help="llmtuner template of the model (chat_model backend).",
+    )
+    parser.add_argument(
+        "--openai_base_url",
+        type=str,
+        default=None,
+        help="Server URL (openai backend), $OPENAI_API_BASE_URL if not given.",
+    )
+
+
+def get_backend(args, template="{}"):
+    """
+    The generation backend chosen by the arguments of `add_backend_args`.
+    """
+    logger.info(f"Loading {args.model} with the {args.backend} backend")
+    if args.backend == "pipeline":
+        return PipelineBackend(args.model, template, args.max_length, args.prefix_cache)
+    if args.backend == "chat_model":
+        return ChatModelBackend(
+            args.model, template, args.max_length, args.chat_template
+        )
+    if args.backend == "openai":
+        return OpenAIBackend(
+            args.model,
+            template,
+            args.max_length,
+            base_url=args.openai_base_url,
+            max_workers=args.batch_size,
+        )
+    if args.backend == "vllm":
+        return VLLMBackend(args.model, template, args.max_length, args.prefix_cache)
+    raise ValueError(f"Unknown backend: {args.backend}")
@@ -0,0 +1,76 @@
+import heapq
+import time
+
+from loguru import logger
+from tqdm import tqdm
+
+
+class GenerationScheduler:
+    """
+    Run the submitted prompts as batched generate calls.
+
+    A prompt is submitted with a callback receiving its generated text, which may
+    submit the prompts depending on it (e.g. the file sketches once the repo sketch
+    is generated), so the ready prompts of all the jobs are batched together.
+    The shortest ready prompts are generated first: they batch with little padding,
+    and the short repo sketch prompts unlock the rest of their repository early.
+
+    The prompts submitted with a `prefix` are only batched with the prompts of the
+    same prefix, so that the generation can reuse its states (see `--prefix_cache`).
+    """
+
+    def __init__(self, generate_batch, batch_size=8):
+        """
+        `generate_batch(prompts, prefix)` maps a list of prompts (starting with `prefix`
+        unless it is None) to the list of their generated texts.
+        """
+        self.generate_batch = generate_batch
+        self.batch_size = batch_size
+        # prefix -> heap of the ready prompts
+        self.ready = {}
+        self.num_submitted = 0
+
+    def submit(self, prompt, callback, prefix=None):
+        # the submission order breaks the ties, callbacks are never compared
+        heapq.heappush(
+            self.ready.setdefault(prefix, []),
+            (len(prompt), self.num_submitted, prompt, callback),
+        )
+        self.num_submitted += 1
+
+    def next_batch(self):
+        # the group of the shortest ready prompt
+        prefix = min(self.ready, key=lambda x: self.ready[x][0][:2])
+        ready = self.ready[prefix]
+        batch = []
+        while ready and len(batch) < self.batch_size:
+            batch.append(heapq.heappop(ready))
+        if not ready:
+            del self.ready[prefix]
+        return prefix, batch
+
+    def run(self):
+        """
+        Generate until no prompt is ready, including the ones submitted meanwhile.
+        """
+        num_batches = 0
+        num_generated = 0
+        start_time = time.perf_counter()
+        with tqdm(total=self.num_submitted, desc="generation") as progress:
+            while self.ready:
+                prefix, batch = self.next_batch()
+                generated_texts = self.generate_batch([x[2] for x in batch], prefix)
+                assert len(generated_texts) == len(batch)
+                for (_, _, _, callback), generated_text in zip(batch, generated_texts):
+                    callback(generated_text)
+
+                num_batches += 1
+                num_generated += len(batch)
+                progress.total = self.num_submitted
+                progress.update(len(batch))
+
+        elapsed = time.perf_counter() - start_time
+        logger.info(
+            f"generated {num_generated} prompts in {num_batches} batches, "
+            f"{elapsed:.1f}s ({num_generated / max(elapsed, 1e-9):.2f} prompts/sec)"
+        )
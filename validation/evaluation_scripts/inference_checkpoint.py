@@ -0,0 +1,96 @@
+import hashlib
+import json
+import os
+import time
+from collections import Counter
+
+from loguru import logger
+
+
+def get_instruction_hash(instruction):
+    """
+    Key of a record, stable across runs (unlike `hash`).
+    """
+    return hashlib.sha256(instruction.encode("utf-8")).hexdigest()
+
+
+def write_text_atomic(path, content):
+    """
+    Write a text file through a temporary file, so that a crash never leaves it half written.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class InferenceCheckpoint:
+    """
+    The `.jsonl` output of an inference phase, appended one record at a time as they
+    are generated, and fsynced at most every `fsync_interval` seconds and on close.
+
+    With `resume`, the records already in the file are kept and looked up by the hash
+    of their instruction and its occurrence (the records of a file may share an
+    instruction), so that a restarted run skips them. A last line torn by a crash is
+    dropped. Without `resume`, the file is truncated.
+    """
+
+    def __init__(self, path, resume=False, fsync_interval=10.0):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        # (instruction hash, occurrence) -> record of the previous run
+        self.completed = {}
+        # occurrences of the instructions looked up so far
+        self.occurrences = Counter()
+        lines = []
+        loaded = Counter()
+        if resume and os.path.exists(path):
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    lines.append(line if line.endswith("\n") else line + "\n")
+                    key = get_instruction_hash(record["instruction"])
+                    self.completed[(key, loaded[key])] = record
+                    loaded[key] += 1
+            logger.info(f"Resuming {path}: {len(lines)} records already done")
+
+        write_text_atomic(path, "".join(lines))
+        self.file = open(path, "a")
+        self.last_fsync = time.monotonic()
+
+    def get(self, instruction):
+        """
+        The record of the previous run for the next occurrence of the instruction,
+        None if it is still to generate. To be called once per input record, in the
+        order of the inputs; the records written meanwhile are never returned.
+        """
+        key = get_instruction_hash(instruction)
+        occurrence = self.occurrences[key]
+        self.occurrences[key] += 1
+        return self.completed.get((key, occurrence))
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        if time.monotonic() - self.last_fsync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.last_fsync = time.monotonic()
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,234 @@
+import asyncio
+import json
+import os
+import random
+import time
+
+from loguru import logger
+
+from inference_checkpoint import get_instruction_hash, write_text_atomic
+
+# statuses worth retrying besides the server errors (>= 500)
+RETRY_STATUS_CODES = {408, 409, 429}
+
+
+class EmptyResponseError(Exception):
+    """
+    A completion without content (e.g. cut by a content filter), retried as a
+    transient error and never cached.
+    """
+
+
+class TokenBucket:
+    """
+    Rate limiter allowing `rate` acquisitions per second on average, in bursts of at
+    most `capacity`. The waiters are served in order.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, amount=1):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.last_refill) * self.rate
+                )
+                self.last_refill = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+class ResponseCache:
+    """
+    Responses keyed by model, temperature and prompt, appended to the `.jsonl` file
+    `path` (kept in memory only if None) as they arrive, so that a rerun only sends
+    the requests that failed or never ran. A last line torn by a crash is dropped.
+    """
+
+    def __init__(self, path=None):
+        self.responses = {}
+        self.file = None
+        if path is None:
+            return
+
+        lines = []
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    lines.append(line if line.endswith("\n") else line + "\n")
+                    self.responses[record["key"]] = record["response"]
+            logger.info(f"Loaded {len(lines)} cached responses from {path}")
+
+        write_text_atomic(path, "".join(lines))
+        self.file = open(path, "a")
+
+    @staticmethod
+    def get_key(prompt, model, temperature):
+        return get_instruction_hash(json.dumps([model, temperature, prompt]))
+
+    def get(self, key):
+        return self.responses.get(key)
+
+    def put(self, key, response):
+        self.responses[key] = response
+        if self.file is not None:
+            self.file.write(json.dumps({"key": key, "response": response}) + "\n")
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+class AsyncOpenAIClient:
+    """
+    Concurrent requests to the chat endpoint of an OpenAI-compatible server (e.g. a
+    local stub, through `base_url`), over one pool of HTTP connections.
+
+    At most `max_concurrency` requests are in flight and at most `requests_per_minute`
+    are started per minute. The connection errors, timeouts, rate limits, server
+    errors and responses without content are retried up to `max_retries` times, after
+    the `Retry-After` delay of the server if any, else an exponential backoff with full
+    jitter; the other errors (e.g. an invalid request) are raised at once.
+
+    Must be created in the running event loop.
+    """
+
+    def __init__(
+        self,
+        model,
+        base_url=None,
+        api_key=None,
+        max_concurrency=16,
+        requests_per_minute=3500,
+        max_retries=6,
+        initial_backoff=1.0,
+        max_backoff=60.0,
+        timeout=120.0,
+        cache_path=None,
+    ):
+        try:
+            import httpx
+            import openai
+        except ImportError:
+            raise ImportError("Please install openai via `pip install openai`")
+
+        self.openai = openai
+        self.model = model
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.client = openai.AsyncOpenAI(
+            base_url=base_url or os.environ.get("OPENAI_API_BASE_URL"),
+            api_key=api_key or os.environ.get("OPENAI_API_KEY"),
+            timeout=timeout,
+            # retried here, to share the backoff with the rate limiter
+            max_retries=0,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=max_concurrency,
+                    max_keepalive_connections=max_concurrency,
+                ),
+                timeout=timeout,
+            ),
+        )
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.rate_limiter = TokenBucket(
+            requests_per_minute / 60.0, capacity=max_concurrency
+        )
+        self.cache = ResponseCache(cache_path)
+        self.num_requests = 0
+        self.num_retries = 0
+        self.num_cache_hits = 0
+
+    def is_retryable(self, e):
+        if isinstance(e, EmptyResponseError):
+            return True
+        # the timeouts are connection errors
+        if isinstance(e, self.openai.APIConnectionError):
+            return True
+        if isinstance(e, self.openai.APIStatusError):
+            return e.status_code in RETRY_STATUS_CODES or e.status_code >= 500
+        return False
+
+    def get_backoff(self, attempt, e):
+        response = getattr(e, "response", None)
+        if response is not None:
+            try:
+                return min(float(response.headers["retry-after"]), self.max_backoff)
+            except (KeyError, ValueError):
+                pass
+        return random.uniform(
+            0, min(self.max_backoff, self.initial_backoff * 2**attempt)
+        )
+
+    async def chat(self, prompt, temperature=0.0):
+        """
+        Response of the model to a single user message.
+        """
+        key = self.cache.get_key(prompt, self.model, temperature)
+        response = self.cache.get(key)
+        if response is not None:
+            self.num_cache_hits += 1
+            return response
+
+        attempt = 0
+        while True:
+            async with self.semaphore:
+                await self.rate_limiter.acquire()
+                self.num_requests += 1
+                try:
+                    completion = await self.client.chat.completions.create(
+                        model=self.model,
+                        temperature=temperature,
+                        messages=[{"role": "user", "content": prompt}],
+                    )
+                    choice = completion.choices[0]
+                    response = choice.message.content
+                    if response is None:
+                        raise EmptyResponseError(
+                            "OpenAI API response without content (finish reason: "
+                            f"{getattr(choice, 'finish_reason', None)})"
+                        )
+                    break
+                except (self.openai.APIError, EmptyResponseError) as e:
+                    if not self.is_retryable(e) or attempt >= self.max_retries:
+                        raise
+                    delay = self.get_backoff(attempt, e)
+                    logger.warning(
+                        f"OpenAI API request failed ({e.__class__.__name__}: {e}), "
+                        f"retrying in {delay:.1f}s"
+                    )
+            # sleeping without holding a connection slot
+            await asyncio.sleep(delay)
+            attempt += 1
+            self.num_retries += 1
+
+        self.cache.put(key, response)
+        return response
+
+    async def close(self):
+        logger.info(
+            f"{self.num_requests} OpenAI API requests, {self.num_retries} retries, "
+            f"{self.num_cache_hits} cache hits"
+        )
+        await self.client.close()
+        self.cache.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
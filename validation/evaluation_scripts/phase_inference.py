@@ -1,13 +1,14 @@
-# =============非常慢的方式=============
-from transformers import AutoTokenizer
-import transformers
-import torch
 import os
 import sys
-import json
 from loguru import logger
 import argparse
+import pathlib
 from tqdm import tqdm
+from inference_checkpoint import InferenceCheckpoint
+from generation_backends import add_backend_args, get_backend
+
+sys.path.append(str(pathlib.Path(__file__).parent.parent.parent.absolute()))
+from record_utils import find_record_file, iter_records
 
 template = """[INST] <<SYS>>\nYou are a helpful, respectful and honest assistant. Always answer as helpfully as possible, while being safe. Your answers should not include any harmful, unethical, racist, sexist, toxic, dangerous, or illegal content. Please ensure that your responses are socially unbiased and positive in nature. 
 
@@ -21,73 +22,63 @@ parser.add_argument(
 )
 parser.add_argument("--phase", type=str, default=None)
 parser.add_argument("--model", type=str, default=None)
+parser.add_argument(
+    "--resume",
+    action="store_true",
+    help="Keep the records already generated in the output directory, only generating the rest.",
+)
+parser.add_argument(
+    "--batch_size", type=int, default=8, help="Prompts per generate call."
+)
+add_backend_args(parser)
 
 args = parser.parse_args()
 
-tokenizer = AutoTokenizer.from_pretrained(args.model)
-pipeline = transformers.pipeline(
-    "text-generation",
-    model=args.model,
-    torch_dtype=torch.float16,
-    device_map="auto",
-)
+backend = get_backend(args, template)
+
+
+def generate_records(batch, checkpoint, share_prefix=False):
+    instructions = [each["instruction"] for each in batch]
+    prefix = None
+    if share_prefix and backend.supports_prefix and len(batch) > 1:
+        # e.g. the README summary and repository sketch of the function body prompts
+        prefix = os.path.commonprefix(instructions) or None
+    for each, generated in zip(batch, backend.generate(instructions, prefix)):
+        each["generated"] = generated
+        checkpoint.write(each)
+
 
 for repo in [args.project] if args.project else os.listdir(args.input_dir):
     output_dir = os.path.join(args.output_dir, args.model.split("/")[-1], repo)
     if not os.path.exists(output_dir):
         os.system(f"mkdir -p {output_dir}")
-    for to_infer in (
-        ["repo_sketch.json", "file_sketch.json", "function_body.json"]
+    for phase in (
+        ["repo_sketch", "file_sketch", "function_body"]
         if not args.phase
-        else f"{args.phase}.json"
+        else [args.phase]
     ):
-        logger.info(f"Processing {repo} {to_infer}")
-        input_file = os.path.join(args.input_dir, repo, to_infer)
-        with open(os.path.join(args.input_dir, repo, to_infer), "r") as f:
-            output_file = os.path.join(output_dir, to_infer + ".jsonl")
-            with open(output_file, "w") as f:
-                pass
-
-            with open(input_file, "r") as f:
-                data = json.load(f)
-
-            for each in tqdm(data):
-                sequences = pipeline(
-                    template.format(each["instruction"]),
-                    do_sample=False,
-                    num_return_sequences=1,
-                    eos_token_id=tokenizer.eos_token_id,
-                    max_length=8192,
-                    # max_new_tokens=2048,
-                )
-                each["generated"] = (
-                    sequences[0]["generated_text"].split("[/INST]")[-1].strip()
-                )
-                for seq in sequences:
-                    with open(output_file, "a") as f:
-                        f.write(json.dumps(each) + "\n")
+        # the records may be .json, .jsonl, .jsonl.gz or .jsonl.zst
+        input_file = find_record_file(os.path.join(args.input_dir, repo), phase)
+        if input_file is None:
+            logger.warning(f"No {phase} records found for {repo}, skipping.")
+            continue
+        logger.info(f"Processing {repo} {phase}")
+        to_infer = f"{phase}.json"
+        output_file = os.path.join(output_dir, to_infer + ".jsonl")
+        checkpoint = InferenceCheckpoint(output_file, args.resume)
 
-# =============使用VLLM加速之后的推理方式，快很多=============
-# from vllm import LLM, SamplingParams
+        data = iter_records(input_file)
 
-# # Sample prompts.
-# prompts = [
-#     raw_input
-# ]
-# # Create a sampling params object.
-# sampling_params = SamplingParams(
-#   temperature=0.8,
-#   top_p=0.95,
-#   max_tokens=1024
-# )
+        batch = []
+        for each in tqdm(data):
+            if checkpoint.get(each["instruction"]) is not None:
+                continue
+            batch.append(each)
+            if len(batch) == args.batch_size:
+                generate_records(batch, checkpoint, phase == "function_body")
+                batch = []
+        if batch:
+            generate_records(batch, checkpoint, phase == "function_body")
+        checkpoint.close()
 
-# # Create an LLM.
-# llm = LLM(model="/dev/shm/codes7b/full/2024-01-01-00-00-01/checkpoint-5")
-# # Generate texts from the prompts. The output is a list of RequestOutput objects
-# # that contain the prompt, generated text, and other information.
-# outputs = llm.generate(prompts, sampling_params)
-# # Print the outputs.
-# for output in outputs:
-#     prompt = output.prompt
-#     generated_text = output.outputs[0].text
-#     print(f"Prompt: {prompt!r}, Generated text: {generated_text!r}")
+backend.close()
@@ -0,0 +1,63 @@
+import json
+import pathlib
+import sys
+
+sys.path.append(str(pathlib.Path(__file__).parent.parent.absolute()))
+from inference_checkpoint import InferenceCheckpoint
+
+
+def run_phase(path, records, resume=False, crash_after=None):
+    # the loop of phase_inference.py, generating the output of each record
+    generated = []
+    checkpoint = InferenceCheckpoint(str(path), resume)
+    for each in records:
+        if checkpoint.get(each["instruction"]) is not None:
+            continue
+        if crash_after is not None and len(generated) == crash_after:
+            break
+        generated.append(each["output"])
+        checkpoint.write(dict(each, generated=each["output"]))
+    checkpoint.close()
+    return generated
+
+
+def read_outputs(path):
+    with open(path, "r") as f:
+        return [json.loads(line)["output"] for line in f]
+
+
+RECORDS = [
+    {"instruction": "write", "output": "a"},
+    {"instruction": "other", "output": "b"},
+    {"instruction": "write", "output": "c"},
+]
+
+
+def test_duplicate_instructions_are_all_written(tmp_path):
+    path = tmp_path / "function_body.json.jsonl"
+    assert run_phase(path, RECORDS) == ["a", "b", "c"]
+    assert read_outputs(path) == ["a", "b", "c"]
+
+
+def test_duplicate_instructions_are_resumed_one_for_one(tmp_path):
+    path = tmp_path / "function_body.json.jsonl"
+    assert run_phase(path, RECORDS, crash_after=2) == ["a", "b"]
+    assert run_phase(path, RECORDS, resume=True) == ["c"]
+    assert read_outputs(path) == ["a", "b", "c"]
+    assert run_phase(path, RECORDS, resume=True) == []
+
+
+def test_without_resume_the_output_is_truncated(tmp_path):
+    path = tmp_path / "function_body.json.jsonl"
+    run_phase(path, RECORDS)
+    assert run_phase(path, RECORDS) == ["a", "b", "c"]
+    assert read_outputs(path) == ["a", "b", "c"]
+
+
+def test_torn_last_line_is_dropped(tmp_path):
+    path = tmp_path / "function_body.json.jsonl"
+    run_phase(path, RECORDS, crash_after=2)
+    with open(path, "a") as f:
+        f.write('{"instruction": "wri')
+    assert run_phase(path, RECORDS, resume=True) == ["c"]
+    assert read_outputs(path) == ["a", "b", "c"]
@@ -0,0 +1,200 @@
+import asyncio
+import json
+import pathlib
+import sys
+import time
+import types
+
+import pytest
+
+sys.path.append(str(pathlib.Path(__file__).parent.parent.absolute()))
+from openai_client import AsyncOpenAIClient, EmptyResponseError, TokenBucket
+
+
+class APIError(Exception):
+    pass
+
+
+class APIConnectionError(APIError):
+    pass
+
+
+class APITimeoutError(APIConnectionError):
+    pass
+
+
+class APIStatusError(APIError):
+    def __init__(self, message, status_code, headers=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.response = types.SimpleNamespace(headers=headers or {})
+
+
+class RateLimitError(APIStatusError):
+    pass
+
+
+class BadRequestError(APIStatusError):
+    pass
+
+
+class FakeServer:
+    """
+    Chat endpoint answering with the scripted exceptions and contents (None for a
+    completion without content) in order, then with the prompt itself.
+    """
+
+    def __init__(self):
+        self.script = []
+        self.latency = 0.0
+        self.num_calls = 0
+        self.inflight = 0
+        self.max_inflight = 0
+
+    async def create(self, model, temperature, messages):
+        self.num_calls += 1
+        self.inflight += 1
+        self.max_inflight = max(self.max_inflight, self.inflight)
+        try:
+            await asyncio.sleep(self.latency)
+            item = self.script.pop(0) if self.script else messages[0]["content"]
+            if isinstance(item, Exception):
+                raise item
+            message = types.SimpleNamespace(content=item)
+            return types.SimpleNamespace(
+                choices=[types.SimpleNamespace(message=message, finish_reason="stop")]
+            )
+        finally:
+            self.inflight -= 1
+
+
+@pytest.fixture
+def server(monkeypatch):
+    server = FakeServer()
+
+    class AsyncOpenAI:
+        def __init__(self, **kwargs):
+            self.chat = types.SimpleNamespace(completions=server)
+
+        async def close(self):
+            pass
+
+    openai = types.ModuleType("openai")
+    for cls in [
+        APIError,
+        APIConnectionError,
+        APITimeoutError,
+        APIStatusError,
+        RateLimitError,
+        BadRequestError,
+        AsyncOpenAI,
+    ]:
+        setattr(openai, cls.__name__, cls)
+    httpx = types.ModuleType("httpx")
+    httpx.AsyncClient = lambda **kwargs: None
+    httpx.Limits = lambda **kwargs: None
+    monkeypatch.setitem(sys.modules, "openai", openai)
+    monkeypatch.setitem(sys.modules, "httpx", httpx)
+    return server
+
+
+def run_client(prompts, cache_path=None, **kwargs):
+    # the clients are created in the running event loop
+    async def run():
+        kwargs.setdefault("initial_backoff", 0.01)
+        async with AsyncOpenAIClient(
+            "model", cache_path=cache_path, **kwargs
+        ) as client:
+            results = await asyncio.gather(
+                *[client.chat(prompt) for prompt in prompts], return_exceptions=True
+            )
+            return client, results
+
+    return asyncio.run(run())
+
+
+def test_transient_errors_are_retried(server):
+    server.script = [
+        RateLimitError("slow down", 429, {"retry-after": "0.01"}),
+        APIStatusError("unavailable", 503),
+        APITimeoutError("timeout"),
+        "response",
+    ]
+    client, results = run_client(["prompt"])
+    assert results == ["response"]
+    assert (client.num_requests, client.num_retries) == (4, 3)
+
+
+def test_retries_are_bounded(server):
+    server.script = [APIStatusError("unavailable", 503)] * 3
+    client, results = run_client(["prompt"], max_retries=2)
+    assert isinstance(results[0], APIStatusError)
+    assert (client.num_requests, client.num_retries) == (3, 2)
+
+
+def test_bad_request_is_raised_at_once(server):
+    server.script = [BadRequestError("too long", 400)]
+    client, results = run_client(["prompt"])
+    assert isinstance(results[0], BadRequestError)
+    assert (client.num_requests, client.num_retries) == (1, 0)
+
+
+def test_empty_response_is_retried_and_not_cached(server, tmp_path):
+    cache_path = tmp_path / "responses.jsonl"
+    server.script = [None, "response"]
+    client, results = run_client(["prompt"], cache_path=str(cache_path))
+    assert results == ["response"]
+    assert client.num_retries == 1
+
+    server.script = [None] * 3
+    client, results = run_client(["other"], cache_path=str(cache_path), max_retries=2)
+    assert isinstance(results[0], EmptyResponseError)
+    with open(cache_path, "r") as f:
+        assert [json.loads(line)["response"] for line in f] == ["response"]
+
+
+def test_responses_are_cached(server, tmp_path):
+    cache_path = tmp_path / "responses.jsonl"
+    client, results = run_client(["a", "b"], cache_path=str(cache_path))
+    assert results == ["a", "b"]
+    assert (client.num_requests, client.num_cache_hits) == (2, 0)
+
+    # a rerun is served from the file, whose torn last line is dropped
+    with open(cache_path, "a") as f:
+        f.write('{"key": "c')
+    client, results = run_client(["a", "b", "c"], cache_path=str(cache_path))
+    assert results == ["a", "b", "c"]
+    assert (client.num_requests, client.num_cache_hits) == (1, 2)
+
+
+def test_retry_after_is_honored(server):
+    async def run():
+        return AsyncOpenAIClient("model", initial_backoff=1.0, max_backoff=10.0)
+
+    client = asyncio.run(run())
+    assert client.get_backoff(0, RateLimitError("", 429, {"retry-after": "3"})) == 3.0
+    assert client.get_backoff(0, RateLimitError("", 429, {"retry-after": "30"})) == 10.0
+    for attempt in range(6):
+        assert (
+            0
+            <= client.get_backoff(attempt, APIStatusError("", 503))
+            <= min(10.0, 2**attempt)
+        )
+
+
+def test_concurrency_is_bounded(server):
+    server.latency = 0.02
+    client, results = run_client([str(i) for i in range(8)], max_concurrency=2)
+    assert results == [str(i) for i in range(8)]
+    assert server.max_inflight == 2
+
+
+def test_token_bucket_paces_acquisitions():
+    async def run():
+        bucket = TokenBucket(rate=50, capacity=2)
+        start = time.monotonic()
+        await asyncio.gather(*[bucket.acquire() for _ in range(7)])
+        return time.monotonic() - start
+
+    # the burst of 2 is free, the 5 others wait 1/50 s each
+    assert asyncio.run(run()) >= 0.09
@@ -0,0 +1,47 @@
+import pathlib
+import sys
+
+sys.path.append(str(pathlib.Path(__file__).parent.parent.absolute()))
+import utils
+import extract_sketch as sketch_utils
+
+SOURCE = """def make_writer(prefix):
+    def write(s):
+        print(prefix + s)
+
+    return write
+
+
+def write(s):
+    print(s)
+"""
+
+
+def get_function_body_inputs():
+    each = {
+        "file_path": "writer.py",
+        "parsed": SOURCE,
+        "repo_sketch": ".\n└── writer.py",
+    }
+    insts = {"writer.py": each}
+    return utils.generate_function_body_input(
+        0, each, "# Writer", insts, "", sketch_utils.ParsedFileCache(insts)
+    )
+
+
+def get_current_file_sketch(function_request):
+    return function_request["relevant_file_sketches"].split("writer.py")[-1]
+
+
+def test_todo_marks_the_top_level_occurrence():
+    nested, top_level = [
+        x for x in get_function_body_inputs() if x["function_header"] == "def write(s):"
+    ]
+    # the nested function is not in the sketch, the top-level one is marked
+    assert '"""TODO"""' not in get_current_file_sketch(nested)
+    assert (
+        get_current_file_sketch(top_level)
+        .rstrip()
+        .endswith('def write(s):\n    """TODO"""\n```')
+    )
+    assert (nested["idx"], top_level["idx"]) == (0, 1)
@@ -5,6 +5,10 @@ import argparse
 import ast
 import astor
 import black
+import pathlib
+
+sys.path.append(str(pathlib.Path(__file__).parent.parent.parent.absolute()))
+from parse_utils import get_parseable_prefix, parse_prefix
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--project", type=str, default=None)
@@ -39,23 +43,17 @@ class FillInFunction(ast.NodeTransformer):
                 self.index[node.name] = 0
             self.index[node.name] += 1
             function_source = self.function_map[node.name][self.index[node.name] - 1]
-            while function_source.strip() != "":
-                try:
-                    node.body = ast.parse(function_source).body[0].body
-                    break
-                except:
-                    function_source = "\n".join(function_source.split("\n")[:-1])
+            try:
+                node.body = parse_prefix(function_source).body[0].body
+            except (IndexError, AttributeError):
+                # nothing parseable, or not starting with a function
+                pass
 
         return node
 
 
 def fill_in_function(source_code, function_map):
-    while source_code.strip() != "":
-        try:
-            parsed_code = ast.parse(source_code)
-            break
-        except:
-            source_code = "\n".join(source_code.split("\n")[:-1])
+    parsed_code = parse_prefix(source_code)
     transformer = FillInFunction(function_map)
     new_code = transformer.visit(parsed_code)
     new_code = astor.to_source(new_code)
@@ -122,14 +120,9 @@ if __name__ == "__main__":
                 new_file_sketch = fill_in_function(file_sketch, function_map)
                 new_file_sketch = astor.to_source(ast.parse(new_file_sketch))
                 for invalid_case in invalid_cases:
-                    while invalid_case["source"].strip() != "":
-                        try:
-                            compile_success = ast.parse(invalid_case["source"])
-                            break
-                        except:
-                            invalid_case["source"] = "\n".join(
-                                invalid_case["source"].split("\n")[:-1]
-                            )
+                    invalid_case["source"] = get_parseable_prefix(
+                        invalid_case["source"]
+                    )
                     new_file_sketch = new_file_sketch.replace(
                         invalid_case["old_source"].strip(),
                         invalid_case["source"].strip(),
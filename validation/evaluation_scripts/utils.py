@@ -1,3 +1,4 @@
+import functools
 import json
 import sys
 import pathlib
@@ -5,6 +6,7 @@ import pathlib
 sys.path.append(str(pathlib.Path(__file__).parent.parent.parent.absolute()))
 import extract_sketch as sketch_utils
 import prompt_construction_utils as prpt_utils
+from parse_utils import get_parseable_prefix
 
 
 class RepoSketchNode:
@@ -69,6 +71,16 @@ def parse_repo_sketch(repo_sketch):
     return root_node
 
 
+@functools.lru_cache(maxsize=16)
+def get_repo_sketch_tree(repo_sketch):
+    """
+    Repository tree of the paths of a generated repository sketch, shared by all
+    the inputs built from the same sketch.
+    """
+    paths = parse_repo_sketch(repo_sketch).get_paths()
+    return sketch_utils.RepoTree([("", path) for path in paths])
+
+
 def parse_reponse(response):
     try:
         response = response.split("```")[1]
@@ -79,8 +91,10 @@ def parse_reponse(response):
 
 
 def generate_file_sketch_input(idx, each, readme_content):
-    repo_sketch_tree = parse_repo_sketch(each["parsed"])
-    repo_sketch_paths = repo_sketch_tree.get_paths()
+    repo_sketch_paths = [x.path for x in get_repo_sketch_tree(each["parsed"])]
+    prompt_template = prpt_utils.get_file_sketch_template(
+        readme_content, each["parsed"]
+    )
     file_sketch_insts = []
     for path in repo_sketch_paths:
         file_sketch_insts.append(
@@ -89,17 +103,14 @@ def generate_file_sketch_input(idx, each, readme_content):
                 "readme": readme_content,
                 "repo_sketch": each["parsed"],
                 "file_path": path,
-                "instruction": prpt_utils.get_file_sketch_prompt(
-                    readme_content, each["parsed"], path
-                ),
+                "instruction": prompt_template.render(path),
             }
         )
     return file_sketch_insts
 
 
 def generate_file_sketch_input_openai(each, readme_content, template):
-    repo_sketch_tree = parse_repo_sketch(each["parsed"])
-    repo_sketch_paths = repo_sketch_tree.get_paths()
+    repo_sketch_paths = [x.path for x in get_repo_sketch_tree(each["parsed"])]
     file_sketch_insts = []
     for path in repo_sketch_paths:
         if not path.endswith(".py"):
@@ -121,39 +132,42 @@ def generate_file_sketch_input_openai(each, readme_content, template):
     return file_sketch_insts
 
 
-def generate_function_body_input(idx, each, readme, insts, repo_path):
+def generate_function_body_input(
+    idx, each, readme, insts, repo_path, parsed_cache=None
+):
+    """
+    `parsed_cache` is the `extract_sketch.ParsedFileCache(insts)` of the repository,
+    shared by its files so that each relevant file is parsed and sketched once.
+    """
+    if parsed_cache is None:
+        parsed_cache = sketch_utils.ParsedFileCache(insts)
     python_content = each["parsed"]
     repo_sketch = each["repo_sketch"]
-    repo_sketch_tree = parse_repo_sketch(repo_sketch)
-    paths = repo_sketch_tree.get_paths()
-    paths = [("", path) for path in paths]
+    paths = get_repo_sketch_tree(repo_sketch)
 
     try:
-        all_function_names = sketch_utils.get_all_function_names(python_content)
+        parsed_code = sketch_utils.parse_code(python_content)
     except SyntaxError as e:
         print(e)
-        while python_content != "":
-            try:
-                python_content = "\n".join(python_content.split("\n")[:-1])
-                all_function_names = sketch_utils.get_all_function_names(python_content)
-                break
-            except:
-                pass
-
-    function_names_cnt = {}
-    all_indexed_function_names = []
-    for function_name in all_function_names:
-        if function_name not in function_names_cnt:
-            function_names_cnt[function_name] = 0
-        function_names_cnt[function_name] += 1
-
-        all_indexed_function_names.append(
-            (function_names_cnt[function_name] - 1, function_name)
-        )
+        python_content = get_parseable_prefix(python_content)
+        parsed_code = sketch_utils.parse_code(python_content)
+
+    # the occurrence index of each function among all the functions (its header),
+    # and among the ones marked as TODO in the sketch (None for nested functions)
+    collector = sketch_utils.FunctionNodeCollector()
+    collector.visit(parsed_code)
+    all_indexed_function_names = sketch_utils.index_function_names(
+        [node.name for node, _ in collector.functions]
+    )
     all_imports = sketch_utils.extract_imports(python_content)
+    readme_summary = sketch_utils.extract_summary_from_readme(readme)
+    prompt_template = prpt_utils.get_function_body_template(readme_summary, repo_sketch)
+    function_headers = sketch_utils.get_function_headers(python_content, parsed_code)
 
     function_requets = []
-    for idx, this_function_name in all_indexed_function_names:
+    for (idx, this_function_name), (_, sketch_index) in zip(
+        all_indexed_function_names, collector.functions
+    ):
         (
             relevant_file_list,
             relevant_file_sketch_content,
@@ -164,18 +178,13 @@ def generate_function_body_input(idx, each, readme, insts, repo_path):
             this_function_name,
             repo_path,
             insts,
-            idx,
+            sketch_index,
+            parsed_cache,
         )
 
-        readme_summary = sketch_utils.extract_summary_from_readme(readme)
-        function_header_content = sketch_utils.extract_function_header(
-            python_content, this_function_name, idx
-        )
-        prompt = prpt_utils.get_function_body_prompt(
-            readme_summary,
-            repo_sketch,
-            relevant_file_sketch_content,
-            function_header_content,
+        function_header_content = function_headers[(idx, this_function_name)]
+        prompt = prompt_template.render(
+            relevant_file_sketch_content, function_header_content
         )
         function_requets.append(
             {
@@ -193,37 +202,28 @@ def generate_function_body_input(idx, each, readme, insts, repo_path):
     return function_requets
 
 
-def generate_function_body_input_openai(each, readme, insts, repo_path, template):
+def generate_function_body_input_openai(
+    each, readme, insts, repo_path, template, parsed_cache=None
+):
+    if parsed_cache is None:
+        parsed_cache = sketch_utils.ParsedFileCache(insts)
     python_content = each["parsed"]
     repo_sketch = each["repo_sketch"]
-    repo_sketch_tree = parse_repo_sketch(repo_sketch)
-    paths = repo_sketch_tree.get_paths()
-    paths = [("", path) for path in paths]
+    paths = get_repo_sketch_tree(repo_sketch)
 
     try:
         all_function_names = sketch_utils.get_all_function_names(python_content)
     except SyntaxError as e:
         print(e)
-        while python_content != "":
-            try:
-                python_content = "\n".join(python_content.split("\n")[:-1])
-                all_function_names = sketch_utils.get_all_function_names(python_content)
-                break
-            except:
-                pass
+        python_content = get_parseable_prefix(python_content)
+        all_function_names = sketch_utils.get_all_function_names(python_content)
 
     # all_filted_function_names = sketch_utils.remove_duplicates(all_function_names)
-    function_names_cnt = {}
-    all_indexed_function_names = []
-    for function_name in all_function_names:
-        if function_name not in function_names_cnt:
-            function_names_cnt[function_name] = 0
-        function_names_cnt[function_name] += 1
-
-        all_indexed_function_names.append(
-            (function_names_cnt[function_name] - 1, function_name)
-        )
+    all_indexed_function_names = sketch_utils.index_function_names(
+        all_function_names
+    )
     all_imports = sketch_utils.extract_imports(python_content)
+    function_headers = sketch_utils.get_function_headers(python_content)
 
     function_requets = []
     for idx, this_function_name in all_indexed_function_names:
@@ -231,13 +231,17 @@ def generate_function_body_input_openai(each, readme, insts, repo_path, template
             relevant_file_list,
             relevant_file_sketch_content,
         ) = sketch_utils.get_relevant_file_meta(
-            each["file_path"], all_imports, paths, this_function_name, repo_path, insts
+            each["file_path"],
+            all_imports,
+            paths,
+            this_function_name,
+            repo_path,
+            insts,
+            parsed_cache=parsed_cache,
         )
 
         readme_summary = sketch_utils.extract_summary_from_readme(readme)
-        function_header_content = sketch_utils.extract_function_header(
-            python_content, this_function_name
-        )
+        function_header_content = function_headers[(0, this_function_name)]
         relevant_file_sketch_content = relevant_file_sketch_content.replace(
             "Relevant File Sketch", "## Relevant File Sketch"
         ).replace("Current File Sketch", "## Current File Sketch")